@@ -22,6 +22,10 @@ appbuilder = AppBuilder(app, db.session)
 from app.cli import register_commands
 register_commands(app)
 
+# Route bandwidth statistics to per-period SQLite databases when STATS_PARTITION is set
+from app.partitions import init_partitioning
+init_partitioning(app)
+
 
 """
 from sqlalchemy.engine import Engine
@@ -0,0 +1,128 @@
+import threading
+import time
+
+# Relative change between two polls (EWMA) at which an interface counts as
+# fully volatile, and the utilization band over which the poll rate ramps up
+VOLATILITY_CEILING = 0.5
+UTILIZATION_FLOOR = 0.3
+UTILIZATION_CEILING = 0.8
+
+
+class AdaptivePollPolicy:
+    """Chooses a poll interval for every interface from its recent behaviour
+
+    Each interface gets a score between 0 and 1: the larger of its volatility
+    (an EWMA of the relative rate change between polls) and how close its rate
+    is to the interface bandwidth. A score of 0 polls it every ``max_interval``
+    seconds and a score of 1 every ``min_interval`` seconds, on a geometric
+    scale in between. Intervals shrink immediately but at most double per poll,
+    so a quiet spell does not hide the next burst for long.
+
+    A device is walked in one go, so it is polled at the shortest interval of
+    its interfaces; interfaces that are not due yet are skipped when samples
+    are recorded.
+    """
+
+    def __init__(self, min_interval=60, max_interval=900, smoothing=0.3, clock=time.monotonic):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.smoothing = smoothing
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._state = {}
+        self._devices = {}
+        self._dirty = set()
+
+    def clamp(self, interval):
+        """Limit an interval to the configured bounds"""
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    @staticmethod
+    def _new_state(interval):
+        return {'interval': interval, 'volatility': 0.0, 'utilization': 0.0,
+                'rate': None, 'recorded': None}
+
+    def seed(self, device_id, interface_id, interval):
+        """Start an interface at a previously persisted interval"""
+        with self._lock:
+            self._devices.setdefault(device_id, set()).add(interface_id)
+            if interface_id not in self._state:
+                self._state[interface_id] = self._new_state(self.clamp(interval))
+
+    def forget_device(self, device_id):
+        """Drop the state of a device that is no longer polled"""
+        with self._lock:
+            for interface_id in self._devices.pop(device_id, ()):
+                self._state.pop(interface_id, None)
+                self._dirty.discard(interface_id)
+
+    def device_interval(self, device_id, default):
+        """Poll interval of a device: the shortest interval of its interfaces"""
+        with self._lock:
+            intervals = [
+                self._state[interface_id]['interval']
+                for interface_id in self._devices.get(device_id, ())
+                if interface_id in self._state
+            ]
+        return min(intervals) if intervals else self.clamp(default)
+
+    def is_due(self, device_id, interface_id):
+        """Whether a sample of this interface should be recorded on this poll
+
+        The interface is due if waiting for the next poll of its device would
+        make it later than recording it now makes it early.
+        """
+        state = self._state.get(interface_id)
+        if not state or state['recorded'] is None:
+            return True
+        elapsed = self.clock() - state['recorded']
+        step = self.device_interval(device_id, state['interval'])
+        return elapsed + step / 2 >= state['interval']
+
+    def observe(self, device_id, interface_id, rates, bandwidth_kbps):
+        """Update an interface with the rates just recorded; returns its new interval
+
+        ``rates`` is the dict from RateEngine.update(), or None when the poll
+        only primed the counters.
+        """
+        with self._lock:
+            self._devices.setdefault(device_id, set()).add(interface_id)
+            state = self._state.get(interface_id)
+            if state is None:
+                state = self._state[interface_id] = self._new_state(self.max_interval)
+                self._dirty.add(interface_id)
+            state['recorded'] = self.clock()
+            if not rates:
+                return state['interval']
+
+            rate = max(rates.get('input_rate_kbps') or 0.0, rates.get('output_rate_kbps') or 0.0)
+            if state['rate'] is not None:
+                # Ignore changes below 1% of the link (or 1 kbps) so idle ports stay flat
+                floor = max(1.0, (bandwidth_kbps or 0) * 0.01)
+                change = abs(rate - state['rate']) / max(rate, state['rate'], floor)
+                state['volatility'] += self.smoothing * (change - state['volatility'])
+            state['rate'] = rate
+            state['utilization'] = rate / bandwidth_kbps if bandwidth_kbps else 0.0
+
+            volatility_score = min(1.0, state['volatility'] / VOLATILITY_CEILING)
+            utilization_score = (state['utilization'] - UTILIZATION_FLOOR) / (
+                UTILIZATION_CEILING - UTILIZATION_FLOOR
+            )
+            score = max(volatility_score, min(1.0, max(0.0, utilization_score)))
+
+            target = self.max_interval * (self.min_interval / self.max_interval) ** score
+            interval = self.clamp(min(target, state['interval'] * 2))
+            if abs(interval - state['interval']) >= 1:
+                state['interval'] = round(interval)
+                self._dirty.add(interface_id)
+            return state['interval']
+
+    def changed(self):
+        """Return {interface_id: interval} for intervals changed since the last call"""
+        with self._lock:
+            changed = {
+                interface_id: self._state[interface_id]['interval']
+                for interface_id in self._dirty if interface_id in self._state
+            }
+            self._dirty.clear()
+        return changed
@@ -0,0 +1,260 @@
+import logging
+import struct
+import zlib
+from datetime import datetime, timedelta
+from itertools import groupby
+
+import numpy as np
+from sqlalchemy import func, select
+
+from . import db
+from .models import BandwidthStat, BandwidthArchiveBlock, Interface
+
+log = logging.getLogger(__name__)
+
+# Value columns kept in the archive, in block order; the raw counters are only
+# needed for the latest sample of an interface and stay in the hot table
+VALUE_COLUMNS = ('input_rate_kbps', 'output_rate_kbps', 'input_packets', 'output_packets',
+                 'input_errors', 'output_errors')
+MAGIC = b'BWA'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<3sBI')  # magic, format version, sample count
+EPOCH = datetime(1970, 1, 1)
+DELETE_CHUNK = 500
+# Samples of one interface moved per step, so the first run over a long history stays in small transactions
+ARCHIVE_CHUNK = 10000
+
+
+def _shuffle(array):
+    """Group the n-th bytes of all values together so zlib sees the runs of equal high bytes"""
+    return array.view(np.uint8).reshape(-1, array.itemsize).T.tobytes()
+
+
+def _unshuffle(data, count, dtype):
+    itemsize = np.dtype(dtype).itemsize
+    return np.frombuffer(data, np.uint8).reshape(itemsize, count).T.copy().view(dtype).ravel()
+
+
+def _zigzag(values):
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _unzigzag(values):
+    return ((values >> np.uint64(1)).view(np.int64)) ^ -((values & np.uint64(1)).view(np.int64))
+
+
+def encode_block(timestamps, columns):
+    """Pack one interface's samples into a compressed columnar block
+
+    ``timestamps`` are int64 microseconds since 1970 in ascending order and
+    ``columns`` maps every VALUE_COLUMNS name to a float64 array with NaN for
+    NULL. Timestamps are stored delta-of-delta and floats XORed with their
+    predecessor (as in Facebook's Gorilla), both byte-shuffled before zlib.
+    Regular polling makes most delta-of-deltas and the high bytes of the XORs
+    zero. Lossless.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    count = len(timestamps)
+    ints = timestamps.copy()
+    ints[1:] = np.diff(timestamps)
+    ints[2:] = np.diff(ints[1:])
+    parts = [_shuffle(_zigzag(ints))]
+    for name in VALUE_COLUMNS:
+        bits = np.ascontiguousarray(columns[name], dtype=np.float64).view(np.uint64)
+        xored = bits.copy()
+        xored[1:] ^= bits[:-1]
+        parts.append(_shuffle(xored))
+    return HEADER.pack(MAGIC, FORMAT_VERSION, count) + zlib.compress(b''.join(parts), 9)
+
+
+def decode_block(data):
+    """Unpack a block into ``(timestamps, columns)`` as produced for encode_block()"""
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported archive block (magic {magic!r}, version {version})")
+    payload = zlib.decompress(data[HEADER.size:])
+    width = count * 8
+    ints = _unzigzag(_unshuffle(payload[:width], count, np.uint64))
+    timestamps = ints.copy()
+    if count > 1:
+        timestamps[1:] = ints[0] + np.cumsum(np.cumsum(ints[1:]))
+    columns = {}
+    for index, name in enumerate(VALUE_COLUMNS, 1):
+        xored = _unshuffle(payload[index * width:(index + 1) * width], count, np.uint64)
+        columns[name] = np.bitwise_xor.accumulate(xored).view(np.float64)
+    return timestamps, columns
+
+
+def to_micros(timestamp):
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=int(micros))
+
+
+def rows_to_arrays(rows):
+    """Turn BandwidthStat-like dicts into ``(timestamps, columns)`` as taken by encode_block()"""
+    timestamps = np.array([to_micros(row['timestamp']) for row in rows], dtype=np.int64)
+    columns = {
+        name: np.array([np.nan if row[name] is None else row[name] for row in rows], dtype=np.float64)
+        for name in VALUE_COLUMNS
+    }
+    return timestamps, columns
+
+
+def _merge(timestamps, columns, other_timestamps, other_columns):
+    """Merge two sets of samples in timestamp order"""
+    merged = np.concatenate([timestamps, other_timestamps])
+    order = np.argsort(merged, kind='stable')
+    return merged[order], {
+        name: np.concatenate([columns[name], other_columns[name]])[order] for name in VALUE_COLUMNS
+    }
+
+
+def day_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, timestamp.day)
+
+
+def _store_day(conn, interface_id, day, rows):
+    """Add rows of one interface and day to its block, creating or re-encoding it"""
+    table = BandwidthArchiveBlock.__table__
+    timestamps, columns = rows_to_arrays(rows)
+    existing = conn.execute(select(table.c.id, table.c.data).where(
+        table.c.interface_id == interface_id, table.c.day == day
+    )).first()
+    if existing is not None:
+        timestamps, columns = _merge(*decode_block(existing.data), timestamps, columns)
+    values = {
+        'first_timestamp': from_micros(timestamps[0]),
+        'last_timestamp': from_micros(timestamps[-1]),
+        'samples': len(timestamps),
+        'data': encode_block(timestamps, columns)
+    }
+    if existing is None:
+        conn.execute(table.insert(), [dict(values, interface_id=interface_id, day=day)])
+    else:
+        conn.execute(table.update().where(table.c.id == existing.id).values(**values))
+    return len(values['data'])
+
+
+def archive_interface(conn, interface_id, cutoff, limit=ARCHIVE_CHUNK):
+    """Move up to ``limit`` samples of the oldest day of an interface before ``cutoff`` into its block
+
+    Each call takes the next step, so the history is archived one day at a
+    time; call it until no rows are left. Samples without rates (first
+    polls) carry no history and are dropped. Returns ``(rows taken, samples
+    archived, bytes written)``.
+    """
+    stats = BandwidthStat.__table__
+    first = conn.execute(select(func.min(stats.c.timestamp)).where(
+        stats.c.interface_id == interface_id, stats.c.timestamp < cutoff
+    )).scalar()
+    if first is None:
+        return 0, 0, 0
+    day = day_start(first)
+    rows = conn.execute(
+        select(stats.c.id, stats.c.timestamp, *[stats.c[name] for name in VALUE_COLUMNS]).where(
+            stats.c.interface_id == interface_id,
+            stats.c.timestamp >= day,
+            stats.c.timestamp < min(day + timedelta(days=1), cutoff)
+        ).order_by(stats.c.timestamp).limit(limit)
+    ).mappings().all()
+
+    samples = [row for row in rows if row['input_rate_kbps'] is not None]
+    written = _store_day(conn, interface_id, day, samples) if samples else 0
+    ids = [row['id'] for row in rows]
+    for start in range(0, len(ids), DELETE_CHUNK):
+        conn.execute(stats.delete().where(stats.c.id.in_(ids[start:start + DELETE_CHUNK])))
+    return len(rows), len(samples), written
+
+
+def archive_samples(after_days=2, now=None, batch_size=50, stop=None, limit=ARCHIVE_CHUNK):
+    """Archive samples older than ``after_days`` whole days, a few interfaces per transaction
+
+    Every transaction takes one step of archive_interface() for each of
+    ``batch_size`` interfaces, so it holds at most ``batch_size * limit``
+    samples however much history is waiting. Returns ``(samples,
+    interfaces, bytes)``.
+    """
+    cutoff = day_start(now or datetime.utcnow()) - timedelta(days=after_days)
+    with db.engine.connect() as conn:
+        interface_ids = conn.execute(select(Interface.__table__.c.id).order_by(Interface.__table__.c.id)).scalars().all()
+
+    samples = written = 0
+    archived_interfaces = set()
+    for start in range(0, len(interface_ids), batch_size):
+        pending = interface_ids[start:start + batch_size]
+        while pending and not (stop is not None and stop()):
+            with db.engine.begin() as conn:
+                busy = []
+                for interface_id in pending:
+                    rows, archived, size = archive_interface(conn, interface_id, cutoff, limit)
+                    if rows:
+                        busy.append(interface_id)
+                    if archived:
+                        samples += archived
+                        written += size
+                        archived_interfaces.add(interface_id)
+            pending = busy
+        if pending:
+            break
+    if samples:
+        log.info("Archived %d bandwidth samples of %d interfaces into %d bytes",
+                 samples, len(archived_interfaces), written)
+    return samples, len(archived_interfaces), written
+
+
+def empty_arrays():
+    """``(timestamps, columns)`` without samples"""
+    return np.empty(0, dtype=np.int64), {name: np.empty(0) for name in VALUE_COLUMNS}
+
+
+def read_archive_many(session, interface_ids, since, until=None):
+    """{interface_id: (timestamps, columns)} of the archived samples of interfaces in [since, until)
+
+    Reads the blocks of all interfaces with one query, grouped in order;
+    interfaces without archived samples are left out.
+    """
+    table = BandwidthArchiveBlock.__table__
+    query = select(table.c.interface_id, table.c.data).where(
+        table.c.interface_id.in_(interface_ids),
+        table.c.day >= day_start(since),
+        table.c.last_timestamp >= since
+    ).order_by(table.c.interface_id, table.c.day)
+    if until is not None:
+        query = query.where(table.c.day < until)
+    archived = {}
+    for interface_id, rows in groupby(session.execute(query), key=lambda row: row.interface_id):
+        blocks = [decode_block(row.data) for row in rows]
+        timestamps = np.concatenate([block[0] for block in blocks])
+        columns = {name: np.concatenate([block[1][name] for block in blocks]) for name in VALUE_COLUMNS}
+        keep = timestamps >= to_micros(since)
+        if until is not None:
+            keep &= timestamps < to_micros(until)
+        archived[interface_id] = timestamps[keep], {name: values[keep] for name, values in columns.items()}
+    return archived
+
+
+def read_archive(session, interface_id, since, until=None):
+    """Return ``(timestamps, columns)`` of the archived samples of an interface in [since, until)
+
+    Timestamps are int64 microseconds; empty arrays when nothing is archived.
+    """
+    return read_archive_many(session, [interface_id], since, until).get(interface_id) or empty_arrays()
+
+
+def block_rows(interface_id, timestamps, columns):
+    """Turn decoded samples into dicts shaped like BandwidthStat rows, NaN back to None"""
+    lists = {name: [None if value != value else value for value in values.tolist()]
+             for name, values in columns.items()}
+    return [
+        dict({name: lists[name][index] for name in VALUE_COLUMNS},
+             interface_id=interface_id, timestamp=from_micros(micros))
+        for index, micros in enumerate(timestamps.tolist())
+    ]
+
+
+def archived_rows(session, interface_id, since, until=None):
+    """Archived samples of an interface as BandwidthStat-like dicts, oldest first"""
+    return block_rows(interface_id, *read_archive(session, interface_id, since, until))
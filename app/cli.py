@@ -1,7 +1,9 @@
 import click
 import os
+import signal
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from flask import current_app
 from flask.cli import with_appcontext
 from app import db
 from app.models import (
@@ -11,15 +13,34 @@ from app.models import (
 )
 from app.utils import (
     ping_ip, decrypt_sensitive_data, collect_interface_bandwidth_stats,
-    get_all_devices
+    get_all_devices, explain_history_queries
+)
+from app.ingest import create_writer, replay_orphaned_spools
+from app.collector import (
+    collect_fleet_bandwidth_stats, collect_fleet_in_processes, CollectorDaemon,
+    run_daemon_processes, STATUS_OK, STATUS_FAILED
+)
+from app.sharding import parse_shard, shard_devices, default_worker_id
+from app.metrics import render_all, write_snapshot
+from app.rollups import finalize_rollups, rebuild_rollups
+from app.retention import prune, vacuum, database_size
+from app.archive import archive_samples
+from app.export import export_history, import_history, FORMATS
+from app.storage import get_storage
+from app.current import rebuild_current_state, top_interfaces
+from app.ringbuffer import open_ring_buffer
+from app.partitions import (
+    partition_period, list_partitions, pg_is_partitioned, convert_pg_table, migrate_sqlite_rows
 )
 
 @click.command("fake-add")
+@click.option("--devices", type=int, default=None,
+              help="Number of devices to create (default: the 9 sample routers)")
 @with_appcontext
-def fake_add_command():
+def fake_add_command(devices):
     """Add fake data to the database"""
     from load_fake_data import create_fake_data
-    create_fake_data()
+    create_fake_data(devices)
 
 @click.command("fake-remove")
 @with_appcontext
@@ -31,7 +52,10 @@ def fake_remove_command():
     db.session.query(PolicyMap).delete()
     db.session.query(ClassMap).delete()
     db.session.query(TrafficClass).delete()
-    db.session.query(BandwidthStat).delete()
+    get_storage().clear()
+    ring = open_ring_buffer()
+    if ring is not None:
+        ring.clear()
     db.session.query(Interface).delete()
     db.session.query(Device).delete()
     db.session.query(Connection).delete()
@@ -43,9 +67,14 @@ def fake_remove_command():
 @click.command("collect-stats")
 @click.option("--device-id", type=int, help="Collect stats for a specific device ID")
 @click.option("--all", is_flag=True, default=True, help="Collect stats for all devices")
+@click.option("--concurrency", type=int, default=None, help="Number of devices polled in parallel")
+@click.option("--timeout", type=int, default=None, help="Per-device timeout in seconds")
+@click.option("--shard", type=str, default=None,
+              help="Only poll shard K of N (e.g. 2/4), to split devices across hosts")
+@click.option("--processes", type=int, default=1, help="Number of collector processes")
 @click.option("--verbose", is_flag=True, help="Show detailed output")
 @with_appcontext
-def collect_stats_command(device_id, all, verbose):
+def collect_stats_command(device_id, all, concurrency, timeout, shard, processes, verbose):
     """Collect bandwidth statistics for all devices or a specific device"""
     start_time = time.time()
     success_count = 0
@@ -72,37 +101,85 @@ def collect_stats_command(device_id, all, verbose):
             click.echo(f"Error collecting statistics for {device.ip}: {str(e)}")
     else:
         # Collect stats for all devices
-        devices = db.session.query(Device).all()
+        devices = db.session.query(Device.id, Device.ip).all()
+        if shard:
+            try:
+                shard_index, shard_count = parse_shard(shard)
+            except ValueError as e:
+                click.echo(f"Error: {str(e)}")
+                return
+            devices = shard_devices(devices, shard_index, shard_count)
         total_devices = len(devices)
         
         if total_devices == 0:
             click.echo("No devices found in the database.")
             return
-            
-        click.echo(f"Collecting bandwidth statistics for {total_devices} devices...")
         
-        for i, device in enumerate(devices, 1):
-            if verbose:
-                click.echo(f"[{i}/{total_devices}] Processing {device.ip}...")
-            
-            try:
-                result = collect_interface_bandwidth_stats(device.id)
-                if result:
-                    success_count += 1
-                    if verbose:
-                        click.echo(f"  ✓ Successfully collected statistics")
-                else:
-                    failure_count += 1
-                    if verbose:
-                        click.echo(f"  ✗ Failed to collect statistics")
-            except Exception as e:
-                failure_count += 1
-                if verbose:
-                    click.echo(f"  ✗ Error: {str(e)}")
+        concurrency = concurrency or current_app.config.get('COLLECTOR_CONCURRENCY', 16)
+        timeout = timeout or current_app.config.get('DEVICE_TIMEOUT', 30)
+        batch_size = current_app.config.get('INGEST_BATCH_SIZE', 1000)
+        max_delay = current_app.config.get('INGEST_MAX_DELAY', 5.0)
+        processes = max(1, min(processes, total_devices))
+        click.echo(f"Collecting bandwidth statistics for {total_devices} devices "
+                   f"({processes} x {concurrency} in parallel, {timeout}s timeout)...")
+        
+        progress = {'done': 0}
+        
+        def report(result):
+            progress['done'] += 1
+            if not verbose:
+                return
+            prefix = f"[{progress['done']}/{total_devices}] {result['ip']}"
+            if result['status'] == STATUS_OK:
+                click.echo(f"{prefix}: ✓ Successfully collected statistics ({result['elapsed']:.2f}s)")
+            elif result['status'] == STATUS_FAILED:
+                click.echo(f"{prefix}: ✗ Failed to collect statistics")
+            else:
+                click.echo(f"{prefix}: ✗ {result['status'].capitalize()}: {result['error']}")
+        
+        if processes > 1:
+            # Each process gets its own slice of the devices and its own DB connections
+            db.session.remove()
+            device_groups = [
+                shard_devices(devices, index, processes, prefix='process')
+                for index in range(processes)
+            ]
+            summary = collect_fleet_in_processes(
+                device_groups, concurrency=concurrency, timeout=timeout,
+                batch_size=batch_size, max_delay=max_delay
+            )
+            ingest = summary['ingest']
+        else:
+            writer = create_writer(default_worker_id(), batch_size=batch_size, max_delay=max_delay)
+            summary = collect_fleet_bandwidth_stats(
+                devices, concurrency=concurrency, timeout=timeout, callback=report, writer=writer
+            )
+            writer.close()
+            ingest = writer.stats()
+            if current_app.config.get('METRICS_DIR'):
+                write_snapshot(current_app.config['METRICS_DIR'], 'collect-stats',
+                               max_age=current_app.config.get('METRICS_SNAPSHOT_MAX_AGE', 300))
+        success_count = summary['success']
+        failure_count = summary['failures'] + summary['errors'] + summary['timeouts']
     
     elapsed_time = time.time() - start_time
     click.echo(f"\nStatistics collection completed in {elapsed_time:.2f} seconds")
     click.echo(f"Success: {success_count}, Failures: {failure_count}")
+    
+    if not device_id:
+        click.echo(f"  (errors: {summary['errors']}, timeouts: {summary['timeouts']})")
+        click.echo(f"Inserted {ingest['rows_written']} samples in {ingest['batches']} batches "
+                   f"({ingest['db_rows_per_sec']:.0f} rows/s)")
+        if ingest['rows_spooled']:
+            click.echo(f"Warning: {ingest['rows_spooled']} samples were spooled while the database "
+                       f"was unavailable, {ingest['rows_replayed']} replayed so far; "
+                       f"run 'flask collector replay' to retry the rest")
+        if ingest['rows_dropped']:
+            click.echo(f"Warning: {ingest['rows_dropped']} samples could not be written")
+        if verbose and summary['slowest']:
+            click.echo("Slowest devices:")
+            for result in summary['slowest']:
+                click.echo(f"  {result['ip']:<15} {result['elapsed']:.2f}s ({result['status']})")
 
 @click.command("check-devices")
 @click.option("--ping", is_flag=True, default=True, help="Check ICMP connectivity")
@@ -542,6 +619,312 @@ def export_config_command(format, output, device_id):
             click.echo(f"Error generating text report: {str(e)}")
             return
 
+@click.group("collector")
+def collector_group():
+    """Long-running bandwidth statistics collector"""
+
+@collector_group.command("run")
+@click.option("--concurrency", type=int, default=None, help="Maximum number of devices polled at once")
+@click.option("--timeout", type=int, default=None, help="Per-device timeout in seconds")
+@click.option("--interval", type=int, default=None,
+              help="Poll interval in seconds for devices without their own")
+@click.option("--workers", type=int, default=1, help="Number of sharded collector processes")
+@click.option("--sharded", is_flag=True,
+              help="Share the devices with collectors on other hosts (implied by --workers > 1)")
+@click.option("--worker-id", type=str, default=None, help="Worker id, defaults to hostname-pid")
+@click.option("--adaptive/--fixed", default=None,
+              help="Adapt poll intervals to interface volatility (default: COLLECTOR_ADAPTIVE)")
+@click.option("--min-interval", type=int, default=None, help="Shortest adaptive poll interval in seconds")
+@click.option("--max-interval", type=int, default=None, help="Longest adaptive poll interval in seconds")
+@with_appcontext
+def collector_run_command(concurrency, timeout, interval, workers, sharded, worker_id,
+                          adaptive, min_interval, max_interval):
+    """Poll every device on its own interval until interrupted"""
+    config = current_app.config
+    options = {
+        'concurrency': concurrency or config.get('COLLECTOR_CONCURRENCY', 16),
+        'timeout': timeout or config.get('DEVICE_TIMEOUT', 30),
+        'default_interval': interval or config.get('COLLECTOR_DEFAULT_INTERVAL', 300),
+        'jitter': config.get('COLLECTOR_JITTER', 0.1),
+        'refresh_interval': config.get('COLLECTOR_REFRESH_INTERVAL', 60),
+        'batch_size': config.get('INGEST_BATCH_SIZE', 1000),
+        'max_delay': config.get('INGEST_MAX_DELAY', 5.0),
+        'heartbeat_interval': config.get('COLLECTOR_HEARTBEAT_INTERVAL', 10),
+        'worker_ttl': config.get('COLLECTOR_WORKER_TTL', 30),
+        'metrics_interval': config.get('METRICS_SNAPSHOT_INTERVAL', 10),
+        'prune_interval': config.get('RETENTION_PRUNE_INTERVAL', 3600),
+        'adaptive': adaptive if adaptive is not None else config.get('COLLECTOR_ADAPTIVE', True),
+        'min_interval': min_interval or config.get('COLLECTOR_MIN_INTERVAL', 60),
+        'max_interval': max_interval or config.get('COLLECTOR_MAX_INTERVAL', 900)
+    }
+    
+    if workers > 1:
+        click.echo(f"Starting {workers} sharded collector processes "
+                   f"({options['concurrency']} workers each). Press Ctrl+C to stop.")
+        db.session.remove()
+        run_daemon_processes(workers, dict(options, worker_id=worker_id))
+        click.echo("Collector stopped.")
+        return
+    
+    if sharded or worker_id:
+        options['worker_id'] = worker_id or default_worker_id()
+    daemon = CollectorDaemon(**options)
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    
+    click.echo(f"Starting collector ({daemon.concurrency} workers, "
+               f"default interval {daemon.default_interval}s). Press Ctrl+C to stop.")
+    daemon.run()
+    click.echo("Collector stopped.")
+
+@collector_group.command("replay")
+@with_appcontext
+def collector_replay_command():
+    """Replay spooled samples of collectors that are not running into the database"""
+    if not current_app.config.get('SPOOL_DIR'):
+        click.echo("Spooling is disabled (SPOOL_DIR is empty).")
+        return
+    replayed, left = replay_orphaned_spools(current_app.config.get('INGEST_BATCH_SIZE', 1000))
+    click.echo(f"Replayed {replayed} spooled samples.")
+    if left:
+        click.echo(f"Warning: {left} spools could not be replayed, the database is still unavailable")
+
+@collector_group.command("intervals")
+@click.option("--device-id", type=int, default=None, help="Only show interfaces of this device")
+@with_appcontext
+def collector_intervals_command(device_id):
+    """Show the effective poll interval of every interface"""
+    query = db.session.query(Device.ip, Device.poll_interval, Interface.ifname,
+                             Interface.poll_interval).join(
+        Interface, Interface.device_id == Device.id
+    ).order_by(Device.ip, Interface.ifname)
+    if device_id:
+        query = query.filter(Device.id == device_id)
+    
+    default = current_app.config.get('COLLECTOR_DEFAULT_INTERVAL', 300)
+    for device_ip, device_interval, ifname, poll_interval in query.all():
+        if device_interval:
+            source = "fixed"
+        elif poll_interval:
+            source = "adaptive"
+        else:
+            source = "default"
+        effective = device_interval or poll_interval or default
+        click.echo(f"{device_ip:<16} {ifname:<24} {effective:>6}s  {source}")
+
+@click.group("stats")
+def stats_group():
+    """Maintenance of the bandwidth statistics tables"""
+
+@stats_group.command("explain")
+@click.option("--interface-id", "interface_ids", type=int, multiple=True, default=[1],
+              help="Interface used in the sample queries, repeatable")
+@click.option("--hours", type=int, default=24, help="History window of the sample queries")
+@with_appcontext
+def stats_explain_command(interface_ids, hours):
+    """Check that the bandwidth history reads are served by their interface indexes"""
+    missing = []
+    for index_name, plan, uses_index in explain_history_queries(interface_ids, hours):
+        click.echo(f"{index_name}:")
+        for line in plan:
+            click.echo(f"  {line}")
+        if uses_index is None:
+            click.echo(f"Query plans are not checked on {db.engine.dialect.name}.")
+        elif uses_index:
+            click.echo(f"OK: history queries use {index_name}.")
+        else:
+            missing.append(index_name)
+    if missing:
+        raise click.ClickException(
+            f"History queries do not use {', '.join(missing)}; run 'flask db upgrade'."
+        )
+
+@stats_group.command("rollup")
+@click.option("--rebuild", is_flag=True, help="Recreate all rollups from the archived and raw samples first")
+@with_appcontext
+def stats_rollup_command(rebuild):
+    """Compute the p95 of closed rollup buckets, optionally rebuilding all rollups"""
+    try:
+        if rebuild:
+            samples = rebuild_rollups(db.session)
+            click.echo(f"Rebuilt rollups from {samples} samples.")
+        finalized = finalize_rollups(db.session, limit=None)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise click.ClickException(f"Rollup failed: {e}")
+    click.echo(f"Finalized {finalized} rollup buckets.")
+
+@stats_group.command("top")
+@click.option("--limit", type=int, default=10, help="Number of interfaces to show")
+@click.option("--device-id", type=int, default=None, help="Only interfaces of this device")
+@click.option("--rebuild", is_flag=True, help="Refill the current state from the latest samples first")
+@with_appcontext
+def stats_top_command(limit, device_id, rebuild):
+    """Show the busiest interfaces from interface_current_tbl"""
+    if rebuild:
+        try:
+            interfaces = rebuild_current_state(db.session)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise click.ClickException(f"Rebuild failed: {e}")
+        click.echo(f"Rebuilt the current state of {interfaces} interfaces.")
+    
+    rows = top_interfaces(db.session, limit=limit, device_id=device_id)
+    if not rows:
+        click.echo("No interface utilization recorded yet.")
+        return
+    click.echo(f"{'Device':<16} {'Interface':<24} {'In kbps':>10} {'Out kbps':>10} {'Util':>7}  Last poll")
+    for current, interface, device in rows:
+        click.echo(
+            f"{device.ip:<16} {interface.ifname or '':<24} {current.input_rate_kbps or 0:>10.0f} "
+            f"{current.output_rate_kbps or 0:>10.0f} {current.utilization:>6.1f}%  "
+            f"{current.timestamp:%Y-%m-%d %H:%M:%S}"
+        )
+
+@stats_group.command("prune")
+@click.option("--chunk-size", type=int, default=None, help="Rows deleted per transaction")
+@click.option("--vacuum", "run_vacuum", is_flag=True, help="VACUUM and ANALYZE afterwards to return space to the OS")
+@click.option("--analyze", is_flag=True, help="Refresh planner statistics afterwards")
+@with_appcontext
+def stats_prune_command(chunk_size, run_vacuum, analyze):
+    """Delete samples, rollups and archive blocks older than their RETENTION_* setting"""
+    config = current_app.config
+    size_before = database_size()
+    results = prune(
+        chunk_size=chunk_size or config.get('RETENTION_CHUNK_SIZE', 5000),
+        pause=config.get('RETENTION_CHUNK_PAUSE', 0.05)
+    )
+    if not results:
+        click.echo("Retention is disabled for all tiers.")
+    for name, days, deleted in results:
+        click.echo(f"  {name:<7} older than {days} days: {deleted} rows deleted")
+    click.echo(f"Pruned {sum(deleted for _, _, deleted in results)} rows.")
+    
+    if run_vacuum or analyze:
+        if not vacuum(analyze_only=not run_vacuum):
+            click.echo(f"VACUUM/ANALYZE is not supported on {db.engine.dialect.name}.")
+        elif run_vacuum and size_before is not None:
+            reclaimed = size_before - database_size()
+            click.echo(f"Reclaimed {reclaimed / (1024 * 1024):.1f} MB.")
+        else:
+            click.echo("Statistics refreshed.")
+
+@stats_group.command("archive")
+@click.option("--older-than", "older_than", type=click.IntRange(min=1), default=None,
+              help="Archive samples older than this many whole days (default ARCHIVE_AFTER_DAYS)")
+@with_appcontext
+def stats_archive_command(older_than):
+    """Pack old samples into compressed per-interface day blocks"""
+    if older_than is None:
+        older_than = current_app.config.get('ARCHIVE_AFTER_DAYS', 2)
+    if not older_than:
+        click.echo("Archiving is disabled (ARCHIVE_AFTER_DAYS is 0).")
+        return
+    if get_storage().name != 'sql':
+        click.echo(f"Samples are kept by the {get_storage().name} storage backend; nothing to archive.")
+        return
+    samples, interfaces, written = archive_samples(older_than)
+    click.echo(f"Archived {samples} samples of {interfaces} interfaces into {written} bytes.")
+    if samples:
+        click.echo(f"  {written / samples:.1f} bytes per sample")
+
+@stats_group.command("export")
+@click.option("--format", "fmt", type=click.Choice(list(FORMATS)), default="parquet", help="File format")
+@click.option("--output", type=click.Path(file_okay=False), default="export", help="Directory to write to")
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), default=None, help="First day to export")
+@click.option("--until", type=click.DateTime(formats=["%Y-%m-%d"]), default=None, help="Last day to export")
+@click.option("--device-id", type=int, default=None, help="Only export this device")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=50000, help="Rows per row group / record batch")
+@with_appcontext
+def stats_export_command(fmt, output, since, until, device_id, chunk_size):
+    """Export the samples of the storage backend into day/device partitioned Parquet or Arrow files"""
+    rows, files = export_history(output, fmt, since=since,
+                                 until=until + timedelta(days=1) if until else None,
+                                 device_id=device_id, chunk_size=chunk_size)
+    click.echo(f"Exported {rows} samples into {files} files under {output}.")
+
+@stats_group.command("import")
+@click.argument("path", type=click.Path(exists=True))
+@click.option("--format", "fmt", type=click.Choice(list(FORMATS)), default="parquet", help="File format")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=10000, help="Rows written per transaction")
+@with_appcontext
+def stats_import_command(path, fmt, chunk_size):
+    """Load samples exported with 'stats export' (the export directory or one file)"""
+    try:
+        imported, skipped = import_history(path, fmt, chunk_size=chunk_size)
+        finalized = finalize_rollups(db.session, limit=None)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise click.ClickException(f"Import failed: {e}")
+    click.echo(f"Imported {imported} samples, finalized {finalized} rollup buckets.")
+    if skipped:
+        click.echo(f"Warning: skipped {skipped} samples of interfaces that do not exist here")
+
+@stats_group.command("partitions")
+@click.option("--convert", is_flag=True,
+              help="Move existing samples into partitions (rewrites the PostgreSQL table)")
+@with_appcontext
+def stats_partitions_command(convert):
+    """Create the partitions of the coming period and list all of them"""
+    config = current_app.config
+    days = partition_period(config)
+    if not days:
+        click.echo("Partitioning is disabled (STATS_PARTITION is empty).")
+        return
+    
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.begin() as conn:
+            if not pg_is_partitioned(conn):
+                if not convert:
+                    raise click.ClickException(
+                        "bandwidth_stats_tbl is not partitioned yet; run with --convert "
+                        "(rewrites the table, stop the collectors first)."
+                    )
+                copied = convert_pg_table(conn, days, config.get('STATS_PARTITION_AHEAD', 1))
+                click.echo(f"Partitioned bandwidth_stats_tbl, {copied} samples copied.")
+    elif db.engine.dialect.name == 'sqlite':
+        if convert:
+            moved = migrate_sqlite_rows(config.get('RETENTION_CHUNK_SIZE', 5000))
+            click.echo(f"Moved {moved} samples from the main database into partitions.")
+    else:
+        raise click.ClickException(f"Partitioning is not supported on {db.engine.dialect.name}.")
+    
+    for start, end, name, rows in list_partitions():
+        click.echo(f"  {name:<45} {start:%Y-%m-%d} .. {end:%Y-%m-%d} {rows:>10} rows")
+
+@click.command("metrics")
+@click.option("--local", is_flag=True, help="Only show metrics of this process")
+@with_appcontext
+def metrics_command(local):
+    """Print collector metrics in the Prometheus text format, as served on /metrics"""
+    config = current_app.config
+    directory = None if local else config.get('METRICS_DIR')
+    click.echo(render_all(directory, config.get('METRICS_SNAPSHOT_MAX_AGE', 300)), nl=False)
+
+@click.group("snmpsim")
+def snmpsim_group():
+    """Local SNMP agent simulator for load testing the collector"""
+
+@snmpsim_group.command("run")
+@click.option("--host", default="127.0.0.1", help="Address to listen on")
+@click.option("--port", type=int, default=1161, help="UDP port to listen on")
+@click.option("--processes", type=int, default=1, help="Processes sharing the port")
+@with_appcontext
+def snmpsim_run_command(host, port, processes):
+    """Answer SNMPv2c requests for every SNMP-enabled device in the database"""
+    from app.snmpsim import build_devices, load_inventory, serve_in_processes
+    
+    devices = build_devices(load_inventory())
+    objects = sum(len(device.oids) for device in devices.values())
+    click.echo(f"Simulating {len(devices)} devices ({objects} objects) on udp://{host}:{port} "
+               f"with {processes} process(es). Press Ctrl+C to stop.")
+    click.echo(f"Point the collector at it with SNMP_TARGET_OVERRIDE={host}:{port}")
+    serve_in_processes(devices, host, port, processes)
+    click.echo("Simulator stopped.")
+
 def register_commands(app):
     """Register CLI commands with the Flask application"""
     app.cli.add_command(fake_add_command)
@@ -549,3 +932,7 @@ def register_commands(app):
     app.cli.add_command(collect_stats_command)
     app.cli.add_command(check_devices_command)
     app.cli.add_command(export_config_command)
+    app.cli.add_command(collector_group)
+    app.cli.add_command(snmpsim_group)
+    app.cli.add_command(metrics_command)
+    app.cli.add_command(stats_group)
@@ -0,0 +1,618 @@
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from flask import current_app
+from sqlalchemy import bindparam
+from . import app as flask_app, db
+from .models import Device, Interface, SNMP
+from .adaptive import AdaptivePollPolicy
+from .metrics import (
+    DEVICE_POLL_SECONDS, DEVICE_POLLS, INGEST_BUFFERED_ROWS, COLLECTOR_SCHEDULED_DEVICES,
+    COLLECTOR_RUNNING_POLLS, COLLECTOR_OVERDUE_POLLS, COLLECTOR_COALESCED_POLLS,
+    write_snapshot, remove_snapshot
+)
+from .ingest import create_writer, replay_orphaned_spools
+from .rollups import finalize_rollups
+from .retention import prune
+from .archive import archive_samples
+from .storage import get_storage
+from .partitions import ensure_partitions
+from .scheduler import PollScheduler
+from .sharding import HashRing, WorkerRegistry, default_worker_id
+from .utils import collect_interface_bandwidth_stats, load_poll_targets
+
+log = logging.getLogger(__name__)
+
+# Result states for a single device poll
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+STATUS_ERROR = 'error'
+STATUS_TIMEOUT = 'timeout'
+
+
+def _collect_device(app, device_id, device_ip, started, writer=None, policy=None, target=None, timeout=None):
+    """Collect stats for one device inside its own app context and DB session
+
+    With a ``timeout`` its SNMP requests give up that many seconds after it started.
+    """
+    started[device_id] = time.monotonic()
+    deadline = started[device_id] + timeout if timeout else None
+    result = {
+        'device_id': device_id,
+        'ip': device_ip,
+        'status': STATUS_ERROR,
+        'error': None,
+        'elapsed': 0.0
+    }
+    with app.app_context():
+        try:
+            if collect_interface_bandwidth_stats(device_id, writer=writer, policy=policy, target=target,
+                                                 deadline=deadline):
+                result['status'] = STATUS_OK
+            else:
+                result['status'] = STATUS_FAILED
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            db.session.remove()
+    result['elapsed'] = time.monotonic() - started[device_id]
+    DEVICE_POLL_SECONDS.observe(result['elapsed'], device=device_ip)
+    DEVICE_POLLS.inc(status=result['status'])
+    return result
+
+
+def collect_fleet_bandwidth_stats(devices, concurrency=16, timeout=30, callback=None, writer=None):
+    """Collect bandwidth statistics for many devices using a bounded worker pool
+
+    ``devices`` is a list of ``(device_id, ip)`` tuples. Each device gets its own
+    deadline of ``timeout`` seconds measured from the moment a worker picks it up;
+    devices that miss it are reported as timed out and no longer waited on, so a
+    dead router cannot hold up the rest of the pass. Their SNMP requests are
+    cut to end by the deadline too, so the worker threads, which cannot be
+    interrupted and are joined at exit, finish soon after. ``callback`` is called with
+    every per-device result as soon as it is known. Samples go through
+    ``writer`` when given so the whole pass is inserted in a few batches.
+    """
+    app = current_app._get_current_object()
+    concurrency = max(1, int(concurrency))
+    started = {}
+    results = []
+    start_time = time.monotonic()
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='collector')
+    try:
+        pending = {}
+        for device_id, device_ip in devices:
+            future = executor.submit(_collect_device, app, device_id, device_ip, started, writer, timeout=timeout)
+            pending[future] = (device_id, device_ip)
+
+        while pending:
+            # Wake up either when a device finishes or when the earliest running
+            # device reaches its deadline
+            now = time.monotonic()
+            deadlines = [
+                started[device_id] + timeout
+                for device_id, _ in pending.values() if device_id in started
+            ]
+            wait_for = max(0.0, min(deadlines) - now) if deadlines else timeout
+            done, _ = wait(list(pending), timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                pending.pop(future)
+                result = future.result()
+                results.append(result)
+                if callback:
+                    callback(result)
+
+            now = time.monotonic()
+            for future, (device_id, device_ip) in list(pending.items()):
+                if device_id in started and now - started[device_id] >= timeout:
+                    # The worker thread cannot be interrupted; stop waiting on it
+                    pending.pop(future)
+                    result = {
+                        'device_id': device_id,
+                        'ip': device_ip,
+                        'status': STATUS_TIMEOUT,
+                        'error': f"No response within {timeout} seconds",
+                        'elapsed': now - started[device_id]
+                    }
+                    log.warning("Collection for %s timed out after %ss", device_ip, timeout)
+                    DEVICE_POLLS.inc(status=STATUS_TIMEOUT)
+                    results.append(result)
+                    if callback:
+                        callback(result)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return summarize_results(results, time.monotonic() - start_time)
+
+
+def summarize_results(results, elapsed):
+    """Build a single summary dict from per-device collection results"""
+    summary = {
+        'total': len(results),
+        'success': 0,
+        'failures': 0,
+        'errors': 0,
+        'timeouts': 0,
+        'elapsed': elapsed,
+        'results': results,
+        'slowest': sorted(results, key=lambda r: r['elapsed'], reverse=True)[:5]
+    }
+    for result in results:
+        if result['status'] == STATUS_OK:
+            summary['success'] += 1
+        elif result['status'] == STATUS_FAILED:
+            summary['failures'] += 1
+        elif result['status'] == STATUS_TIMEOUT:
+            summary['timeouts'] += 1
+        else:
+            summary['errors'] += 1
+    return summary
+
+
+def merge_summaries(summaries):
+    """Combine collection summaries of several processes into one"""
+    merged = summarize_results([], 0.0)
+    merged.pop('results')
+    slowest = []
+    for summary in summaries:
+        for key in ('total', 'success', 'failures', 'errors', 'timeouts'):
+            merged[key] += summary[key]
+        merged['elapsed'] = max(merged['elapsed'], summary['elapsed'])
+        slowest.extend(summary['slowest'])
+    merged['slowest'] = sorted(slowest, key=lambda r: r['elapsed'], reverse=True)[:5]
+    return merged
+
+
+def _collect_in_process(devices, concurrency, timeout, batch_size, max_delay):
+    """Entry point of a forked collect-stats process"""
+    with flask_app.app_context():
+        # Never reuse connections inherited from the parent process
+        db.engine.dispose()
+        writer = create_writer(default_worker_id(), batch_size=batch_size, max_delay=max_delay)
+        summary = collect_fleet_bandwidth_stats(
+            devices, concurrency=concurrency, timeout=timeout, writer=writer
+        )
+        writer.close()
+        summary.pop('results')
+        summary['ingest'] = writer.stats()
+        metrics_dir = flask_app.config.get('METRICS_DIR')
+        if metrics_dir:
+            write_snapshot(metrics_dir, default_worker_id('collect-stats'),
+                           max_age=flask_app.config.get('METRICS_SNAPSHOT_MAX_AGE', 300))
+        return summary
+
+
+def collect_fleet_in_processes(device_groups, concurrency=16, timeout=30,
+                               batch_size=1000, max_delay=5.0):
+    """Collect each group of devices in its own process and merge the summaries
+
+    Parsing SNMP responses and building rows is CPU bound, so a single process
+    is limited by the GIL no matter how many threads it runs.
+    """
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes=len(device_groups)) as pool:
+        summaries = pool.starmap(_collect_in_process, [
+            (devices, concurrency, timeout, batch_size, max_delay)
+            for devices in device_groups
+        ])
+    merged = merge_summaries(summaries)
+    merged['ingest'] = {
+        key: sum(summary['ingest'][key] for summary in summaries)
+        for key in ('rows_written', 'rows_dropped', 'rows_spooled', 'rows_replayed',
+                    'batches', 'db_seconds', 'rows_per_sec')
+    }
+    merged['ingest']['db_rows_per_sec'] = sum(
+        summary['ingest']['db_rows_per_sec'] for summary in summaries
+    )
+    return merged
+
+
+class CollectorDaemon:
+    """Long-running collector that polls every device on its own interval
+
+    Devices are dispatched from a PollScheduler into a bounded worker pool. At
+    most ``concurrency`` polls run at once; devices that become due while the
+    pool is full simply wait in the heap, and if they fall a whole interval
+    behind their missed polls are coalesced. The device list is re-read from the
+    database every ``refresh_interval`` seconds, together with the address,
+    SNMP settings and interfaces of every device. Polls use that inventory and
+    the in-memory rate engine only, so while the database is unreachable the
+    daemon keeps polling the devices it knew of and its samples are spooled.
+
+    With a ``worker_id`` the daemon joins the workers registered in
+    collector_workers_tbl and only polls the devices the consistent hash ring
+    assigns to it; membership is checked every ``heartbeat_interval`` seconds so
+    devices of a dead worker are taken over once its heartbeat expires.
+
+    With ``adaptive`` enabled, devices without a fixed poll_interval are polled
+    at the interval an AdaptivePollPolicy picks from their interfaces, between
+    ``min_interval`` and ``max_interval``; the effective interval of every
+    interface is saved to interfaces_tbl on each refresh.
+
+    Every ``prune_interval`` seconds old samples and rollups are pruned in a
+    background thread according to the RETENTION_* settings, after creating
+    the partitions of the coming period when STATS_PARTITION is set and
+    moving samples older than ARCHIVE_AFTER_DAYS into the archive.
+    """
+
+    def __init__(self, concurrency=16, timeout=30, default_interval=300, jitter=0.1,
+                 refresh_interval=60, report_interval=60, batch_size=1000, max_delay=5.0,
+                 worker_id=None, heartbeat_interval=10, worker_ttl=30,
+                 adaptive=True, min_interval=60, max_interval=900, metrics_interval=10,
+                 prune_interval=3600):
+        self.app = current_app._get_current_object()
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.default_interval = default_interval
+        self.refresh_interval = refresh_interval
+        self.report_interval = report_interval
+        self.scheduler = PollScheduler(jitter=jitter)
+        self.writer = create_writer(
+            worker_id or default_worker_id(), batch_size=batch_size, max_delay=max_delay
+        )
+        self.stop_event = threading.Event()
+        self._ips = {}
+        self._targets = {}
+        self._running = {}
+        self._started = {}
+        self._timed_out = set()
+        self.stats = {STATUS_OK: 0, STATUS_FAILED: 0, STATUS_ERROR: 0, STATUS_TIMEOUT: 0}
+        self.worker_id = worker_id
+        self.heartbeat_interval = heartbeat_interval
+        self.registry = WorkerRegistry(worker_id, ttl=worker_ttl) if worker_id else None
+        self.ring = None
+        self.policy = AdaptivePollPolicy(min_interval, max_interval) if adaptive else None
+        self._fixed = set()
+        self.metrics_dir = self.app.config.get('METRICS_DIR')
+        self.metrics_interval = metrics_interval
+        self.metrics_name = worker_id or default_worker_id()
+        self.metrics_max_age = self.app.config.get('METRICS_SNAPSHOT_MAX_AGE', 300)
+        self.prune_interval = prune_interval
+        self._pruner = None
+
+    def stop(self, *args):
+        """Ask the collector to finish running polls and exit"""
+        self.stop_event.set()
+
+    def refresh_devices(self):
+        """Sync the schedule and poll inventory with the devices that have SNMP enabled
+
+        Keeps the current ones and returns None when the database cannot be read.
+        """
+        if self.registry is not None and self.ring is None:
+            # Our share of the devices is unknown until the first heartbeat succeeds
+            return None
+        try:
+            devices = db.session.query(Device.id, Device.ip, Device.poll_interval).join(
+                SNMP, Device.snmp_id == SNMP.id
+            ).filter(SNMP.status == 1).all()
+            targets = load_poll_targets()
+        except Exception as e:
+            db.session.rollback()
+            log.warning("Could not refresh the device list, polling the %d known devices: %s",
+                        len(self.scheduler), getattr(e, 'orig', e))
+            return None
+        finally:
+            db.session.remove()
+
+        if self.ring is not None:
+            devices = [device for device in devices if self.ring.owner(device[0]) == self.worker_id]
+
+        if self.policy is not None:
+            self.save_intervals()
+            self._seed_intervals([
+                device_id for device_id, _, poll_interval in devices
+                if not poll_interval and device_id not in self.scheduler
+            ])
+
+        seen = set()
+        for device_id, device_ip, poll_interval in devices:
+            seen.add(device_id)
+            self._ips[device_id] = device_ip
+            self._targets[device_id] = targets.get(device_id)
+            if poll_interval or self.policy is None:
+                self._fixed.add(device_id)
+                self.scheduler.add(device_id, poll_interval or self.default_interval)
+            else:
+                self._fixed.discard(device_id)
+                self.scheduler.add(
+                    device_id, self.policy.device_interval(device_id, self.default_interval)
+                )
+        for device_id in self.scheduler.device_ids():
+            if device_id not in seen:
+                self.scheduler.remove(device_id)
+                self._ips.pop(device_id, None)
+                self._targets.pop(device_id, None)
+                self._fixed.discard(device_id)
+                if self.policy is not None:
+                    self.policy.forget_device(device_id)
+        return len(seen)
+
+    def _seed_intervals(self, device_ids):
+        """Resume newly scheduled devices at the interface intervals saved last time"""
+        if not device_ids:
+            return
+        wanted = set(device_ids)
+        try:
+            saved = db.session.query(Interface.device_id, Interface.id, Interface.poll_interval).filter(
+                Interface.poll_interval.isnot(None)
+            ).all()
+        except Exception as e:
+            db.session.rollback()
+            log.warning("Could not load saved poll intervals: %s", getattr(e, 'orig', e))
+            return
+        finally:
+            db.session.remove()
+        for device_id, interface_id, poll_interval in saved:
+            if device_id in wanted:
+                self.policy.seed(device_id, interface_id, poll_interval)
+
+    def save_intervals(self):
+        """Store the effective poll interval of interfaces whose interval changed"""
+        changed = self.policy.changed()
+        if not changed:
+            return 0
+        table = Interface.__table__
+        try:
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('interface_id')).values(
+                    poll_interval=bindparam('interval')
+                ),
+                [{'interface_id': interface_id, 'interval': interval}
+                 for interface_id, interval in changed.items()]
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            log.warning("Could not save poll intervals: %s", e)
+        finally:
+            db.session.remove()
+        return len(changed)
+
+    def replay_orphans(self):
+        """Replay spools of collectors that died before their samples reached the database"""
+        if self.writer.db_down():
+            return
+        try:
+            replayed, _ = replay_orphaned_spools(self.writer.batch_size)
+        except Exception as e:
+            log.warning("Could not replay orphaned spools: %s", e)
+            return
+        if replayed:
+            log.info("Replayed %d samples from orphaned spools", replayed)
+
+    def finalize_rollups(self):
+        """Compute the p95 of closed rollup buckets
+
+        With several sharded workers only the first one does it, the buckets
+        cover the devices of all of them.
+        """
+        if self.ring is not None and self.ring.worker_ids[:1] != [self.worker_id]:
+            return
+        try:
+            finalized = finalize_rollups(db.session)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            log.warning("Could not finalize bandwidth rollups: %s", e)
+            return
+        finally:
+            db.session.remove()
+        if finalized:
+            log.debug("Finalized %d bandwidth rollups", finalized)
+
+    def prune_in_background(self):
+        """Start pruning expired rows unless a previous prune is still running
+
+        With several sharded workers only the first one prunes.
+        """
+        if self._pruner is not None and self._pruner.is_alive():
+            return
+        if self.ring is not None and self.ring.worker_ids[:1] != [self.worker_id]:
+            return
+        self._pruner = threading.Thread(target=self._prune, name='collector-prune', daemon=True)
+        self._pruner.start()
+
+    def _prune(self):
+        config = self.app.config
+        with self.app.app_context():
+            try:
+                ensure_partitions()
+                after_days = config.get('ARCHIVE_AFTER_DAYS', 2)
+                # The archive packs rows of bandwidth_stats_tbl, so only the SQL backend has any
+                if after_days and get_storage().name == 'sql':
+                    archive_samples(after_days, stop=self.stop_event.is_set)
+                prune(
+                    chunk_size=config.get('RETENTION_CHUNK_SIZE', 5000),
+                    pause=config.get('RETENTION_CHUNK_PAUSE', 0.05),
+                    stop=self.stop_event.is_set
+                )
+            except Exception as e:
+                log.warning("Could not prune bandwidth statistics: %s", e)
+
+    def heartbeat(self):
+        """Refresh our heartbeat; returns True when the set of live workers changed
+
+        While the database is unreachable the last known ring is kept.
+        """
+        try:
+            live = self.registry.heartbeat()
+        except Exception as e:
+            log.warning("Could not refresh the heartbeat of %s, keeping %d workers: %s", self.worker_id,
+                        len(self.ring.worker_ids) if self.ring is not None else 0, getattr(e, 'orig', e))
+            return False
+        finally:
+            db.session.remove()
+        if self.ring is not None and self.ring.worker_ids == live:
+            return False
+        self.ring = HashRing(live)
+        log.info("Collector %s sharing devices with %d workers", self.worker_id, len(live))
+        return True
+
+    def _dispatch(self, executor):
+        """Submit due devices for as many free worker slots as there are"""
+        free = self.concurrency - len(self._running)
+        for device_id in self.scheduler.pop_due(free):
+            self._started.pop(device_id, None)
+            policy = self.policy if device_id not in self._fixed else None
+            future = executor.submit(
+                _collect_device, self.app, device_id, self._ips.get(device_id),
+                self._started, self.writer, policy, self._targets.get(device_id), self.timeout
+            )
+            self._running[future] = device_id
+
+    def _check_timeouts(self):
+        """Log devices that exceeded their timeout; they keep their slot until they return"""
+        now = time.monotonic()
+        for device_id in self._running.values():
+            started = self._started.get(device_id)
+            if started and device_id not in self._timed_out and now - started >= self.timeout:
+                self._timed_out.add(device_id)
+                DEVICE_POLLS.inc(status=STATUS_TIMEOUT)
+                log.warning("Collection for %s exceeded %ss", self._ips.get(device_id), self.timeout)
+
+    def _finish(self, done):
+        """Record results of finished polls and put their devices back on the schedule"""
+        for future in done:
+            device_id = self._running.pop(future)
+            result = future.result()
+            if device_id in self._timed_out:
+                self._timed_out.discard(device_id)
+                result['status'] = STATUS_TIMEOUT
+            self.stats[result['status']] += 1
+            if result['status'] == STATUS_ERROR:
+                log.warning("Collection for %s failed: %s", result['ip'], result['error'])
+            if self.policy is not None and device_id not in self._fixed:
+                self.scheduler.set_interval(
+                    device_id, self.policy.device_interval(device_id, self.default_interval)
+                )
+            self.scheduler.done(device_id)
+
+    def write_metrics(self):
+        """Update the collector gauges and write the metrics snapshot read by /metrics"""
+        COLLECTOR_SCHEDULED_DEVICES.set(len(self.scheduler))
+        COLLECTOR_RUNNING_POLLS.set(len(self._running))
+        COLLECTOR_OVERDUE_POLLS.set(self.scheduler.overdue())
+        COLLECTOR_COALESCED_POLLS.set(self.scheduler.coalesced)
+        INGEST_BUFFERED_ROWS.set(len(self.writer))
+        if self.metrics_dir:
+            try:
+                write_snapshot(self.metrics_dir, self.metrics_name, max_age=self.metrics_max_age)
+            except OSError as e:
+                log.warning("Could not write metrics snapshot: %s", e)
+
+    def report(self):
+        """Log a one-line summary of the collector state"""
+        ingest = self.writer.stats()
+        log.info(
+            "Collector%s: %d devices, %d running, %d overdue, %d coalesced, "
+            "ok=%d failed=%d errors=%d timeouts=%d, %d rows written (%.0f rows/s), "
+            "%d spooled, %d replayed",
+            f" {self.worker_id}" if self.worker_id else "",
+            len(self.scheduler), len(self._running), self.scheduler.overdue(),
+            self.scheduler.coalesced, self.stats[STATUS_OK], self.stats[STATUS_FAILED],
+            self.stats[STATUS_ERROR], self.stats[STATUS_TIMEOUT],
+            ingest['rows_written'], ingest['db_rows_per_sec'],
+            ingest['rows_spooled'], ingest['rows_replayed']
+        )
+
+    def run(self):
+        """Poll devices until stop() is called"""
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='collector')
+        next_refresh = next_report = next_heartbeat = next_metrics = next_prune = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                now = time.monotonic()
+                if self.registry and now >= next_heartbeat:
+                    if self.heartbeat():
+                        next_refresh = now
+                    next_heartbeat = now + self.heartbeat_interval
+                if now >= next_refresh:
+                    self.refresh_devices()
+                    self.replay_orphans()
+                    self.finalize_rollups()
+                    next_refresh = now + self.refresh_interval
+                if now >= next_report:
+                    self.report()
+                    next_report = now + self.report_interval
+                if now >= next_metrics:
+                    self.write_metrics()
+                    next_metrics = now + self.metrics_interval
+                if self.prune_interval and now >= next_prune:
+                    self.prune_in_background()
+                    next_prune = now + self.prune_interval
+
+                self._dispatch(executor)
+                self._check_timeouts()
+                self.writer.maybe_flush()
+
+                # Sleep until a poll finishes, the next one is due or at most a second
+                next_due = self.scheduler.next_due_in()
+                wait_for = min(1.0, next_refresh - now, next_due if next_due is not None else 1.0)
+                wait_for = max(0.0, wait_for)
+                if self._running:
+                    done, _ = wait(list(self._running), timeout=wait_for, return_when=FIRST_COMPLETED)
+                    self._finish(done)
+                else:
+                    self.stop_event.wait(wait_for)
+
+            # Let running polls finish so their samples are not lost
+            if self._running:
+                done, _ = wait(list(self._running), timeout=self.timeout)
+                self._finish(done)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.writer.close()
+            if self.policy is not None:
+                self.save_intervals()
+            if self.registry:
+                try:
+                    self.registry.leave()
+                except Exception as e:
+                    log.warning("Could not unregister %s, its heartbeat will expire: %s",
+                                self.worker_id, getattr(e, 'orig', e))
+                finally:
+                    db.session.remove()
+            if self.metrics_dir:
+                remove_snapshot(self.metrics_dir, self.metrics_name)
+            self.report()
+
+
+def _run_daemon_in_process(options):
+    """Entry point of a forked collector daemon process"""
+    with flask_app.app_context():
+        db.engine.dispose()
+        daemon = CollectorDaemon(**options)
+        signal.signal(signal.SIGINT, daemon.stop)
+        signal.signal(signal.SIGTERM, daemon.stop)
+        daemon.run()
+
+
+def run_daemon_processes(count, options):
+    """Run ``count`` sharded collector daemons in forked processes until they exit"""
+    context = multiprocessing.get_context('fork')
+    processes = []
+    base_id = options.get('worker_id') or default_worker_id()
+    for index in range(count):
+        worker_options = dict(options, worker_id=f"{base_id}-{index}")
+        processes.append(context.Process(
+            target=_run_daemon_in_process, args=(worker_options,), name=f"collector-{index}"
+        ))
+
+    def stop_children(*args):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGINT, stop_children)
+    signal.signal(signal.SIGTERM, stop_children)
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
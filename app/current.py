@@ -0,0 +1,162 @@
+import logging
+
+from sqlalchemy import func, select
+
+from .models import BandwidthStat, Device, Interface, InterfaceCurrent
+from .rates import COUNTER_FIELDS
+
+log = logging.getLogger(__name__)
+
+SAMPLE_FIELDS = (
+    'timestamp', 'input_rate_kbps', 'output_rate_kbps', 'input_packets', 'output_packets',
+    'input_errors', 'output_errors'
+) + COUNTER_FIELDS + ('counter_bits', 'sys_uptime')
+UTILIZATION_FIELDS = ('speed_kbps', 'input_utilization', 'output_utilization', 'utilization')
+
+
+def _percent(rate_kbps, bandwidth_kbps):
+    if rate_kbps is None or not bandwidth_kbps:
+        return None
+    return 100.0 * rate_kbps / bandwidth_kbps
+
+
+def current_rows(conn, rows):
+    """Reduce sample rows to the newest one per interface and add its utilization
+
+    Utilization is relative to the ``speed_kbps`` the collector read from the
+    device, or Interface.bandwidth for rows without one.
+    """
+    latest = {}
+    for row in rows:
+        seen = latest.get(row['interface_id'])
+        if seen is None or row['timestamp'] >= seen['timestamp']:
+            latest[row['interface_id']] = row
+    if not latest:
+        return []
+
+    interfaces = Interface.__table__
+    unknown = [interface_id for interface_id, row in latest.items() if not row.get('speed_kbps')]
+    bandwidths = dict(conn.execute(
+        select(interfaces.c.id, interfaces.c.bandwidth).where(interfaces.c.id.in_(unknown))
+    ).all()) if unknown else {}
+    result = []
+    for interface_id, row in latest.items():
+        current = {field: row.get(field) for field in SAMPLE_FIELDS}
+        current['interface_id'] = interface_id
+        bandwidth = row.get('speed_kbps') or bandwidths.get(interface_id)
+        current['speed_kbps'] = bandwidth
+        current['input_utilization'] = _percent(row.get('input_rate_kbps'), bandwidth)
+        current['output_utilization'] = _percent(row.get('output_rate_kbps'), bandwidth)
+        directions = [value for value in (current['input_utilization'], current['output_utilization'])
+                      if value is not None]
+        current['utilization'] = max(directions) if directions else None
+        result.append(current)
+    return result
+
+
+def update_current_state(conn, rows):
+    """Upsert the newest of freshly inserted sample rows into interface_current_tbl
+
+    Runs in the transaction that inserted the rows, like update_rollups().
+    Rows older than the stored state (e.g. replayed from a spool) never
+    overwrite it. Returns the number of interfaces touched.
+    """
+    currents = current_rows(conn, rows)
+    if not currents:
+        return 0
+    table = InterfaceCurrent.__table__
+    fields = SAMPLE_FIELDS + UTILIZATION_FIELDS
+    dialect = conn.get_bind().dialect.name if hasattr(conn, 'get_bind') else conn.dialect.name
+
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['interface_id'],
+            set_={field: statement.excluded[field] for field in fields},
+            where=table.c.timestamp <= statement.excluded.timestamp
+        )
+        conn.execute(statement, currents)
+        return len(currents)
+
+    for current in currents:
+        existing = conn.execute(
+            select(table.c.timestamp).where(table.c.interface_id == current['interface_id'])
+        ).first()
+        if existing is None:
+            conn.execute(table.insert(), [current])
+        elif existing.timestamp <= current['timestamp']:
+            conn.execute(table.update().where(
+                table.c.interface_id == current['interface_id']
+            ).values({field: current[field] for field in fields}))
+    return len(currents)
+
+
+def rebuild_current_state(session, chunk_size=1000):
+    """Fill interface_current_tbl from the latest sample of every interface
+
+    Returns the number of interfaces with a sample.
+    """
+    session.query(InterfaceCurrent).delete(synchronize_session=False)
+    stats = BandwidthStat.__table__
+    interface_ids = session.execute(select(Interface.__table__.c.id)).scalars().all()
+    total = 0
+    for start in range(0, len(interface_ids), chunk_size):
+        latest_ids = select(func.max(stats.c.id)).where(
+            stats.c.interface_id.in_(interface_ids[start:start + chunk_size])
+        ).group_by(stats.c.interface_id)
+        rows = session.execute(
+            select(stats.c.interface_id, *[stats.c[field] for field in SAMPLE_FIELDS]).where(
+                stats.c.id.in_(latest_ids)
+            )
+        ).mappings().all()
+        total += update_current_state(session, [dict(row) for row in rows])
+    return total
+
+
+def top_interfaces(session, limit=10, device_id=None):
+    """The busiest interfaces by utilization, as (InterfaceCurrent, Interface, Device) tuples"""
+    query = session.query(InterfaceCurrent, Interface, Device).join(
+        Interface, Interface.id == InterfaceCurrent.interface_id
+    ).join(
+        Device, Device.id == Interface.device_id
+    ).filter(InterfaceCurrent.utilization.isnot(None))
+    if device_id is not None:
+        query = query.filter(Interface.device_id == device_id)
+    return query.order_by(InterfaceCurrent.utilization.desc()).limit(limit).all()
+
+
+def device_utilization(session, device_ids=None):
+    """Per-device summary of the current state: {device_id: (peak utilization, last poll)}"""
+    query = select(
+        Interface.device_id, func.max(InterfaceCurrent.utilization), func.max(InterfaceCurrent.timestamp)
+    ).select_from(InterfaceCurrent.__table__.join(
+        Interface.__table__, Interface.id == InterfaceCurrent.interface_id
+    )).group_by(Interface.device_id)
+    if device_ids is not None:
+        query = query.where(Interface.device_id.in_(device_ids))
+    return {device_id: (utilization, last_poll) for device_id, utilization, last_poll in session.execute(query)}
+
+
+def interface_current_state(session, interface_ids):
+    """{interface_id: InterfaceCurrent} of the given interfaces"""
+    if not interface_ids:
+        return {}
+    return {
+        current.interface_id: current
+        for current in session.query(InterfaceCurrent).filter(InterfaceCurrent.interface_id.in_(interface_ids))
+    }
+
+
+def latest_sample_times(session, interface_ids):
+    """{interface_id: timestamp of its newest sample} of the given interfaces that have one"""
+    if not interface_ids:
+        return {}
+    return dict(session.execute(
+        select(InterfaceCurrent.interface_id, InterfaceCurrent.timestamp).where(
+            InterfaceCurrent.interface_id.in_(interface_ids)
+        )
+    ).all())
@@ -0,0 +1,119 @@
+import numpy as np
+
+METHODS = ('minmax', 'lttb')
+# Series whose shape the reduction preserves; the other columns follow the points picked
+SHAPE_FIELDS = ('input_rate_kbps', 'output_rate_kbps')
+# Rollup points carry the bucket average as the rate; their extremes are in these columns
+ROLLUP_EXTREMES = {
+    'input_rate_kbps': ('input_rate_min', 'input_rate_max'),
+    'output_rate_kbps': ('output_rate_min', 'output_rate_max')
+}
+
+
+def _chunks(count, buckets):
+    """Interior indices 1..count-2 split into ``buckets`` nearly equal chunks, one row each, -1 padded"""
+    edges = np.linspace(1, count - 1, min(buckets, count - 2) + 1).astype(np.int64)
+    indices = edges[:-1, None] + np.arange(np.diff(edges).max())
+    indices[indices >= edges[1:, None]] = -1
+    return indices
+
+
+def minmax_indices(series, max_points):
+    """Indices of the first and last point plus the minimum and maximum of every series per bucket
+
+    Every local extreme of a bucket is kept, so no peak is ever lost;
+    the result has at most ``max_points`` indices. A series may be a
+    ``(minima, maxima)`` pair, whose minimum is taken from the first array
+    and maximum from the second.
+    """
+    series = [values if isinstance(values, tuple) else (values, values) for values in series]
+    count = len(series[0][0])
+    if count <= max_points:
+        return np.arange(count)
+    buckets = (max_points - 2) // (2 * len(series))
+    if buckets < 1:
+        return np.array([0, count - 1])[:max_points]
+    chunks = _chunks(count, buckets)
+    padding = chunks < 0
+    rows = np.arange(len(chunks))
+    keep = [np.array([0, count - 1])]
+    for minima, maxima in series:
+        bucketed = minima[chunks]
+        invalid = padding | np.isnan(bucketed)
+        keep.append(chunks[rows, np.where(invalid, np.inf, bucketed).argmin(axis=1)])
+        bucketed = maxima[chunks]
+        invalid = padding | np.isnan(bucketed)
+        keep.append(chunks[rows, np.where(invalid, -np.inf, bucketed).argmax(axis=1)])
+    keep = np.unique(np.concatenate(keep))
+    return keep[keep >= 0]
+
+
+def lttb_indices(timestamps, series, max_points):
+    """Indices picked by Largest-Triangle-Three-Buckets (Steinarsson, 2013)
+
+    Each bucket keeps the point spanning the largest triangle with the point
+    kept in the previous bucket and the average of the next one, summed over
+    the series after scaling each to its range. The triangles of a bucket
+    are computed at once; only the walk over the buckets is sequential.
+    Keeps the visual shape well, but a single-sample spike next to a larger
+    one may be dropped.
+    """
+    count = len(timestamps)
+    if count <= max_points:
+        return np.arange(count)
+    if max_points < 3:
+        return np.array([0, count - 1])[:max_points]
+    x = (timestamps - timestamps[0]) / 1e6
+    y = np.nan_to_num(np.vstack(series))
+    spread = y.max(axis=1) - y.min(axis=1)
+    y = y / np.where(spread > 0, spread, 1)[:, None]
+
+    chunks = _chunks(count, max_points - 2)
+    valid = chunks >= 0
+    sizes = valid.sum(axis=1)
+    average_x = np.where(valid, x[chunks], 0).sum(axis=1) / sizes
+    average_y = np.where(valid, y[:, chunks], 0).sum(axis=2) / sizes
+
+    keep = np.empty(len(chunks) + 2, dtype=np.int64)
+    keep[0], keep[-1] = 0, count - 1
+    previous = 0
+    for bucket, indices in enumerate(chunks):
+        indices = indices[valid[bucket]]
+        if bucket + 1 < len(chunks):
+            next_x, next_y = average_x[bucket + 1], average_y[:, bucket + 1]
+        else:
+            next_x, next_y = x[-1], y[:, -1]
+        a_x, a_y = x[previous], y[:, previous:previous + 1]
+        areas = np.abs(
+            (a_x - next_x) * (y[:, indices] - a_y) - (a_x - x[indices]) * (next_y[:, None] - a_y)
+        ).sum(axis=0)
+        previous = keep[bucket + 1] = indices[areas.argmax()]
+    return keep
+
+
+def _extremes(columns, field):
+    """``(minima, maxima)`` of a rate on rollup points, else the column itself"""
+    names = ROLLUP_EXTREMES.get(field)
+    if names and all(name in columns for name in names):
+        return tuple(columns[name] for name in names)
+    return columns[field]
+
+
+def downsample(timestamps, columns, max_points, method='minmax', fields=SHAPE_FIELDS):
+    """Reduce history arrays to at most ``max_points`` points picked by the shape of ``fields``
+
+    ``timestamps`` and ``columns`` are shaped as returned by
+    bandwidth_history_arrays(); points are picked, never averaged, so every
+    value returned was measured. On rollup points 'minmax' picks the
+    buckets by their ROLLUP_EXTREMES rather than their averages, so the
+    peaks survive. Returns them unchanged when short enough.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown downsampling method {method!r}; use one of {', '.join(METHODS)}")
+    if max_points is None or len(timestamps) <= max_points:
+        return timestamps, columns
+    if method == 'lttb':
+        keep = lttb_indices(timestamps, [columns[field] for field in fields], max_points)
+    else:
+        keep = minmax_indices([_extremes(columns, field) for field in fields], max_points)
+    return timestamps[keep], {field: values[keep] for field, values in columns.items()}
@@ -0,0 +1,153 @@
+import logging
+import os
+from datetime import datetime, timedelta
+from itertools import groupby, islice
+from operator import itemgetter
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import select
+
+from . import db
+from .models import Interface
+from .archive import VALUE_COLUMNS, day_start
+from .rates import COUNTER_FIELDS
+from .storage import get_storage
+
+log = logging.getLogger(__name__)
+
+# Columns of the exported files; the day and device are the directory names
+EXPORT_COLUMNS = ('interface_id', 'timestamp') + VALUE_COLUMNS + COUNTER_FIELDS + ('counter_bits', 'sys_uptime')
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+
+def export_schema():
+    """Arrow schema of the exported samples; timestamps are naive UTC like in the database"""
+    types = {'interface_id': pa.int32(), 'timestamp': pa.timestamp('us'), 'counter_bits': pa.int8()}
+    types.update((name, pa.float64()) for name in ('input_rate_kbps', 'output_rate_kbps'))
+    return pa.schema([(name, types.get(name, pa.int64())) for name in EXPORT_COLUMNS])
+
+
+def _open_writer(path, fmt, schema):
+    if fmt == 'parquet':
+        return pq.ParquetWriter(path, schema, compression='zstd')
+    return pa.ipc.new_file(path, schema)
+
+
+def _write_file(path, fmt, schema, rows, chunk_size):
+    """Write rows in chunks of ``chunk_size``, one row group / record batch each
+
+    The file is written under a hidden name and renamed when complete, so a
+    re-export replaces it atomically and readers never see half a file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    writer = _open_writer(partial, fmt, schema)
+    rows = iter(rows)
+    written = 0
+    try:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            written += len(chunk)
+    finally:
+        writer.close()
+    os.replace(partial, path)
+    return written
+
+
+def _day_rows(storage, interface_ids, since, until):
+    """Samples of interfaces in [since, until) read through the storage backend, in timestamp order"""
+    rows = []
+    for interface_id in interface_ids:
+        rows.extend(storage.read_range(interface_id, since, until))
+    rows.sort(key=itemgetter('timestamp', 'interface_id'))
+    return rows
+
+
+def export_history(directory, fmt='parquet', since=None, until=None, device_id=None, chunk_size=50000,
+                   storage=None):
+    """Export samples into ``directory``/day=YYYY-MM-DD/device_id=N/samples files, one device at a time
+
+    The samples are read through the storage backend's read_range() one
+    device and day at a time, so every backend exports and memory is bound
+    by the samples of a device per day; on SQL that includes the archive.
+    The layout is a Hive-partitioned dataset pyarrow, Spark and DuckDB read.
+    Samples are exported from ``since`` (by default the backend's oldest)
+    up to but excluding ``until`` (by default now), in row groups of
+    ``chunk_size`` rows. Counters are exported as far as the backend returns
+    them, which the built-in ones do not. Returns ``(rows, files)``.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}; use one of {', '.join(FORMATS)}")
+    storage = storage or get_storage()
+    interfaces = Interface.__table__
+    query = select(interfaces.c.device_id, interfaces.c.id).where(
+        interfaces.c.device_id.isnot(None)
+    ).order_by(interfaces.c.device_id, interfaces.c.id)
+    if device_id is not None:
+        query = query.where(interfaces.c.device_id == device_id)
+    devices = [
+        (device, [row.id for row in rows])
+        for device, rows in groupby(db.session.execute(query).all(), key=lambda row: row.device_id)
+    ]
+    db.session.rollback()
+    if until is None:
+        until = datetime.utcnow()
+
+    schema = export_schema()
+    total = files = 0
+    for device, interface_ids in devices:
+        start = storage.oldest(interface_ids)
+        if start is None:
+            continue
+        if since is not None:
+            start = max(start, since)
+        day = day_start(start)
+        while day < until:
+            next_day = day + timedelta(days=1)
+            rows = _day_rows(storage, interface_ids, max(day, start), min(next_day, until))
+            db.session.rollback()
+            if rows:
+                path = os.path.join(directory, f"day={day:%Y-%m-%d}", f"device_id={device}",
+                                    'samples' + FORMATS[fmt])
+                total += _write_file(path, fmt, schema, rows, chunk_size)
+                files += 1
+            day = next_day
+    log.info("Exported %d bandwidth samples into %d %s files", total, files, fmt)
+    return total, files
+
+
+def import_history(path, fmt='parquet', storage=None, chunk_size=10000):
+    """Load exported samples through the storage backend's batch writer
+
+    ``path`` is an export directory or a single file. Samples of interfaces
+    that do not exist here are skipped; nothing checks for samples that are
+    already stored, so importing the same files twice duplicates them.
+    Returns ``(rows imported, rows skipped)``.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}; use one of {', '.join(FORMATS)}")
+    storage = storage or get_storage()
+    dataset = ds.dataset(path, format='parquet' if fmt == 'parquet' else 'ipc', partitioning='hive')
+    known = set(db.session.execute(select(Interface.__table__.c.id)).scalars())
+    db.session.rollback()
+
+    imported = skipped = 0
+    pending = []
+    # Files of one day and device are small; gather rows across them into full batches
+    for batch in dataset.to_batches(columns=list(EXPORT_COLUMNS), batch_size=chunk_size):
+        rows = [row for row in batch.to_pylist() if row['interface_id'] in known]
+        skipped += batch.num_rows - len(rows)
+        pending.extend(rows)
+        while len(pending) >= chunk_size:
+            imported += storage.write_batch(pending[:chunk_size])
+            del pending[:chunk_size]
+    if pending:
+        imported += storage.write_batch(pending)
+    if skipped:
+        log.warning("Skipped %d imported samples of unknown interfaces", skipped)
+    return imported, skipped
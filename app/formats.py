@@ -0,0 +1,157 @@
+import gzip
+import hashlib
+import struct
+import time
+
+import brotli
+import msgpack
+import numpy as np
+from flask import Response, current_app, request
+
+from . import db
+from .current import latest_sample_times
+from .utils import format_history_timestamps, history_points, history_values
+
+RESPONSE_FORMATS = ('rows', 'columns', 'msgpack', 'binary')
+# Keys of the history fields in the columnar formats
+COLUMN_KEYS = {
+    'input_rate_kbps': 'in', 'output_rate_kbps': 'out',
+    'input_packets': 'in_pkts', 'output_packets': 'out_pkts',
+    'input_errors': 'in_err', 'output_errors': 'out_err',
+    'input_rate_min': 'in_min', 'input_rate_max': 'in_max', 'input_rate_p95': 'in_p95',
+    'output_rate_min': 'out_min', 'output_rate_max': 'out_max', 'output_rate_p95': 'out_p95'
+}
+MAGIC = b'BWH'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<3sBI')  # magic, format version, interface count
+SECTION = struct.Struct('<IIIB')  # interface id, points, resolution (0 for raw samples), column count
+# Largest interface id the uint32 of a SECTION holds
+MAX_INTERFACE_ID = 2 ** 32 - 1
+MIN_COMPRESS_SIZE = 1024
+# Seconds a history ETag stays valid without new samples, while the window slides on
+ETAG_WINDOW = 60
+
+
+def _fields(columns, fields):
+    return [field for field in columns if fields is None or field in fields]
+
+
+def history_columns(micros, columns, resolution, timestamps='iso', fields=None):
+    """History arrays as one list per field under its COLUMN_KEYS key, timestamps under ``t``"""
+    result = {'t': format_history_timestamps(micros, timestamps)}
+    for field in _fields(columns, fields):
+        result[COLUMN_KEYS[field]] = history_values(field, columns[field])
+    if resolution is not None:
+        result['resolution'] = resolution
+    return result
+
+
+def pack_history(history, fields=None):
+    """Pack {interface_id: (timestamps, columns, resolution)} into the binary history format
+
+    All little-endian: HEADER, then per interface a SECTION, the COLUMN_KEYS
+    of its columns as one length byte plus ASCII each, the timestamps as
+    int64 epoch milliseconds and every column as float64 with NaN for NULL.
+    """
+    parts = [HEADER.pack(MAGIC, FORMAT_VERSION, len(history))]
+    for interface_id, (micros, columns, resolution) in history.items():
+        names = _fields(columns, fields)
+        parts.append(SECTION.pack(interface_id, len(micros), resolution or 0, len(names)))
+        for name in names:
+            key = COLUMN_KEYS[name].encode('ascii')
+            parts.append(bytes([len(key)]) + key)
+        parts.append((micros // 1000).astype('<i8').tobytes())
+        parts.extend(columns[name].astype('<f8').tobytes() for name in names)
+    return b''.join(parts)
+
+
+def unpack_history(data):
+    """Read pack_history() output back as {interface_id: (milliseconds, {key: values}, resolution)}"""
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported history data (magic {magic!r}, version {version})")
+    offset = HEADER.size
+    history = {}
+    for _ in range(count):
+        interface_id, points, resolution, column_count = SECTION.unpack_from(data, offset)
+        offset += SECTION.size
+        keys = []
+        for _ in range(column_count):
+            length = data[offset]
+            keys.append(data[offset + 1:offset + 1 + length].decode('ascii'))
+            offset += 1 + length
+        millis = np.frombuffer(data, '<i8', points, offset)
+        offset += points * 8
+        columns = {}
+        for key in keys:
+            columns[key] = np.frombuffer(data, '<f8', points, offset)
+            offset += points * 8
+        history[interface_id] = millis, columns, resolution or None
+    return history
+
+
+def encode_history(history, fmt='rows', timestamps='iso', fields=None, single=False):
+    """Serialize {interface_id: (timestamps, columns, resolution)} as ``(body, mimetype)``
+
+    ``rows`` is the JSON list of point dicts, ``columns`` one JSON list per
+    field, ``msgpack`` the columns as MessagePack with epoch milliseconds
+    and ``binary`` pack_history(). With ``single`` the value of the only
+    interface is returned instead of a mapping by interface id, except
+    for ``binary`` whose sections carry the id.
+    """
+    if fmt == 'binary':
+        return pack_history(history, fields), 'application/octet-stream'
+    if fmt == 'msgpack':
+        timestamps = 'ms'
+    encode = history_points if fmt == 'rows' else history_columns
+    payload = {
+        interface_id: encode(micros, columns, resolution, timestamps, fields)
+        for interface_id, (micros, columns, resolution) in history.items()
+    }
+    if single:
+        payload, = payload.values()
+    if fmt == 'msgpack':
+        return msgpack.packb(payload), 'application/msgpack'
+    return current_app.json.dumps(payload) + '\n', 'application/json'
+
+
+def compressed_response(body, mimetype):
+    """Response of ``body``, brotli or gzip encoded when the client accepts it and it is worth it"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    response = Response(body, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+    accepted = request.accept_encodings
+    if accepted['br']:
+        response.set_data(brotli.compress(body, quality=5))
+        response.content_encoding = 'br'
+        return response
+    if accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.content_encoding = 'gzip'
+    return response
+
+
+def history_etag(interface_ids):
+    """Weak ETag of a history response: its query string and the newest sample of each interface
+
+    Changes with every new sample; without one it still changes every
+    ETAG_WINDOW seconds, so points sliding out of the window are dropped
+    that late at most.
+    """
+    latest = sorted(latest_sample_times(db.session, interface_ids).items())
+    key = repr((sorted(request.args.items(multi=True)), latest, int(time.time() // ETAG_WINDOW)))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def not_modified(etag):
+    """304 response when the client already holds ``etag``, else None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    return response
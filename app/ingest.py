@@ -0,0 +1,257 @@
+import logging
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy.exc import DBAPIError, DisconnectionError, OperationalError
+
+from .storage import get_storage
+from .spool import SegmentRejected, open_spool, orphaned_spools
+from .ringbuffer import open_ring_buffer
+from .metrics import DB_COMMIT_SECONDS, INGEST_BATCH_ROWS, INGEST_ROWS
+
+log = logging.getLogger(__name__)
+
+
+def database_unavailable(error):
+    """Whether a failed write may succeed later: lost connections, locks, timeouts"""
+    if isinstance(error, (OperationalError, DisconnectionError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+class BatchWriter:
+    """Buffers bandwidth samples from many devices and inserts them in batches
+
+    Rows are plain dicts keyed by BandwidthStat column names. They are handed
+    to the storage backend's write_batch() once ``batch_size`` rows are
+    buffered or the oldest buffered row is ``max_delay`` seconds old, so a
+    fleet pass costs a handful of statements instead of one ORM object per
+    interface; the SQL backend inserts with one executemany and updates the
+    rollup tiers and interface_current_tbl in the same transaction. The writer
+    is shared by all collector threads.
+
+    With a ``spool`` (a spool.Spool), batches that fail because the database
+    is unavailable are appended to the spool instead of being dropped. For
+    the next ``retry_interval`` seconds new batches go straight to the spool
+    so a locked or unreachable database does not hold up polling; after that
+    the spooled rows are replayed in bulk and normal inserts resume. Batches
+    rejected for good, e.g. by a foreign key, are logged and dropped, and a
+    spooled segment rejected that way is quarantined.
+
+    With a ``ring`` (a ringbuffer.RingBuffer), committed rows are also
+    appended to it for the recent history reads of the web workers.
+    """
+
+    def __init__(self, batch_size=1000, max_delay=5.0, storage=None, spool=None, retry_interval=30,
+                 ring=None):
+        self.batch_size = max(1, int(batch_size))
+        self.max_delay = max_delay
+        self.storage = storage or get_storage()
+        self._buffer = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._started = time.monotonic()
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.rows_spooled = 0
+        self.rows_replayed = 0
+        self.batches = 0
+        self.db_seconds = 0.0
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.ring = ring
+        self._db_down_until = 0.0
+        # Replay anything a previous run left in the spool on the first flush
+        self._spool_pending = spool is not None and spool.pending()[0] > 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add_many(self, rows):
+        """Buffer rows and flush if the size bound is reached"""
+        if not rows:
+            return
+        with self._lock:
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.extend(rows)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def maybe_flush(self):
+        """Flush if the oldest buffered row has waited longer than max_delay
+
+        Also fsyncs the spool and replays it once the database is back.
+        """
+        with self._lock:
+            due = self._buffer and time.monotonic() - self._oldest >= self.max_delay
+        if due:
+            self.flush()
+        if self.spool is not None:
+            self.spool.maybe_sync()
+            self.replay_spool()
+
+    def flush(self):
+        """Write all buffered rows; returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+                self._oldest = None
+            if not rows:
+                return 0
+
+            written = 0
+            for start in range(0, len(rows), self.batch_size):
+                written += self._write(rows[start:start + self.batch_size])
+            return written
+
+    def db_down(self):
+        """Whether inserts are currently being diverted to the spool"""
+        return time.monotonic() < self._db_down_until
+
+    def _spool_rows(self, rows):
+        """Keep rows in the spool until the database takes them again"""
+        try:
+            self.spool.append(rows)
+        except OSError:
+            self.rows_dropped += len(rows)
+            INGEST_ROWS.inc(len(rows), result='dropped')
+            log.exception("Failed to spool %d bandwidth samples", len(rows))
+            return
+        self.rows_spooled += len(rows)
+        INGEST_ROWS.inc(len(rows), result='spooled')
+        self._spool_pending = True
+
+    def _append_ring(self, rows):
+        """Copy committed rows to the ring buffer; the database stays the source of truth"""
+        if self.ring is None:
+            return
+        try:
+            self.ring.append(rows)
+        except Exception:
+            log.exception("Failed to append %d bandwidth samples to the ring buffer", len(rows))
+
+    def _write(self, rows):
+        """Write one batch through the storage backend"""
+        if self.spool is not None and self.db_down():
+            self._spool_rows(rows)
+            return 0
+        started = time.monotonic()
+        try:
+            self.storage.write_batch(rows)
+        except Exception as e:
+            if self.spool is None or not database_unavailable(e):
+                self.rows_dropped += len(rows)
+                INGEST_ROWS.inc(len(rows), result='dropped')
+                log.exception("Failed to insert %d bandwidth samples", len(rows))
+                return 0
+            log.warning("Database unavailable, spooling samples for %ss: %s",
+                        self.retry_interval, getattr(e, 'orig', e))
+            self._db_down_until = time.monotonic() + self.retry_interval
+            self._spool_rows(rows)
+            return 0
+        self._append_ring(rows)
+        elapsed = time.monotonic() - started
+        self.db_seconds += elapsed
+        self.rows_written += len(rows)
+        self.batches += 1
+        DB_COMMIT_SECONDS.observe(elapsed)
+        INGEST_BATCH_ROWS.observe(len(rows))
+        INGEST_ROWS.inc(len(rows), result='written')
+        return len(rows)
+
+    def _replay_segment(self, rows):
+        """Write the rows of one spool segment in a single batch (one transaction on SQL)
+
+        Returns False while the database is unavailable and raises
+        SegmentRejected when it refuses the rows for another reason.
+        """
+        started = time.monotonic()
+        try:
+            self.storage.write_batch(rows)
+        except Exception as e:
+            if not database_unavailable(e):
+                raise SegmentRejected(getattr(e, 'orig', e)) from e
+            log.warning("Database still unavailable, keeping spooled samples: %s", getattr(e, 'orig', e))
+            self._db_down_until = time.monotonic() + self.retry_interval
+            return False
+        self._append_ring(rows)
+        elapsed = time.monotonic() - started
+        self.db_seconds += elapsed
+        self.batches += 1
+        DB_COMMIT_SECONDS.observe(elapsed)
+        INGEST_BATCH_ROWS.observe(len(rows))
+        return True
+
+    def replay_spool(self):
+        """Move spooled rows into the database; returns the number of rows replayed"""
+        if self.spool is None or not self._spool_pending or self.db_down():
+            return 0
+        with self._flush_lock:
+            replayed = self.spool.replay(self._replay_segment)
+            if not self.db_down():
+                self._spool_pending = False
+        if replayed:
+            self.rows_replayed += replayed
+            INGEST_ROWS.inc(replayed, result='replayed')
+            log.info("Replayed %d spooled bandwidth samples", replayed)
+        return replayed
+
+    def close(self):
+        """Flush whatever is left, replaying the spool if the database is reachable"""
+        written = self.flush()
+        if self.spool is not None:
+            self.replay_spool()
+            self.spool.close()
+        return written
+
+    def stats(self):
+        """Return ingestion counters, including rows/sec inside the DB and overall"""
+        elapsed = time.monotonic() - self._started
+        return {
+            'rows_written': self.rows_written,
+            'rows_dropped': self.rows_dropped,
+            'rows_spooled': self.rows_spooled,
+            'rows_replayed': self.rows_replayed,
+            'rows_buffered': len(self._buffer),
+            'batches': self.batches,
+            'db_seconds': self.db_seconds,
+            'db_rows_per_sec': self.rows_written / self.db_seconds if self.db_seconds else 0.0,
+            'rows_per_sec': self.rows_written / elapsed if elapsed else 0.0
+        }
+
+
+def create_writer(name, batch_size=1000, max_delay=5.0):
+    """Build a BatchWriter that spools to SPOOL_DIR/<name> when spooling is enabled
+
+    Committed rows also go to the RING_BUFFER_PATH ring buffer when it is set.
+    """
+    return BatchWriter(
+        batch_size=batch_size,
+        max_delay=max_delay,
+        spool=open_spool(name),
+        retry_interval=current_app.config.get('SPOOL_RETRY_INTERVAL', 30),
+        ring=open_ring_buffer()
+    )
+
+
+def replay_orphaned_spools(batch_size=1000):
+    """Replay the spools left behind by collectors that are no longer running
+
+    Returns ``(rows_replayed, spools_left)``; a spool is left when the database
+    refused its rows.
+    """
+    root = current_app.config.get('SPOOL_DIR')
+    if not root:
+        return 0, 0
+    replayed = left = 0
+    for spool in orphaned_spools(root):
+        writer = BatchWriter(batch_size=batch_size, spool=spool, ring=open_ring_buffer())
+        replayed += writer.replay_spool()
+        if writer.db_down():
+            left += 1
+        spool.close()
+    return replayed, left
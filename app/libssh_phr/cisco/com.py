@@ -5,6 +5,8 @@ import time
 import sys
 import re
 
+from app.metrics import SSH_COMMAND_SECONDS
+
 class ssh:	
 	
 	priv = False
@@ -12,6 +14,7 @@ class ssh:
 	def __init__(self, host, username, password, enpassword):
 		(ip, port) = host.split(':')
 		
+		self.ip = ip
 		self.enpassword = enpassword
 		self.ssh = paramiko.SSHClient()
 		self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -73,6 +76,7 @@ class ssh:
 		timeo = 60 if timeo == 0 else timeo  
 		interval = 0.01
 		p = re.compile('^'+self.hostname+'.*#', re.M)
+		started = time.time()
 		self.conn.send("%s\n" % cmd)
 
 		output = ''
@@ -88,6 +92,7 @@ class ssh:
 				output += chunk
 			if p.search(output):
 				break
+		SSH_COMMAND_SECONDS.observe(time.time() - started, device=self.ip)
 		return '>' + output[:output.rfind('\n')]
 	
 	def batch_send(self, cmd, timeo=0):
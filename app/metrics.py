@@ -0,0 +1,312 @@
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+# Default latency buckets in seconds, from a fast SNMP reply to a stuck SSH session
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Rows per insert batch
+ROW_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = (
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    """Base class of a metric family with optional labels"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, **extra):
+        labels = dict(zip(self.labelnames, key))
+        labels.update(extra)
+        return labels
+
+    def remove(self, **labels):
+        """Forget one labelled series, e.g. of a device that was deleted"""
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def collect(self):
+        """Return the family as a dict of name, help, type and (name, labels, value) samples"""
+        with self._lock:
+            samples = self._samples()
+        return {'name': self.name, 'help': self.documentation, 'type': self.type, 'samples': samples}
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        return [(self.name + '_total', self._labels(key), value) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """A value that can go up and down"""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        return [(self.name, self._labels(key), value) for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets, with their sum and count"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block"""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket', self._labels(key, le=_format_value(float(bound))),
+                                cumulative))
+            samples.append((self.name + '_sum', self._labels(key), total))
+            samples.append((self.name + '_count', self._labels(key), count))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+        return False
+
+
+class Registry:
+    """Holds the metric families of this process"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def collect(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [metric.collect() for metric in metrics]
+
+
+REGISTRY = Registry()
+
+
+def render(families_by_source):
+    """Render families in the Prometheus text format
+
+    ``families_by_source`` maps a source name to a list of collected families;
+    samples of a named source get a ``worker`` label so the families of several
+    collector processes can be merged into one exposition. Use None as the name
+    of this process.
+    """
+    merged = {}
+    for source, families in families_by_source.items():
+        for family in families:
+            entry = merged.setdefault(family['name'], {
+                'help': family['help'], 'type': family['type'], 'samples': []
+            })
+            for name, labels, value in family['samples']:
+                if source is not None:
+                    labels = dict(labels, worker=source)
+                entry['samples'].append((name, labels, value))
+
+    lines = []
+    for name in sorted(merged):
+        family = merged[name]
+        if not family['samples']:
+            continue
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for sample_name, labels, value in family['samples']:
+            lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_snapshot(directory, name, registry=None, max_age=None):
+    """Atomically write this process' metrics to ``directory``/``name``.json
+
+    With ``max_age``, snapshots of other processes not rewritten for that
+    many seconds (processes that died without removing theirs) are deleted.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.json")
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as snapshot:
+        json.dump((registry or REGISTRY).collect(), snapshot)
+    os.replace(temp_path, path)
+    if max_age is not None:
+        remove_stale_snapshots(directory, max_age)
+    return path
+
+
+def remove_stale_snapshots(directory, max_age=300):
+    """Delete snapshots older than ``max_age`` seconds; returns how many were deleted"""
+    removed = 0
+    now = time.time()
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+def remove_snapshot(directory, name):
+    """Delete the snapshot of a process that is shutting down"""
+    try:
+        os.remove(os.path.join(directory, f"{name}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def read_snapshots(directory, max_age=300):
+    """Return {name: families} of snapshots younger than ``max_age`` seconds; older ones are skipped"""
+    snapshots = {}
+    now = time.time()
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        name = os.path.basename(path)[:-len('.json')]
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                continue
+            with open(path) as snapshot:
+                snapshots[name] = json.load(snapshot)
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def render_all(directory=None, max_age=300, include_local=True):
+    """Render this process' metrics together with the snapshots of collector processes"""
+    sources = {None: REGISTRY.collect()} if include_local else {}
+    if directory:
+        sources.update(read_snapshots(directory, max_age))
+    return render(sources)
+
+
+# Metrics of the collection paths
+SNMP_REQUEST_SECONDS = Histogram(
+    'bwopt_snmp_request_seconds', 'Duration of SNMP requests per device',
+    ['device', 'operation']
+)
+DEVICE_POLL_SECONDS = Histogram(
+    'bwopt_device_poll_seconds', 'Duration of a full bandwidth poll per device', ['device']
+)
+DEVICE_POLLS = Counter(
+    'bwopt_device_polls', 'Device polls by result', ['status']
+)
+PING_SECONDS = Histogram(
+    'bwopt_ping_seconds', 'Duration of ping checks per device', ['device']
+)
+SSH_COMMAND_SECONDS = Histogram(
+    'bwopt_ssh_command_seconds', 'Duration of SSH commands per device', ['device']
+)
+INGEST_BATCH_ROWS = Histogram(
+    'bwopt_ingest_batch_rows', 'Rows per bandwidth sample insert batch', buckets=ROW_BUCKETS
+)
+DB_COMMIT_SECONDS = Histogram(
+    'bwopt_db_commit_seconds', 'Duration of bandwidth sample inserts including the commit'
+)
+INGEST_ROWS = Counter(
+    'bwopt_ingest_rows', 'Bandwidth samples by outcome', ['result']
+)
+INGEST_BUFFERED_ROWS = Gauge(
+    'bwopt_ingest_buffered_rows', 'Bandwidth samples waiting for the next insert batch'
+)
+COLLECTOR_SCHEDULED_DEVICES = Gauge(
+    'bwopt_collector_scheduled_devices', 'Devices scheduled by the collector daemon'
+)
+COLLECTOR_RUNNING_POLLS = Gauge(
+    'bwopt_collector_running_polls', 'Device polls currently running'
+)
+COLLECTOR_OVERDUE_POLLS = Gauge(
+    'bwopt_collector_overdue_polls', 'Devices whose poll is due but waiting for a free worker'
+)
+COLLECTOR_COALESCED_POLLS = Gauge(
+    'bwopt_collector_coalesced_polls', 'Missed polls merged into a later one since start'
+)
+
+# Metrics of the live sample streams of the web workers
+STREAM_CLIENTS = Gauge(
+    'bwopt_stream_clients', 'Clients connected to the live interface sample stream'
+)
+STREAM_SAMPLES = Counter(
+    'bwopt_stream_samples', 'Samples of the live stream by outcome', ['result']
+)
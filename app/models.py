@@ -1,9 +1,11 @@
 from flask_appbuilder import Model
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, Boolean, DateTime, Text, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, Float, Boolean, DateTime, Text, Enum, Index, LargeBinary
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 from flask_appbuilder.models.mixins import AuditMixin
 import enum
-from datetime import datetime
+from datetime import datetime, timedelta
+from . import app
 
 class Connection(Model):
     __tablename__ = 'connections_tbl'
@@ -51,6 +53,7 @@ class Device(Model):
     connection_id = Column(Integer, ForeignKey('connections_tbl.id'))
     snmp_id = Column(Integer, ForeignKey('snmp_tbl.id'))
     icmp_id = Column(Integer, ForeignKey('icmps_tbl.id'))
+    poll_interval = Column(Integer, nullable=True)  # seconds, None = COLLECTOR_DEFAULT_INTERVAL
     interfaces = relationship('Interface', backref='device', lazy='dynamic', 
                             cascade='all, delete-orphan')
     
@@ -69,6 +72,7 @@ class Interface(Model):
     description = Column(String(255), nullable=True)
     bandwidth = Column(Integer, nullable=True)  # in Kbps
     is_active = Column(Boolean, default=True)
+    poll_interval = Column(Integer, nullable=True)  # effective adaptive interval in seconds
     policies = relationship('PolicyApplication', back_populates='interface', lazy='dynamic')
     bandwidth_stats = relationship('BandwidthStat', back_populates='interface', lazy='dynamic')
     
@@ -165,21 +169,168 @@ class PolicyApplication(Model):
         interface_name = self.interface.ifname if self.interface else "Unknown"
         return f"Policy Application: {policy_name} on {interface_name} ({self.direction}, {status})"
 
+# Units STATS_TIMESTAMP_UNIT may store bandwidth_stats_tbl.timestamp in, per second
+EPOCH_UNITS = {'s': 1, 'ms': 1000}
+
+class EpochDateTime(TypeDecorator):
+    """A naive UTC datetime stored as integer epoch seconds or milliseconds
+
+    Datetimes bound to it, e.g. the bounds of range filters, are floored to
+    the unit, so the database compares integers. Ints pass through unchanged.
+    """
+    impl = BigInteger
+    cache_ok = True
+    epoch = datetime(1970, 1, 1)
+
+    def __init__(self, unit='s'):
+        if unit not in EPOCH_UNITS:
+            raise ValueError(f"STATS_TIMESTAMP_UNIT must be one of {', '.join(EPOCH_UNITS)}, got {unit!r}")
+        super().__init__()
+        self.unit = unit
+        self.micros = 1000000 // EPOCH_UNITS[unit]
+
+    def to_epoch(self, value):
+        return (value - self.epoch) // timedelta(microseconds=self.micros)
+
+    def from_epoch(self, value):
+        return self.epoch + timedelta(microseconds=int(value) * self.micros)
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, int):
+            return value
+        return self.to_epoch(value)
+
+    def process_literal_param(self, value, dialect):
+        return str(self.process_bind_param(value, dialect))
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.from_epoch(value)
+
+def stats_timestamp_type(unit=None):
+    """Column type of bandwidth_stats_tbl.timestamp for STATS_TIMESTAMP_UNIT: DateTime or EpochDateTime"""
+    return EpochDateTime(unit) if unit else DateTime()
+
 class BandwidthStat(Model):
     """Bandwidth statistics for interfaces"""
     __tablename__ = 'bandwidth_stats_tbl'
+    __table_args__ = (
+        # History queries filter on one interface and a time range, ordered by time
+        Index('ix_bandwidth_stats_interface_timestamp', 'interface_id', 'timestamp'),
+    )
     id = Column(Integer, primary_key=True)
     interface_id = Column(Integer, ForeignKey('interfaces_tbl.id'))
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(stats_timestamp_type(app.config.get('STATS_TIMESTAMP_UNIT')), default=datetime.utcnow)
     input_rate_kbps = Column(Float)
     output_rate_kbps = Column(Float)
     input_packets = Column(Integer)
     output_packets = Column(Integer)
     input_errors = Column(Integer, default=0)
     output_errors = Column(Integer, default=0)
+    # Raw SNMP counters and device uptime at poll time, used to compute the rates above
+    input_octets_counter = Column(BigInteger, nullable=True)
+    output_octets_counter = Column(BigInteger, nullable=True)
+    input_packets_counter = Column(BigInteger, nullable=True)
+    output_packets_counter = Column(BigInteger, nullable=True)
+    input_errors_counter = Column(BigInteger, nullable=True)
+    output_errors_counter = Column(BigInteger, nullable=True)
+    counter_bits = Column(Integer, nullable=True)  # 32 or 64
+    sys_uptime = Column(BigInteger, nullable=True)  # hundredths of a second
     interface = relationship('Interface', back_populates='bandwidth_stats')
     
     def __repr__(self):
         interface_name = self.interface.ifname if self.interface else "Unknown"
         time_str = self.timestamp.strftime("%Y-%m-%d %H:%M:%S") if self.timestamp else "Unknown"
         return f"Bandwidth Stats for {interface_name} at {time_str} (In: {self.input_rate_kbps} kbps, Out: {self.output_rate_kbps} kbps)"
+
+class BandwidthRollup(Model):
+    """Bandwidth statistics of an interface aggregated over a fixed time bucket"""
+    __tablename__ = 'bandwidth_rollups_tbl'
+    __table_args__ = (
+        Index('ix_bandwidth_rollups_interface_resolution_bucket',
+              'interface_id', 'resolution', 'bucket', unique=True),
+    )
+    id = Column(Integer, primary_key=True)
+    interface_id = Column(Integer, ForeignKey('interfaces_tbl.id'), nullable=False)
+    resolution = Column(Integer, nullable=False)  # bucket length in seconds
+    bucket = Column(DateTime, nullable=False)  # bucket start, UTC
+    samples = Column(Integer, nullable=False, default=0)
+    input_rate_avg = Column(Float)
+    input_rate_min = Column(Float)
+    input_rate_max = Column(Float)
+    input_rate_p95 = Column(Float, nullable=True)  # filled in once the bucket has closed
+    output_rate_avg = Column(Float)
+    output_rate_min = Column(Float)
+    output_rate_max = Column(Float)
+    output_rate_p95 = Column(Float, nullable=True)
+    input_packets = Column(BigInteger, default=0)
+    output_packets = Column(BigInteger, default=0)
+    input_errors = Column(BigInteger, default=0)
+    output_errors = Column(BigInteger, default=0)
+    interface = relationship('Interface')
+
+    def __repr__(self):
+        return f"Bandwidth Rollup ({self.resolution}s) for interface {self.interface_id} at {self.bucket}"
+
+class BandwidthArchiveBlock(Model):
+    """Bandwidth samples of one interface and day packed into a compressed columnar block"""
+    __tablename__ = 'bandwidth_archive_tbl'
+    __table_args__ = (
+        Index('ix_bandwidth_archive_interface_day', 'interface_id', 'day', unique=True),
+    )
+    id = Column(Integer, primary_key=True)
+    interface_id = Column(Integer, ForeignKey('interfaces_tbl.id'), nullable=False)
+    day = Column(DateTime, nullable=False)  # UTC day the samples belong to
+    first_timestamp = Column(DateTime, nullable=False)
+    last_timestamp = Column(DateTime, nullable=False)
+    samples = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)  # see archive.encode_block()
+    interface = relationship('Interface')
+
+    def __repr__(self):
+        return f"Bandwidth Archive for interface {self.interface_id} on {self.day:%Y-%m-%d} ({self.samples} samples)"
+
+class InterfaceCurrent(Model):
+    """Latest sample and utilization of an interface, upserted by the collector on every poll"""
+    __tablename__ = 'interface_current_tbl'
+    __table_args__ = (
+        # Top-N queries order the whole fleet by utilization
+        Index('ix_interface_current_utilization', 'utilization'),
+    )
+    interface_id = Column(Integer, ForeignKey('interfaces_tbl.id'), primary_key=True)
+    timestamp = Column(DateTime, nullable=False)  # last poll
+    input_rate_kbps = Column(Float)
+    output_rate_kbps = Column(Float)
+    input_packets = Column(Integer)
+    output_packets = Column(Integer)
+    input_errors = Column(Integer)
+    output_errors = Column(Integer)
+    input_octets_counter = Column(BigInteger, nullable=True)
+    output_octets_counter = Column(BigInteger, nullable=True)
+    input_packets_counter = Column(BigInteger, nullable=True)
+    output_packets_counter = Column(BigInteger, nullable=True)
+    input_errors_counter = Column(BigInteger, nullable=True)
+    output_errors_counter = Column(BigInteger, nullable=True)
+    counter_bits = Column(Integer, nullable=True)
+    sys_uptime = Column(BigInteger, nullable=True)
+    speed_kbps = Column(Integer, nullable=True)  # from the device, else Interface.bandwidth
+    # Percent of speed_kbps; utilization is the busier direction
+    input_utilization = Column(Float, nullable=True)
+    output_utilization = Column(Float, nullable=True)
+    utilization = Column(Float, nullable=True)
+    interface = relationship('Interface')
+
+    def __repr__(self):
+        return f"Current state of interface {self.interface_id} at {self.timestamp} ({self.utilization}%)"
+
+class CollectorWorker(Model):
+    """Collector processes sharing the polling work, kept alive by heartbeats"""
+    __tablename__ = 'collector_workers_tbl'
+    id = Column(Integer, primary_key=True)
+    worker_id = Column(String(255), unique=True)
+    hostname = Column(String(255))
+    pid = Column(Integer)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    heartbeat_at = Column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"Collector Worker {self.worker_id} on {self.hostname}"
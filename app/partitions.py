@@ -0,0 +1,522 @@
+import logging
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import Column, Index, Integer, MetaData, Table, event, func, select, text
+from sqlalchemy.dialects import sqlite as sqlite_dialect
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from . import db
+from .models import BandwidthStat, EpochDateTime
+
+log = logging.getLogger(__name__)
+
+PERIOD_DAYS = {'day': 1, 'week': 7}
+TABLE = BandwidthStat.__tablename__
+# SQLite partition files are named after the range they hold
+FILE_PATTERN = re.compile(r'^' + TABLE + r'_(\d{8})_(\d{8})\.db$')
+DEFAULT_FILE = f"{TABLE}_default.db"
+SCHEMA_PATTERN = re.compile(r'^p(\d{8}|default)$')
+# Compiled-in default of SQLITE_MAX_ATTACHED, one of which is the default partition
+SQLITE_MAX_ATTACHED = 10
+# Ids of a SQLite partition start at its first day (since 1970) times this, so
+# they keep growing across partitions; the default partition counts from below
+# the first of them so its stray rows never look like the latest sample
+SQLITE_ID_STRIDE = 10 ** 9
+SQLITE_DEFAULT_ID_BASE = 10 ** 12
+PG_BOUND_PATTERN = re.compile(r"FROM \('?([^')]+)'?\) TO \('?([^')]+)'?\)")
+
+
+def partition_period(config=None):
+    """Length of a partition in days, or None when STATS_PARTITION is off"""
+    config = config if config is not None else current_app.config
+    period = (config.get('STATS_PARTITION') or '').lower()
+    if period and period not in PERIOD_DAYS:
+        raise ValueError(f"STATS_PARTITION must be one of {', '.join(PERIOD_DAYS)}, got {period!r}")
+    return PERIOD_DAYS.get(period)
+
+
+def sqlite_partitions_needed(days, retention_days, ahead=1):
+    """Most SQLite partitions holding unexpired samples at once, or None when they never expire
+
+    That is every period reaching back ``retention_days`` plus the current
+    period and the ``ahead`` next ones.
+    """
+    if not retention_days:
+        return None
+    return -(-retention_days // days) + ahead + 1
+
+
+def check_sqlite_partition_limit(config):
+    """Raise ValueError unless the SQLite partitions of the retention fit in one connection
+
+    Each partition is an attached database, and _attach_sqlite_partitions()
+    would have to hide the oldest of them beyond SQLITE_MAX_ATTACHED.
+    """
+    days = partition_period(config)
+    retention_days = config.get('RETENTION_RAW_DAYS', 7)
+    ahead = config.get('STATS_PARTITION_AHEAD', 1)
+    needed = sqlite_partitions_needed(days, retention_days, ahead)
+    limit = SQLITE_MAX_ATTACHED - 1
+    if needed is None:
+        raise ValueError("STATS_PARTITION on SQLite needs RETENTION_RAW_DAYS above 0, "
+                         f"as SQLite attaches at most {limit} partitions")
+    if needed > limit:
+        raise ValueError(
+            f"STATS_PARTITION={config.get('STATS_PARTITION')} with RETENTION_RAW_DAYS={retention_days} "
+            f"and STATS_PARTITION_AHEAD={ahead} keeps up to {needed} partitions, but SQLite attaches "
+            f"at most {limit}; use STATS_PARTITION=week or a shorter retention"
+        )
+
+
+def period_start(timestamp, days):
+    """Start of the partition period a timestamp falls into; weeks start on Monday"""
+    start = datetime(timestamp.year, timestamp.month, timestamp.day)
+    if days == 7:
+        start -= timedelta(days=start.weekday())
+    return start
+
+
+def missing_ranges(existing, now, days, ahead=1):
+    """Ranges to create so the current and ``ahead`` next periods are covered
+
+    ``existing`` is a list of (start, end). Periods partly covered by existing
+    partitions, e.g. after switching from days to weeks, only get their
+    uncovered tail.
+    """
+    ranges = []
+    start = period_start(now, days)
+    for _ in range(ahead + 1):
+        end = start + timedelta(days=days)
+        begin = start
+        for other_start, other_end in existing:
+            if other_start < end and other_end > begin:
+                begin = max(begin, other_end)
+        if begin < end:
+            ranges.append((begin, end))
+        start = end
+    return ranges
+
+
+def _unpartitioned_table(name, schema=None):
+    """Minimal Table of rows outside any partition, as used by retention.prune_table()"""
+    return Table(name, MetaData(), Column('id', Integer, primary_key=True),
+                 Column('timestamp', BandwidthStat.__table__.c.timestamp.type), schema=schema)
+
+
+def stored_timestamp(value):
+    """A datetime as bandwidth_stats_tbl.timestamp stores it, for SQL its column type does not bind"""
+    column_type = BandwidthStat.__table__.c.timestamp.type
+    return column_type.to_epoch(value) if isinstance(column_type, EpochDateTime) else value
+
+
+def loaded_timestamp(value):
+    """A bandwidth_stats_tbl.timestamp read by plain SQL as a datetime"""
+    column_type = BandwidthStat.__table__.c.timestamp.type
+    if isinstance(column_type, EpochDateTime) and value is not None:
+        return column_type.from_epoch(value)
+    return value
+
+
+def unpartitioned_stats_tables(config=None):
+    """Tables holding the samples that do not expire with a whole partition
+
+    That is the main SQLite table (rows from before partitioning) and the
+    default partition of rows outside every period, the PostgreSQL default
+    partition, or the whole table when partitioning is off.
+    """
+    if not partition_period(config):
+        return [BandwidthStat.__table__]
+    if db.engine.dialect.name == 'sqlite':
+        return [_unpartitioned_table(TABLE, schema='main'),
+                _unpartitioned_table(f"{TABLE}_default", schema='pdefault')]
+    return [_unpartitioned_table(f"{TABLE}_default")]
+
+
+# SQLite: one attached database per period behind a temporary view
+
+def _sqlite_partition_table(name):
+    """BandwidthStat table without foreign keys, which cannot cross databases
+
+    Every partition names its table differently because trigger bodies may
+    not qualify table names with a schema.
+    """
+    source = BandwidthStat.__table__
+    table = Table(name, MetaData(), *[
+        Column(column.name, column.type, primary_key=column.primary_key) for column in source.columns
+    ], sqlite_autoincrement=True)
+    for index in source.indexes:
+        Index(index.name, *[table.c[column.name] for column in index.columns])
+    return table
+
+
+def sqlite_partitions(directory):
+    """Return [(start, end, path)] of the partition files in ``directory``, oldest first"""
+    partitions = []
+    if not os.path.isdir(directory):
+        return partitions
+    for name in os.listdir(directory):
+        match = FILE_PATTERN.match(name)
+        if match:
+            partitions.append((datetime.strptime(match.group(1), '%Y%m%d'),
+                               datetime.strptime(match.group(2), '%Y%m%d'),
+                               os.path.join(directory, name)))
+    return sorted(partitions)
+
+
+def _create_sqlite_file(path, table_name, first_id):
+    """Create a partition database holding one empty table, unless it exists already"""
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Build it under a temporary name so no one attaches a file without its table
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    table = _sqlite_partition_table(table_name)
+    dialect = sqlite_dialect.dialect()
+    connection = sqlite3.connect(temp_path)
+    try:
+        with connection:
+            connection.execute(str(CreateTable(table).compile(dialect=dialect)))
+            for index in table.indexes:
+                connection.execute(str(CreateIndex(index).compile(dialect=dialect)))
+            connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)",
+                               (table_name, first_id))
+    finally:
+        connection.close()
+    try:
+        os.link(temp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(temp_path)
+    return path
+
+
+def create_sqlite_partition(directory, start, end):
+    """Create the partition file of [start, end) unless another process beat us to it"""
+    first_day = (start - datetime(1970, 1, 1)).days
+    return _create_sqlite_file(
+        os.path.join(directory, f"{TABLE}_{start:%Y%m%d}_{end:%Y%m%d}.db"),
+        f"{TABLE}_p{start:%Y%m%d}", first_day * SQLITE_ID_STRIDE
+    )
+
+
+def ensure_sqlite_partitions(directory, days, ahead=1, now=None, oldest=None):
+    """Create missing partitions of the current and next periods; returns all partitions
+
+    With ``oldest``, the periods back to that timestamp are created as well.
+    The default partition is created too but not returned.
+    """
+    _create_sqlite_file(os.path.join(directory, DEFAULT_FILE), f"{TABLE}_default", SQLITE_DEFAULT_ID_BASE)
+    partitions = sqlite_partitions(directory)
+    now = now or datetime.utcnow()
+    missing = []
+    moment = oldest or now
+    while True:
+        # Back-filling walks one period at a time up to now, then looks ahead
+        missing += missing_ranges([(start, end) for start, end, _ in partitions] + missing,
+                                  moment, days, ahead if moment >= period_start(now, days) else 0)
+        if moment >= period_start(now, days):
+            break
+        moment = period_start(moment, days) + timedelta(days=days)
+    for start, end in missing:
+        create_sqlite_partition(directory, start, end)
+        log.info("Created bandwidth stats partition %s..%s", start.date(), end.date())
+    return sqlite_partitions(directory) if missing else partitions
+
+
+def _sqlite_bound(value):
+    """A datetime as an SQL literal of the text format SQLAlchemy stores in SQLite, or of its epoch"""
+    stored = stored_timestamp(value)
+    if isinstance(stored, int):
+        return str(stored)
+    return value.strftime("'%Y-%m-%d %H:%M:%S.%f'")
+
+
+def _attach_sqlite_partitions(dbapi_connection, directory, partitions):
+    """Attach partition files and route ``bandwidth_stats_tbl`` through a temporary view
+
+    Temporary objects shadow the main table, so every query and insert on the
+    table transparently goes to the view: reads see the main table, the
+    partitions and the default partition, and an INSTEAD OF trigger sends each
+    inserted row to the partition of its timestamp, or to the default
+    partition when there is none. Rows left in the main table are read-only
+    until they expire or are moved with migrate_sqlite_rows().
+    """
+    if len(partitions) > SQLITE_MAX_ATTACHED - 1:
+        # check_sqlite_partition_limit() leaves only expired ones over the limit
+        log.warning("%d bandwidth stats partitions but SQLite attaches at most %d; "
+                    "the oldest are hidden until they are pruned", len(partitions), SQLITE_MAX_ATTACHED - 1)
+        partitions = partitions[-(SQLITE_MAX_ATTACHED - 1):]
+    wanted = {f"p{start:%Y%m%d}": (start, end, path) for start, end, path in partitions}
+    wanted_paths = dict({schema: path for schema, (_, _, path) in wanted.items()},
+                        pdefault=os.path.join(directory, DEFAULT_FILE))
+    tables = dict({schema: f"{TABLE}_{schema}" for schema in wanted}, pdefault=f"{TABLE}_default")
+    columns = [column.name for column in BandwidthStat.__table__.columns]
+    column_list = ', '.join(f'"{name}"' for name in columns)
+    new_values = ', '.join(f'NEW."{name}"' for name in columns)
+
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"DROP VIEW IF EXISTS temp.{TABLE}")
+        # The view hides the main table from create_all(), so make sure it exists
+        dialect = sqlite_dialect.dialect()
+        cursor.execute(str(CreateTable(BandwidthStat.__table__, if_not_exists=True).compile(dialect=dialect)))
+        for index in BandwidthStat.__table__.indexes:
+            cursor.execute(str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect)))
+        attached = {row[1] for row in cursor.execute("PRAGMA database_list").fetchall()}
+        for schema in attached:
+            if SCHEMA_PATTERN.match(schema) and schema not in wanted_paths:
+                cursor.execute(f'DETACH DATABASE "{schema}"')
+        for schema, path in wanted_paths.items():
+            if schema not in attached:
+                cursor.execute(f'ATTACH DATABASE ? AS "{schema}"', (path,))
+
+        selects = [f"SELECT {column_list} FROM main.{TABLE}"] + [
+            f'SELECT {column_list} FROM "{schema}".{tables[schema]}' for schema in wanted_paths
+        ]
+        cursor.execute(f"CREATE TEMP VIEW {TABLE} AS " + " UNION ALL ".join(selects))
+
+        routes = []
+        ranges = []
+        for schema, (start, end, _) in wanted.items():
+            in_range = f'NEW."timestamp" >= {_sqlite_bound(start)} AND NEW."timestamp" < {_sqlite_bound(end)}'
+            ranges.append(f"({in_range})")
+            routes.append(f'INSERT INTO {tables[schema]} ({column_list}) SELECT {new_values} WHERE {in_range};')
+        outside = f'NOT ({" OR ".join(ranges)})' if ranges else '1'
+        routes.append(
+            f'INSERT INTO {TABLE}_default ({column_list}) SELECT {new_values} '
+            f'WHERE NEW."timestamp" IS NULL OR {outside};'
+        )
+        cursor.execute(f"CREATE TEMP TRIGGER {TABLE}_insert INSTEAD OF INSERT ON {TABLE} "
+                       f"BEGIN {' '.join(routes)} END")
+
+        deletes = [f'DELETE FROM {table} WHERE id = OLD.id;' for table in tables.values()]
+        cursor.execute(f"CREATE TEMP TRIGGER {TABLE}_delete INSTEAD OF DELETE ON {TABLE} "
+                       f"BEGIN {' '.join(deletes)} END")
+    finally:
+        cursor.close()
+
+
+def migrate_sqlite_rows(chunk_size=5000):
+    """Move the samples of the main SQLite table into their partitions; returns the rows moved
+
+    Partitions are created back to the oldest sample. Ids are kept so the
+    latest sample of an interface is still the one with the highest id.
+    """
+    config = current_app.config
+    days = partition_period(config)
+    main = _unpartitioned_table(TABLE, schema='main')
+    with db.engine.connect() as conn:
+        oldest = conn.execute(select(func.min(main.c.timestamp))).scalar()
+    if oldest is None:
+        return 0
+    ensure_sqlite_partitions(config.get('STATS_PARTITION_DIR'), days,
+                             config.get('STATS_PARTITION_AHEAD', 1), oldest=oldest)
+
+    column_list = ', '.join(f'"{column.name}"' for column in BandwidthStat.__table__.columns)
+    moved = 0
+    while True:
+        # A fresh checkout attaches the partitions just created
+        with db.engine.begin() as conn:
+            last_id = conn.execute(text(
+                f"SELECT max(id) FROM (SELECT id FROM main.{TABLE} ORDER BY id LIMIT :limit)"
+            ), {'limit': chunk_size}).scalar()
+            if last_id is None:
+                break
+            conn.execute(text(
+                f"INSERT INTO {TABLE} ({column_list}) SELECT {column_list} FROM main.{TABLE} WHERE id <= :last_id"
+            ), {'last_id': last_id})
+            moved += conn.execute(text(f"DELETE FROM main.{TABLE} WHERE id <= :last_id"),
+                                  {'last_id': last_id}).rowcount
+    return moved
+
+
+def init_partitioning(app):
+    """Route bandwidth statistics to per-period SQLite databases when STATS_PARTITION is set
+
+    Partitions are created and attached when a connection is checked out of
+    the pool, so long-lived connections pick up new periods and drop pruned
+    ones. PostgreSQL partitions natively and needs no hook here.
+    """
+    days = partition_period(app.config)
+    if not days:
+        return
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+    check_sqlite_partition_limit(app.config)
+    directory = app.config.get('STATS_PARTITION_DIR')
+    ahead = app.config.get('STATS_PARTITION_AHEAD', 1)
+
+    @event.listens_for(engine, "checkout")
+    def attach_partitions(dbapi_connection, connection_record, connection_proxy):
+        partitions = ensure_sqlite_partitions(directory, days, ahead)
+        key = tuple(path for _, _, path in partitions)
+        if connection_record.info.get('stats_partitions') != key:
+            _attach_sqlite_partitions(dbapi_connection, directory, partitions)
+            connection_record.info['stats_partitions'] = key
+
+
+# PostgreSQL: declarative range partitioning of bandwidth_stats_tbl
+
+def pg_is_partitioned(conn):
+    return conn.execute(
+        text("SELECT relkind FROM pg_class WHERE relname = :name AND relkind IN ('r', 'p')"),
+        {'name': TABLE}
+    ).scalar() == 'p'
+
+
+def pg_partitions(conn):
+    """Return [(start, end, name)] of the range partitions, oldest first"""
+    rows = conn.execute(text(
+        "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+        "FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :name"
+    ), {'name': TABLE}).all()
+    partitions = []
+    for name, bound in rows:
+        match = PG_BOUND_PATTERN.search(bound or '')
+        if match:
+            partitions.append((_pg_bound_value(match.group(1)), _pg_bound_value(match.group(2)), name))
+    return sorted(partitions)
+
+
+def _pg_bound(value):
+    """A datetime as the SQL literal of a partition bound"""
+    stored = stored_timestamp(value)
+    return str(stored) if isinstance(stored, int) else f"'{value.isoformat(' ')}'"
+
+
+def _pg_bound_value(bound):
+    """A partition bound as pg_get_expr() renders it, back as a datetime"""
+    if bound.lstrip('-').isdigit():
+        return loaded_timestamp(int(bound))
+    return datetime.fromisoformat(bound)
+
+
+def create_pg_partition(conn, start, end):
+    """Create the partition of [start, end), moving its rows out of the default partition"""
+    name = f"{TABLE}_p{start:%Y%m%d}"
+    bounds = {'start': stored_timestamp(start), 'end': stored_timestamp(end)}
+    conn.execute(text(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+    conn.execute(text(
+        f'WITH moved AS (DELETE FROM {TABLE}_default WHERE "timestamp" >= :start AND "timestamp" < :end '
+        f'RETURNING *) INSERT INTO {name} SELECT * FROM moved'
+    ), bounds)
+    conn.execute(text(
+        f"ALTER TABLE {TABLE} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ({_pg_bound(start)}) TO ({_pg_bound(end)})"
+    ))
+    return name
+
+
+def ensure_pg_partitions(conn, days, ahead=1, now=None):
+    """Create missing partitions of the current and next periods; returns all partitions"""
+    partitions = pg_partitions(conn)
+    missing = missing_ranges([(start, end) for start, end, _ in partitions],
+                             now or datetime.utcnow(), days, ahead)
+    for start, end in missing:
+        create_pg_partition(conn, start, end)
+        log.info("Created bandwidth stats partition %s..%s", start.date(), end.date())
+    return pg_partitions(conn) if missing else partitions
+
+
+def convert_pg_table(conn, days, ahead=1):
+    """Turn a plain bandwidth_stats_tbl into a partitioned one, copying its rows
+
+    Partitions are created for every period holding samples; the primary key
+    becomes (id, timestamp) because PostgreSQL requires the partition key in it.
+    Runs in the caller's transaction and rewrites the whole table.
+    """
+    legacy = f"{TABLE}_unpartitioned"
+    index = 'ix_bandwidth_stats_interface_timestamp'
+    conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {legacy}"))
+    conn.execute(text(f"ALTER INDEX IF EXISTS {index} RENAME TO {index}_unpartitioned"))
+    conn.execute(text(
+        f'CREATE TABLE {TABLE} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ("timestamp")'
+    ))
+    conn.execute(text(f'ALTER TABLE {TABLE} ADD PRIMARY KEY (id, "timestamp")'))
+    conn.execute(text(f"ALTER TABLE {TABLE} ADD FOREIGN KEY (interface_id) REFERENCES interfaces_tbl (id)"))
+    conn.execute(text(f'CREATE INDEX {index} ON {TABLE} (interface_id, "timestamp")'))
+    conn.execute(text(f"ALTER SEQUENCE IF EXISTS {TABLE}_id_seq OWNED BY {TABLE}.id"))
+    conn.execute(text(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT"))
+
+    oldest = loaded_timestamp(conn.execute(text(f'SELECT min("timestamp") FROM {legacy}')).scalar())
+    now = datetime.utcnow()
+    start = period_start(oldest or now, days)
+    while start <= now:
+        create_pg_partition(conn, start, start + timedelta(days=days))
+        start += timedelta(days=days)
+    ensure_pg_partitions(conn, days, ahead, now)
+    copied = conn.execute(text(f"INSERT INTO {TABLE} SELECT * FROM {legacy}")).rowcount
+    conn.execute(text(f"DROP TABLE {legacy}"))
+    return copied
+
+
+# Both databases
+
+def _count_rows(name):
+    """Rows in a partition, given its table name on PostgreSQL or file name on SQLite"""
+    if db.engine.dialect.name != 'sqlite':
+        with db.engine.connect() as conn:
+            return conn.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+    match = FILE_PATTERN.match(name)
+    connection = sqlite3.connect(os.path.join(current_app.config.get('STATS_PARTITION_DIR'), name))
+    try:
+        return connection.execute(f"SELECT count(*) FROM {TABLE}_p{match.group(1)}").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def list_partitions(count_rows=True):
+    """Return [(start, end, name, rows)] after creating partitions that are due
+
+    ``rows`` is None unless ``count_rows`` is set. Empty when partitioning is
+    off or the PostgreSQL table is not partitioned yet.
+    """
+    config = current_app.config
+    days = partition_period(config)
+    if not days:
+        return []
+    ahead = config.get('STATS_PARTITION_AHEAD', 1)
+    if db.engine.dialect.name == 'sqlite':
+        partitions = [
+            (start, end, os.path.basename(path))
+            for start, end, path in ensure_sqlite_partitions(config.get('STATS_PARTITION_DIR'), days, ahead)
+        ]
+    else:
+        with db.engine.begin() as conn:
+            if not pg_is_partitioned(conn):
+                return []
+            partitions = ensure_pg_partitions(conn, days, ahead)
+    return [(start, end, name, _count_rows(name) if count_rows else None)
+            for start, end, name in partitions]
+
+
+def ensure_partitions():
+    """Create the partitions of the current and next periods; returns how many exist"""
+    return len(list_partitions(count_rows=False))
+
+
+def drop_expired_partitions(cutoff):
+    """Drop partitions that end before ``cutoff``; returns the number of rows they held"""
+    dropped = 0
+    for start, end, name, _ in list_partitions(count_rows=False):
+        if end > cutoff:
+            continue
+        rows = _count_rows(name)
+        if db.engine.dialect.name == 'sqlite':
+            os.remove(os.path.join(current_app.config.get('STATS_PARTITION_DIR'), name))
+        else:
+            with db.engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE {name}"))
+        log.info("Dropped bandwidth stats partition %s..%s (%d rows)", start.date(), end.date(), rows)
+        dropped += rows
+    return dropped
@@ -0,0 +1,153 @@
+import threading
+
+# Counters kept per interface and the width of the SNMP counter behind each one
+COUNTER_FIELDS = (
+    'input_octets_counter', 'output_octets_counter',
+    'input_packets_counter', 'output_packets_counter',
+    'input_errors_counter', 'output_errors_counter'
+)
+
+# sysUpTime is a 32 bit TimeTicks value in hundredths of a second
+UPTIME_BITS = 32
+
+# A measured rate above this multiple of the interface speed means the counters
+# were reset rather than wrapped
+MAX_SPEED_RATIO = 1.5
+
+# Samples further apart than this are too coarse for a meaningful rate
+MAX_INTERVAL_SECONDS = 3600
+
+
+def counter_delta(previous, current, bits):
+    """Return the increase of a counter between two polls, or None on a reset
+
+    A counter that went down is treated as having wrapped exactly once when the
+    wrapped distance is less than half the counter range; anything else (clear
+    counters, a replaced line card) is a discontinuity and yields None.
+    """
+    if previous is None or current is None:
+        return None
+    if current >= previous:
+        return current - previous
+    wrapped = (1 << bits) - previous + current
+    if wrapped < (1 << (bits - 1)):
+        return wrapped
+    return None
+
+
+class CounterSample:
+    """Raw counters of one interface at one poll"""
+
+    __slots__ = ('timestamp', 'sys_uptime', 'counters', 'bits')
+
+    def __init__(self, timestamp, sys_uptime, counters, bits=64):
+        self.timestamp = timestamp
+        self.sys_uptime = sys_uptime
+        self.counters = counters
+        self.bits = bits
+
+
+class RateEngine:
+    """Turns raw interface counters into rates using the previous sample in memory
+
+    Only the last sample of each interface is kept, so memory stays at one small
+    object per interface and no database read-back is needed between polls. An
+    interface with no previous sample (first poll, device reboot, counter reset)
+    is primed and produces no rates until its next poll.
+    """
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def has_sample(self, interface_id):
+        """Return True if a previous sample is known for the interface"""
+        return interface_id in self._samples
+
+    def seed(self, interface_id, sample):
+        """Store a previous sample without computing rates, e.g. loaded from the DB"""
+        with self._lock:
+            self._samples.setdefault(interface_id, sample)
+
+    def forget(self, interface_id):
+        """Drop the previous sample of an interface"""
+        with self._lock:
+            self._samples.pop(interface_id, None)
+
+    def update(self, interface_id, sample, speed_kbps=None):
+        """Record a new sample and return the rates since the previous one
+
+        Returns a dict with input/output kbps and per-interval packet and error
+        counts, or None when the sample only primes the engine.
+        """
+        with self._lock:
+            previous = self._samples.get(interface_id)
+            self._samples[interface_id] = sample
+
+        if previous is None:
+            return None
+
+        elapsed = self._elapsed_seconds(previous, sample)
+        if elapsed is None or elapsed <= 0 or elapsed > MAX_INTERVAL_SECONDS:
+            return None
+
+        if sample.bits != previous.bits:
+            # The device switched between 32 and 64 bit counters
+            return None
+
+        deltas = {}
+        for field in COUNTER_FIELDS:
+            # Error counters are Counter32 even on devices with 64 bit octet counters
+            bits = 32 if field.endswith('errors_counter') else sample.bits
+            deltas[field] = counter_delta(
+                previous.counters.get(field), sample.counters.get(field), bits
+            )
+
+        if deltas['input_octets_counter'] is None or deltas['output_octets_counter'] is None:
+            return None
+
+        input_rate_kbps = deltas['input_octets_counter'] * 8 / 1000.0 / elapsed
+        output_rate_kbps = deltas['output_octets_counter'] * 8 / 1000.0 / elapsed
+
+        if speed_kbps and max(input_rate_kbps, output_rate_kbps) > speed_kbps * MAX_SPEED_RATIO:
+            return None
+
+        return {
+            'input_rate_kbps': input_rate_kbps,
+            'output_rate_kbps': output_rate_kbps,
+            'input_packets': deltas['input_packets_counter'] or 0,
+            'output_packets': deltas['output_packets_counter'] or 0,
+            'input_errors': deltas['input_errors_counter'] or 0,
+            'output_errors': deltas['output_errors_counter'] or 0,
+            'interval': elapsed
+        }
+
+    def _elapsed_seconds(self, previous, sample):
+        """Seconds between two samples, or None if the device rebooted in between
+
+        The device's own sysUpTime is preferred over the poll timestamps because
+        it is not skewed by network or collector latency.
+        """
+        wall_clock = (sample.timestamp - previous.timestamp).total_seconds()
+        if previous.sys_uptime is None or sample.sys_uptime is None:
+            return wall_clock
+
+        uptime_delta = counter_delta(previous.sys_uptime, sample.sys_uptime, UPTIME_BITS)
+        if uptime_delta is None:
+            # sysUpTime went backwards without wrapping: the device rebooted
+            return None
+
+        uptime_seconds = uptime_delta / 100.0
+        if abs(uptime_seconds - wall_clock) > max(5.0, wall_clock * 0.1):
+            # Disagreement means the uptime restarted and has grown past its old value
+            if sample.sys_uptime / 100.0 < wall_clock:
+                return None
+            return wall_clock
+        return uptime_seconds
+
+
+# Engine shared by all collection paths of this process
+rate_engine = RateEngine()
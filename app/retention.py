@@ -0,0 +1,140 @@
+import logging
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import select, text, true
+
+from . import db
+from .models import BandwidthStat, BandwidthRollup, BandwidthArchiveBlock
+from .storage import get_storage
+
+log = logging.getLogger(__name__)
+
+# Retention setting of the raw samples (None), every rollup tier and the archive, in days
+RETENTION_SETTINGS = (
+    (None, 'raw', 'RETENTION_RAW_DAYS', 7),
+    (60, '1m', 'RETENTION_1M_DAYS', 3),
+    (300, '5m', 'RETENTION_5M_DAYS', 30),
+    (3600, '1h', 'RETENTION_1H_DAYS', 730),
+    (86400, '1d', 'RETENTION_1D_DAYS', 0),
+    ('archive', 'archive', 'RETENTION_ARCHIVE_DAYS', 90)
+)
+
+
+def retention_policy(config=None):
+    """Return [(resolution, tier name, days)]
+
+    A resolution of None is the raw samples and 'archive' the compressed
+    archive blocks. Tiers with 0 days are kept forever and left out.
+    """
+    config = config if config is not None else current_app.config
+    policy = []
+    for resolution, name, key, default in RETENTION_SETTINGS:
+        days = config.get(key, default)
+        if days:
+            policy.append((resolution, name, days))
+    return policy
+
+
+def prune_table(table, scope, expired, chunk_size=5000, pause=0.0, stop=None, engine=None):
+    """Delete expired rows in chunks of ``chunk_size``, one short transaction each
+
+    ``scope`` selects the rows the policy applies to and ``expired`` the ones
+    to delete. Each chunk is the next ``chunk_size`` expired rows in id order
+    after the previous chunk; ids are not assumed to grow with time, since
+    spool replays, imports and backfilled rollups insert old rows with new
+    ids. ``pause`` seconds between chunks leave room for the collector's
+    inserts and ``stop`` is a callable that ends the walk early. Returns the
+    number of rows deleted.
+    """
+    engine = engine or db.engine
+    deleted = 0
+    after = None
+    while stop is None or not stop():
+        query = select(table.c.id).where(scope, expired).order_by(table.c.id).limit(chunk_size)
+        if after is not None:
+            query = query.where(table.c.id > after)
+        with engine.begin() as conn:
+            ids = conn.execute(query).scalars().all()
+            if not ids:
+                break
+            # Every expired row in the range is one of ``ids``; a range keeps the statement small
+            deleted += conn.execute(
+                table.delete().where(table.c.id.between(ids[0], ids[-1]), scope, expired)
+            ).rowcount
+        after = ids[-1]
+        if len(ids) < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return deleted
+
+
+def prune(policy=None, now=None, chunk_size=5000, pause=0.0, stop=None):
+    """Apply the retention policy; returns [(tier name, days, rows deleted)]
+
+    Raw samples are expired by the storage backend. On SQL with
+    STATS_PARTITION set they expire a whole partition at a time, once its
+    period has ended before the cutoff; only rows outside the partitions are
+    deleted in chunks.
+    """
+    now = now or datetime.utcnow()
+    policy = policy if policy is not None else retention_policy()
+    rollups = BandwidthRollup.__table__
+    archive = BandwidthArchiveBlock.__table__
+    results = []
+    for resolution, name, days in policy:
+        cutoff = now - timedelta(days=days)
+        if resolution is None:
+            deleted = get_storage().expire(cutoff, chunk_size, pause, stop)
+        elif resolution == 'archive':
+            deleted = prune_table(archive, true(), archive.c.last_timestamp < cutoff,
+                                  chunk_size, pause, stop)
+        else:
+            deleted = prune_table(rollups, rollups.c.resolution == resolution,
+                                  rollups.c.bucket < cutoff, chunk_size, pause, stop)
+        results.append((name, days, deleted))
+        if deleted:
+            log.info("Pruned %d %s bandwidth rows older than %s days", deleted, name, days)
+    return results
+
+
+def database_size():
+    """Size of the database in bytes, or None where it cannot be read"""
+    dialect = db.engine.dialect.name
+    with db.engine.connect() as conn:
+        if dialect == 'sqlite':
+            page_count = conn.execute(text("PRAGMA page_count")).scalar()
+            page_size = conn.execute(text("PRAGMA page_size")).scalar()
+            return page_count * page_size
+        if dialect == 'postgresql':
+            return conn.execute(text("SELECT pg_database_size(current_database())")).scalar()
+    return None
+
+
+def vacuum(analyze_only=False):
+    """Return freed pages to the OS and refresh planner statistics of the bandwidth tables
+
+    VACUUM rewrites the whole file on SQLite and blocks writers while it runs;
+    with ``analyze_only`` only the statistics are refreshed. Returns False on
+    databases where neither is supported.
+    """
+    dialect = db.engine.dialect.name
+    tables = (BandwidthStat.__tablename__, BandwidthRollup.__tablename__,
+              BandwidthArchiveBlock.__tablename__)
+    if dialect == 'sqlite':
+        statements = ["ANALYZE"] if analyze_only else ["VACUUM", "ANALYZE"]
+    elif dialect == 'postgresql':
+        command = "ANALYZE" if analyze_only else "VACUUM ANALYZE"
+        statements = [f"{command} {table}" for table in tables]
+    elif dialect == 'mysql':
+        command = "ANALYZE TABLE" if analyze_only else "OPTIMIZE TABLE"
+        statements = [f"{command} {', '.join(tables)}"]
+    else:
+        return False
+    # VACUUM cannot run inside a transaction
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+    return True
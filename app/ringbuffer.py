@@ -0,0 +1,206 @@
+import fcntl
+import logging
+import os
+import struct
+import threading
+
+import numpy as np
+from flask import current_app
+
+from .archive import VALUE_COLUMNS, to_micros
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'BWRB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sII')  # magic, format version, slots per interface
+HEADER_SIZE = 64
+GROW_RECORDS = 1024
+SAMPLE_DTYPE = np.dtype([('timestamp', '<i8')] + [(name, '<f8') for name in VALUE_COLUMNS])
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+
+def record_dtype(slots):
+    """One interface: the number of samples ever appended and the last ``slots`` of them"""
+    return np.dtype([('head', '<u8'), ('samples', SAMPLE_DTYPE, (slots,))])
+
+
+class RingBuffer:
+    """Fixed-size ring of the latest samples of every interface in one memory-mapped file
+
+    Record ``n`` of the file belongs to the interface with id ``n`` and holds
+    its last ``slots`` samples as a NumPy structured array; ``head`` counts
+    the samples ever appended, so the newest one sits at ``(head - 1) % slots``.
+    Collector processes append after their inserts are committed and web
+    workers map the same file read-only, so recent history is served from the
+    page cache without touching the database. Rates are stored as float64
+    with NaN for NULL.
+
+    Each interface is written by one collector process only (see sharding);
+    growing the file for new interface ids is serialized with an flock.
+    """
+
+    def __init__(self, path, slots=128, readonly=False):
+        self.path = path
+        self.slots = slots
+        self.readonly = readonly
+        self._records = None
+        self._lock = threading.Lock()
+
+    def _grow(self, records):
+        """Create the file or extend it to at least ``records`` interfaces"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            if size < HEADER_SIZE:
+                os.pwrite(fd, HEADER.pack(MAGIC, FORMAT_VERSION, self.slots).ljust(HEADER_SIZE, b'\0'), 0)
+                size = HEADER_SIZE
+            else:
+                magic, version, slots = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+                if magic != MAGIC or version != FORMAT_VERSION:
+                    raise ValueError(f"{self.path} is not a bandwidth ring buffer")
+                if slots != self.slots:
+                    log.warning("Ring buffer %s has %d slots per interface, not %d; keeping %d",
+                                self.path, slots, self.slots, slots)
+                    self.slots = slots
+            itemsize = record_dtype(self.slots).itemsize
+            records = -(-records // GROW_RECORDS) * GROW_RECORDS
+            # Only ever grow: mappings of other processes must stay valid
+            if size < HEADER_SIZE + records * itemsize:
+                os.ftruncate(fd, HEADER_SIZE + records * itemsize)
+        finally:
+            os.close(fd)
+
+    def _map(self, records=0):
+        """Map the file, remapping when it holds fewer than ``records`` interfaces
+
+        Returns None when a read-only buffer has no file yet.
+        """
+        if self._records is not None and len(self._records) >= records:
+            return self._records
+        if not self.readonly:
+            self._grow(max(records, 1))
+        elif not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            magic, version, slots = HEADER.unpack(f.read(HEADER.size))
+            size = os.fstat(f.fileno()).st_size
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{self.path} is not a bandwidth ring buffer")
+        self.slots = slots
+        dtype = record_dtype(slots)
+        count = (size - HEADER_SIZE) // dtype.itemsize
+        if not count:
+            return None
+        self._records = np.memmap(self.path, dtype=dtype, mode='r' if self.readonly else 'r+',
+                                  offset=HEADER_SIZE, shape=(count,))
+        return self._records
+
+    def append(self, rows):
+        """Add committed sample rows (BandwidthStat column dicts) to their interfaces' rings"""
+        by_interface = {}
+        for row in rows:
+            by_interface.setdefault(row['interface_id'], []).append(row)
+        if not by_interface:
+            return
+        with self._lock:
+            records = self._map(max(by_interface) + 1)
+            heads = records['head']
+            samples = records['samples']
+            for interface_id, interface_rows in by_interface.items():
+                head = int(heads[interface_id])
+                for row in sorted(interface_rows, key=lambda row: row['timestamp']):
+                    samples[interface_id, head % self.slots] = (to_micros(row['timestamp']),) + tuple(
+                        np.nan if row.get(name) is None else row[name] for name in VALUE_COLUMNS
+                    )
+                    head += 1
+                # Publish the samples only once they are written
+                heads[interface_id] = head
+
+    def window(self, interface_id, since, newest=None):
+        """Samples of an interface from ``since`` on, oldest first, as a structured array
+
+        Returns None unless the ring reaches back to ``since``, so a caller
+        never mistakes a short ring for a quiet interface, and, with
+        ``newest``, unless it holds a sample at least that recent.
+        """
+        with self._lock:
+            records = self._map()
+            if records is not None and interface_id >= len(records):
+                records = self._map(interface_id + 1) if self.readonly else None
+        if records is None or interface_id >= len(records):
+            return None
+        head = int(records['head'][interface_id])
+        ring = records['samples'][interface_id, :min(head, self.slots)]
+        if not len(ring) or ring['timestamp'].min() > to_micros(since):
+            return None
+        if newest is not None and ring['timestamp'].max() < to_micros(newest):
+            return None
+        recent = ring[ring['timestamp'] >= to_micros(since)]
+        return recent[np.argsort(recent['timestamp'], kind='stable')]
+
+    def latest(self, interface_ids):
+        """The newest sample of each interface as ``(interface_ids, samples)`` arrays
+
+        Interfaces without a sample in the ring are left out. Reads one
+        head counter and one slot per interface, so it is cheap enough to
+        call every second for thousands of interfaces.
+        """
+        ids = np.asarray(sorted(interface_ids), dtype=np.int64)
+        with self._lock:
+            records = self._map()
+            if records is not None and len(ids) and ids[-1] >= len(records) and self.readonly:
+                records = self._map(int(ids[-1]) + 1)
+        if records is None:
+            return ids[:0], np.zeros(0, SAMPLE_DTYPE)
+        ids = ids[ids < len(records)]
+        heads = records['head'][ids].astype(np.int64)
+        ids = ids[heads > 0]
+        slots = (heads[heads > 0] - 1) % self.slots
+        return ids, np.array(records['samples'][ids, slots])
+
+    def clear(self):
+        """Forget all samples, e.g. after the interfaces were removed"""
+        with self._lock:
+            records = self._map()
+            if records is not None:
+                records['head'][:] = 0
+                records.flush()
+
+
+def open_ring_buffer(readonly=False):
+    """The RING_BUFFER_PATH buffer of this process, or None when it is disabled"""
+    config = current_app.config
+    path = config.get('RING_BUFFER_PATH')
+    if not path:
+        return None
+    with _buffers_lock:
+        buffer = _buffers.get((path, readonly))
+        if buffer is None:
+            buffer = RingBuffer(path, slots=config.get('RING_BUFFER_SLOTS', 128), readonly=readonly)
+            _buffers[(path, readonly)] = buffer
+    return buffer
+
+
+def recent_history(interface_id, since, newest=None):
+    """Samples of an interface since ``since`` from the ring buffer as ``(timestamps, columns)``
+
+    Timestamps are int64 microseconds and columns float64 arrays with NaN for
+    NULL, as returned by archive.read_archive(). Samples without rates are
+    left out, as in the history query. Returns None when the ring buffer is
+    disabled or does not cover the whole window. The ring only holds what
+    the collectors of this host wrote, so ``newest``, the time of the newest
+    sample stored anywhere (interface_current_tbl), makes a ring that
+    stopped being written count as not covering the window.
+    """
+    buffer = open_ring_buffer(readonly=True)
+    if buffer is None:
+        return None
+    recent = buffer.window(interface_id, since, newest)
+    if recent is None:
+        return None
+    recent = recent[~np.isnan(recent['input_rate_kbps'])]
+    return recent['timestamp'].copy(), {name: recent[name].copy() for name in VALUE_COLUMNS}
@@ -0,0 +1,300 @@
+import logging
+import math
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, bindparam, case, select
+
+from .models import BandwidthStat, BandwidthRollup, BandwidthArchiveBlock
+from .archive import block_rows, decode_block
+
+log = logging.getLogger(__name__)
+
+# Rollup tiers in seconds, finest first
+RESOLUTIONS = (60, 300, 3600, 86400)
+# p95 of tiers of an hour or more is the 95th percentile of their 5-minute
+# averages, the usual definition for link utilization; finer tiers use raw samples
+P95_SOURCE = {60: None, 300: None, 3600: 300, 86400: 300}
+EPOCH = datetime(1970, 1, 1)
+
+SUM_FIELDS = ('input_packets', 'output_packets', 'input_errors', 'output_errors')
+
+
+def bucket_start(timestamp, resolution):
+    """Start of the rollup bucket a (naive UTC) timestamp falls into"""
+    seconds = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % resolution)
+
+
+def percentile(values, fraction=0.95):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def aggregate(rows, resolutions=RESOLUTIONS):
+    """Fold sample rows into one partial rollup row per (interface, resolution, bucket)
+
+    Rows without rates (the first poll of an interface) are skipped.
+    """
+    rollups = {}
+    for row in rows:
+        input_rate = row.get('input_rate_kbps')
+        output_rate = row.get('output_rate_kbps')
+        if input_rate is None or output_rate is None:
+            continue
+        for resolution in resolutions:
+            key = (row['interface_id'], resolution, bucket_start(row['timestamp'], resolution))
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = rollups[key] = {
+                    'interface_id': key[0],
+                    'resolution': resolution,
+                    'bucket': key[2],
+                    'samples': 0,
+                    'input_rate_avg': 0.0,
+                    'input_rate_min': input_rate,
+                    'input_rate_max': input_rate,
+                    'output_rate_avg': 0.0,
+                    'output_rate_min': output_rate,
+                    'output_rate_max': output_rate,
+                    'input_packets': 0,
+                    'output_packets': 0,
+                    'input_errors': 0,
+                    'output_errors': 0
+                }
+            count = rollup['samples']
+            rollup['input_rate_avg'] += (input_rate - rollup['input_rate_avg']) / (count + 1)
+            rollup['output_rate_avg'] += (output_rate - rollup['output_rate_avg']) / (count + 1)
+            rollup['input_rate_min'] = min(rollup['input_rate_min'], input_rate)
+            rollup['input_rate_max'] = max(rollup['input_rate_max'], input_rate)
+            rollup['output_rate_min'] = min(rollup['output_rate_min'], output_rate)
+            rollup['output_rate_max'] = max(rollup['output_rate_max'], output_rate)
+            for field in SUM_FIELDS:
+                rollup[field] += row.get(field) or 0
+            rollup['samples'] = count + 1
+    return list(rollups.values())
+
+
+def _merge_values(table, incoming):
+    """Column values that merge ``incoming`` (a row-like of new partials) into an existing rollup"""
+    total = table.c.samples + incoming.samples
+    values = {'samples': total}
+    for direction in ('input', 'output'):
+        avg, low, high = (f'{direction}_rate_avg', f'{direction}_rate_min', f'{direction}_rate_max')
+        values[avg] = (table.c[avg] * table.c.samples + incoming[avg] * incoming.samples) / total
+        values[low] = case((incoming[low] < table.c[low], incoming[low]), else_=table.c[low])
+        values[high] = case((incoming[high] > table.c[high], incoming[high]), else_=table.c[high])
+        # New samples invalidate the percentile; finalize_rollups() recomputes it
+        values[f'{direction}_rate_p95'] = None
+    for field in SUM_FIELDS:
+        values[field] = table.c[field] + incoming[field]
+    return values
+
+
+def update_rollups(conn, rows, resolutions=RESOLUTIONS):
+    """Merge freshly inserted sample rows into every rollup tier
+
+    ``conn`` is a Connection or Session inside the transaction that inserted
+    the rows, so samples and rollups are committed together. Uses a native
+    upsert on SQLite and PostgreSQL and read-modify-write elsewhere.
+    """
+    partials = aggregate(rows, resolutions)
+    if not partials:
+        return 0
+    table = BandwidthRollup.__table__
+    dialect = conn.get_bind().dialect.name if hasattr(conn, 'get_bind') else conn.dialect.name
+
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['interface_id', 'resolution', 'bucket'],
+            set_=_merge_values(table, statement.excluded)
+        )
+        conn.execute(statement, partials)
+        return len(partials)
+
+    for partial in partials:
+        existing = conn.execute(select(table.c.id).where(and_(
+            table.c.interface_id == partial['interface_id'],
+            table.c.resolution == partial['resolution'],
+            table.c.bucket == partial['bucket']
+        ))).first()
+        if existing is None:
+            conn.execute(table.insert(), [partial])
+        else:
+            conn.execute(
+                table.update().where(table.c.id == existing.id).values(
+                    _merge_values(table, _Literal(partial))
+                )
+            )
+    return len(partials)
+
+
+class _Literal(dict):
+    """Lets _merge_values() read plain values with the same syntax as ``excluded``"""
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+def finalize_rollups(session, now=None, grace=60, limit=200):
+    """Compute p95 of rollup buckets that closed at least ``grace`` seconds ago
+
+    Buckets are handled one (resolution, bucket) at a time so the source rows of
+    all interfaces in it are read with a single query. Returns the number of
+    rollup rows updated.
+    """
+    now = now or datetime.utcnow()
+    table = BandwidthRollup.__table__
+    updated = 0
+    for resolution in RESOLUTIONS:
+        closed_before = now - timedelta(seconds=resolution + grace)
+        buckets = session.execute(
+            select(table.c.bucket).where(
+                table.c.resolution == resolution,
+                table.c.input_rate_p95.is_(None),
+                table.c.bucket <= closed_before
+            ).group_by(table.c.bucket).order_by(table.c.bucket).limit(limit)
+        ).scalars().all()
+        for bucket in buckets:
+            updated += _finalize_bucket(session, table, resolution, bucket)
+    return updated
+
+
+def _finalize_bucket(session, table, resolution, bucket):
+    end = bucket + timedelta(seconds=resolution)
+    pending = session.execute(select(table.c.id, table.c.interface_id).where(
+        table.c.resolution == resolution,
+        table.c.bucket == bucket,
+        table.c.input_rate_p95.is_(None)
+    )).all()
+    interface_ids = [interface_id for _, interface_id in pending]
+
+    source = P95_SOURCE[resolution]
+    if source is None:
+        stats = BandwidthStat.__table__
+        query = select(stats.c.interface_id, stats.c.input_rate_kbps, stats.c.output_rate_kbps).where(
+            stats.c.interface_id.in_(interface_ids),
+            stats.c.timestamp >= bucket,
+            stats.c.timestamp < end,
+            stats.c.input_rate_kbps.isnot(None)
+        )
+    else:
+        query = select(table.c.interface_id, table.c.input_rate_avg, table.c.output_rate_avg).where(
+            table.c.interface_id.in_(interface_ids),
+            table.c.resolution == source,
+            table.c.bucket >= bucket,
+            table.c.bucket < end
+        )
+
+    values = {}
+    for interface_id, input_rate, output_rate in session.execute(query):
+        inputs, outputs = values.setdefault(interface_id, ([], []))
+        inputs.append(input_rate)
+        outputs.append(output_rate or 0.0)
+
+    updates = []
+    for rollup_id, interface_id in pending:
+        inputs, outputs = values.get(interface_id, ([], []))
+        updates.append({
+            'rollup_id': rollup_id,
+            # Keep the bucket marked as finalized even if its source rows are gone
+            'p95_in': percentile(inputs) if inputs else 0.0,
+            'p95_out': percentile(outputs) if outputs else 0.0
+        })
+    if updates:
+        session.execute(
+            table.update().where(table.c.id == bindparam('rollup_id')).values(
+                input_rate_p95=bindparam('p95_in'), output_rate_p95=bindparam('p95_out')
+            ),
+            updates
+        )
+    return len(updates)
+
+
+def rollups_from_samples(rows, resolution):
+    """Complete rollup rows of one tier, p95 included, computed straight from sample rows
+
+    Used where samples are not rolled up on insert; the p95 follows the same
+    P95_SOURCE rules as finalize_rollups().
+    """
+    rollups = aggregate(rows, (resolution,))
+    source = P95_SOURCE[resolution]
+    if source is None:
+        points = [(row['timestamp'], row['input_rate_kbps'], row['output_rate_kbps']) for row in rows
+                  if row.get('input_rate_kbps') is not None and row.get('output_rate_kbps') is not None]
+    else:
+        points = [(point['bucket'], point['input_rate_avg'], point['output_rate_avg'])
+                  for point in aggregate(rows, (source,))]
+    values = {}
+    for timestamp, input_rate, output_rate in points:
+        inputs, outputs = values.setdefault(bucket_start(timestamp, resolution), ([], []))
+        inputs.append(input_rate)
+        outputs.append(output_rate)
+    for rollup in rollups:
+        inputs, outputs = values.get(rollup['bucket'], ([], []))
+        rollup['input_rate_p95'] = percentile(inputs)
+        rollup['output_rate_p95'] = percentile(outputs)
+    return sorted(rollups, key=lambda rollup: rollup['bucket'])
+
+
+def choose_resolution(hours, min_points):
+    """Coarsest tier that still yields ``min_points`` points over ``hours``, or None for raw samples"""
+    span = hours * 3600
+    for resolution in reversed(RESOLUTIONS):
+        if span / resolution >= min_points:
+            return resolution
+    return None
+
+
+def rollup_history_query(session, interface_id, resolution, since):
+    """Query the rollup rows of an interface at one resolution since a point in time"""
+    return session.query(BandwidthRollup).filter(
+        BandwidthRollup.interface_id == interface_id,
+        BandwidthRollup.resolution == resolution,
+        BandwidthRollup.bucket >= bucket_start(since, resolution)
+    ).order_by(BandwidthRollup.bucket)
+
+
+def rollup_history_batch_query(session, interface_ids, resolution, since):
+    """Query the rollup rows of several interfaces at one resolution, grouped by interface"""
+    return session.query(BandwidthRollup).filter(
+        BandwidthRollup.interface_id.in_(interface_ids),
+        BandwidthRollup.resolution == resolution,
+        BandwidthRollup.bucket >= bucket_start(since, resolution)
+    ).order_by(BandwidthRollup.interface_id, BandwidthRollup.bucket)
+
+
+def rebuild_rollups(session, chunk_size=10000):
+    """Recreate all rollups from the archived and raw samples; returns the number of samples read"""
+    session.query(BandwidthRollup).delete(synchronize_session=False)
+    total = 0
+    blocks = BandwidthArchiveBlock.__table__
+    for block_id in session.execute(select(blocks.c.id).order_by(blocks.c.id)).scalars().all():
+        block = session.execute(
+            select(blocks.c.interface_id, blocks.c.data).where(blocks.c.id == block_id)
+        ).one()
+        rows = block_rows(block.interface_id, *decode_block(block.data))
+        update_rollups(session, rows)
+        total += len(rows)
+
+    stats = BandwidthStat.__table__
+    columns = [stats.c.id, stats.c.interface_id, stats.c.timestamp, stats.c.input_rate_kbps,
+               stats.c.output_rate_kbps] + [stats.c[field] for field in SUM_FIELDS]
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(*columns).where(stats.c.id > last_id).order_by(stats.c.id).limit(chunk_size)
+        ).mappings().all()
+        if not rows:
+            break
+        update_rollups(session, [dict(row) for row in rows])
+        last_id = rows[-1]['id']
+        total += len(rows)
+    return total
@@ -0,0 +1,119 @@
+import heapq
+import random
+import time
+
+
+class PollScheduler:
+    """Heap scheduler that polls every device on its own interval
+
+    Each device is in the heap at most once and is taken out while it is being
+    polled, so a slow device can never overlap with itself. When the collector
+    falls behind, missed polls of a device are coalesced into a single one
+    instead of piling up, which keeps the poll rate steady.
+    """
+
+    def __init__(self, jitter=0.1, clock=time.monotonic):
+        self.jitter = jitter
+        self.clock = clock
+        self._heap = []
+        self._intervals = {}
+        self._due = {}
+        self._in_flight = set()
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __contains__(self, device_id):
+        return device_id in self._intervals
+
+    def _jittered(self, interval):
+        """Return the interval with +/- jitter applied"""
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _push(self, device_id, due):
+        self._due[device_id] = due
+        heapq.heappush(self._heap, (due, device_id))
+
+    def add(self, device_id, interval):
+        """Schedule a device; its first poll is spread randomly over one interval"""
+        if device_id in self._intervals:
+            self.set_interval(device_id, interval)
+            return
+        self._intervals[device_id] = interval
+        self._push(device_id, self.clock() + random.uniform(0, interval))
+
+    def set_interval(self, device_id, interval):
+        """Change the interval of a scheduled device, pulling its next poll in if needed"""
+        if self._intervals.get(device_id) == interval:
+            return
+        self._intervals[device_id] = interval
+        due = self._due.get(device_id)
+        if due is not None and device_id not in self._in_flight:
+            latest = self.clock() + interval
+            if due > latest:
+                self._push(device_id, latest)
+
+    def remove(self, device_id):
+        """Stop polling a device; stale heap entries are skipped lazily"""
+        self._intervals.pop(device_id, None)
+        self._due.pop(device_id, None)
+        self._in_flight.discard(device_id)
+
+    def device_ids(self):
+        """Return the ids of all scheduled devices"""
+        return list(self._intervals)
+
+    def next_due_in(self):
+        """Seconds until the next poll is due, or None if nothing is scheduled"""
+        while self._heap:
+            due, device_id = self._heap[0]
+            if self._due.get(device_id) != due or device_id in self._in_flight:
+                heapq.heappop(self._heap)
+                continue
+            return max(0.0, due - self.clock())
+        return None
+
+    def overdue(self):
+        """Number of devices whose poll time has passed but which are not running yet"""
+        now = self.clock()
+        return sum(
+            1 for device_id, due in self._due.items()
+            if due <= now and device_id not in self._in_flight
+        )
+
+    def pop_due(self, limit):
+        """Take up to ``limit`` due devices out of the heap and mark them in flight"""
+        now = self.clock()
+        due_devices = []
+        while self._heap and len(due_devices) < limit:
+            due, device_id = self._heap[0]
+            if self._due.get(device_id) != due or device_id in self._in_flight:
+                heapq.heappop(self._heap)
+                continue
+            if due > now:
+                break
+            heapq.heappop(self._heap)
+            self._in_flight.add(device_id)
+            due_devices.append(device_id)
+        return due_devices
+
+    def done(self, device_id):
+        """Reschedule a device after its poll finished
+
+        The next poll is one interval after the previous *scheduled* time so the
+        rate does not drift with poll duration. If that is already in the past
+        the collector is behind: the missed polls are dropped and the device is
+        polled again one jittered interval from now.
+        """
+        self._in_flight.discard(device_id)
+        interval = self._intervals.get(device_id)
+        if interval is None:
+            return
+        now = self.clock()
+        previous_due = self._due.get(device_id, now)
+        next_due = previous_due + self._jittered(interval)
+        if next_due <= now:
+            self.coalesced += int((now - previous_due) // interval)
+            next_due = now + self._jittered(interval)
+        self._push(device_id, next_due)
@@ -0,0 +1,120 @@
+import bisect
+import hashlib
+import os
+import socket
+from datetime import datetime, timedelta
+
+from . import db
+from .models import CollectorWorker
+
+
+def _hash(key):
+    """Stable 64 bit hash of a string, identical on every host and Python run"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping device ids to worker ids
+
+    Every worker owns ``replicas`` points on the ring, so when a worker joins or
+    leaves only the devices next to its points move and the load stays even.
+    """
+
+    def __init__(self, worker_ids, replicas=64):
+        self.worker_ids = sorted(worker_ids)
+        self._points = []
+        for worker_id in self.worker_ids:
+            for replica in range(replicas):
+                self._points.append((_hash(f"{worker_id}#{replica}"), worker_id))
+        self._points.sort()
+        self._owners = [owner for _, owner in self._points]
+        self._points = [point for point, _ in self._points]
+
+    def owner(self, device_id):
+        """Return the worker id responsible for a device"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(f"device:{device_id}")) % len(self._points)
+        return self._owners[index]
+
+
+def parse_shard(value):
+    """Parse a "K/N" shard spec (1-based K) into a zero-based (index, count) tuple"""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except (AttributeError, ValueError):
+        raise ValueError(f"Invalid shard '{value}', expected K/N such as 1/4")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{value}', K must be between 1 and N")
+    return index - 1, count
+
+
+def shard_devices(devices, index, count, prefix='shard'):
+    """Keep the ``(device_id, ...)`` tuples that belong to static shard ``index`` of ``count``
+
+    Every host computes the same assignment, so ``collect-stats --shard K/N`` can
+    be run on N machines without coordination. Use a different ``prefix`` to
+    split a shard again independently of the first split.
+    """
+    ring = HashRing([f"{prefix}-{i}" for i in range(count)])
+    worker_id = f"{prefix}-{index}"
+    return [device for device in devices if ring.owner(device[0]) == worker_id]
+
+
+def default_worker_id(suffix=None):
+    """Build a worker id that is unique across hosts and processes"""
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    return f"{worker_id}-{suffix}" if suffix is not None else worker_id
+
+
+class WorkerRegistry:
+    """Tracks live collector workers through heartbeats in collector_workers_tbl
+
+    A worker is alive while its heartbeat is younger than ``ttl`` seconds. When a
+    worker dies its heartbeat expires and the remaining workers pick up its
+    devices on their next refresh; a worker that exits cleanly removes itself
+    right away.
+    """
+
+    def __init__(self, worker_id, ttl=30):
+        self.worker_id = worker_id
+        self.ttl = ttl
+
+    def heartbeat(self):
+        """Refresh this worker's heartbeat and return the ids of all live workers"""
+        now = datetime.utcnow()
+        try:
+            worker = db.session.query(CollectorWorker).filter_by(worker_id=self.worker_id).first()
+            if worker:
+                worker.heartbeat_at = now
+            else:
+                db.session.add(CollectorWorker(
+                    worker_id=self.worker_id,
+                    hostname=socket.gethostname(),
+                    pid=os.getpid(),
+                    started_at=now,
+                    heartbeat_at=now
+                ))
+
+            # Forget workers that have been dead for a long time
+            db.session.query(CollectorWorker).filter(
+                CollectorWorker.heartbeat_at < now - timedelta(seconds=self.ttl * 10)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+
+            live = db.session.query(CollectorWorker.worker_id).filter(
+                CollectorWorker.heartbeat_at >= now - timedelta(seconds=self.ttl)
+            ).all()
+            return sorted(worker_id for worker_id, in live)
+        except Exception as e:
+            db.session.rollback()
+            raise
+
+    def leave(self):
+        """Remove this worker so the others take over its devices immediately"""
+        try:
+            db.session.query(CollectorWorker).filter_by(worker_id=self.worker_id).delete()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise
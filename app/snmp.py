@@ -0,0 +1,212 @@
+import math
+import threading
+import time
+from flask import current_app
+
+from .metrics import SNMP_REQUEST_SECONDS
+
+# Interface table columns fetched on every poll, keyed by the name used in the
+# row dicts returned by walk_interface_table()
+IF_TABLE_COLUMNS = {
+    'ifDescr': '1.3.6.1.2.1.2.2.1.2',
+    'ifInOctets': '1.3.6.1.2.1.2.2.1.10',
+    'ifInUcastPkts': '1.3.6.1.2.1.2.2.1.11',
+    'ifInErrors': '1.3.6.1.2.1.2.2.1.14',
+    'ifOutOctets': '1.3.6.1.2.1.2.2.1.16',
+    'ifOutUcastPkts': '1.3.6.1.2.1.2.2.1.17',
+    'ifOutErrors': '1.3.6.1.2.1.2.2.1.20',
+    'ifName': '1.3.6.1.2.1.31.1.1.1.1',
+    'ifHCInOctets': '1.3.6.1.2.1.31.1.1.1.6',
+    'ifHCInUcastPkts': '1.3.6.1.2.1.31.1.1.1.7',
+    'ifHCOutOctets': '1.3.6.1.2.1.31.1.1.1.10',
+    'ifHCOutUcastPkts': '1.3.6.1.2.1.31.1.1.1.11',
+    'ifHighSpeed': '1.3.6.1.2.1.31.1.1.1.15',
+}
+
+SYS_UPTIME_OID = '1.3.6.1.2.1.1.3.0'
+
+# pysnmp engines are expensive to build, so every collector thread keeps its own
+_local = threading.local()
+
+
+class SNMPError(Exception):
+    """Raised when a device does not answer an SNMP request"""
+
+
+def _get_engine():
+    """Return the SNMP engine for the current thread"""
+    from pysnmp.hlapi import SnmpEngine
+    if not hasattr(_local, 'engine'):
+        _local.engine = SnmpEngine()
+    return _local.engine
+
+
+def _snmp_config(name, default):
+    """Read an SNMP setting from the app config when an app context exists"""
+    try:
+        return current_app.config.get(name, default)
+    except RuntimeError:
+        return default
+
+
+def _target(ip, port):
+    """Send requests to SNMP_TARGET_OVERRIDE ("host:port", e.g. the simulator) when it is set"""
+    override = _snmp_config('SNMP_TARGET_OVERRIDE', None)
+    if not override:
+        return ip, port
+    host, _, override_port = override.rpartition(':')
+    return host, int(override_port)
+
+
+def _attempt_timeout(ip, timeout, retries, deadline):
+    """Timeout of one request attempt, cut so that it and its retries end by ``deadline``
+
+    ``deadline`` is a time.monotonic() value or None. Cut timeouts are rounded
+    down to tenths of a second, as pysnmp registers a target per distinct timeout.
+    """
+    if deadline is None:
+        return timeout
+    attempt = math.floor((deadline - time.monotonic()) / (retries + 1) * 10) / 10
+    if attempt < 0.1:
+        raise SNMPError(f"{ip}: no time left before the device deadline")
+    return min(timeout, attempt)
+
+
+def walk_interface_table(ip, community, version=2, port=161, timeout=None, retries=None,
+                         max_repetitions=None, columns=None, deadline=None):
+    """Fetch the interface table of a device in as few requests as possible
+
+    All columns are walked side by side with GETBULK (GETNEXT for SNMPv1), so a
+    switch with a few hundred ports is read in a handful of round trips instead
+    of one query per interface. Returns a dict of ifIndex -> row dict with one
+    key per column that the device answered. With a ``deadline`` every request
+    gets at most the time left, so a slow device cannot keep the walk going.
+    """
+    from pysnmp.hlapi import (
+        CommunityData, UdpTransportTarget, ContextData,
+        ObjectType, ObjectIdentity, bulkCmd, nextCmd
+    )
+    from pysnmp.proto.rfc1905 import EndOfMibView, NoSuchObject, NoSuchInstance
+
+    columns = columns or IF_TABLE_COLUMNS
+    timeout = timeout if timeout is not None else _snmp_config('SNMP_TIMEOUT', 2)
+    retries = retries if retries is not None else _snmp_config('SNMP_RETRIES', 1)
+    max_repetitions = max_repetitions or _snmp_config('SNMP_MAX_REPETITIONS', 25)
+
+    names = list(columns)
+    prefixes = [tuple(int(part) for part in columns[name].split('.')) for name in names]
+    var_binds = [ObjectType(ObjectIdentity(columns[name])) for name in names]
+    target = UdpTransportTarget(_target(ip, port), timeout=_attempt_timeout(ip, timeout, retries, deadline),
+                                retries=retries)
+
+    if version == 1:
+        responses = nextCmd(
+            _get_engine(), CommunityData(community, mpModel=0), target, ContextData(),
+            *var_binds, lexicographicMode=False, lookupMib=False
+        )
+    else:
+        responses = bulkCmd(
+            _get_engine(), CommunityData(community, mpModel=1), target, ContextData(),
+            0, max_repetitions, *var_binds, lexicographicMode=False, lookupMib=False
+        )
+
+    rows = {}
+    with SNMP_REQUEST_SECONDS.time(device=ip, operation='walk'):
+        for error_indication, error_status, error_index, var_bind_row in responses:
+            if error_indication:
+                raise SNMPError(f"{ip}: {error_indication}")
+            if error_status:
+                raise SNMPError(f"{ip}: {error_status.prettyPrint()} at index {error_index}")
+
+            for column, (oid, value) in enumerate(var_bind_row):
+                if isinstance(value, (EndOfMibView, NoSuchObject, NoSuchInstance)):
+                    continue
+                oid = tuple(oid)
+                prefix = prefixes[column]
+                if oid[:len(prefix)] != prefix or len(oid) != len(prefix) + 1:
+                    continue
+                if_index = oid[-1]
+                if names[column] in ('ifDescr', 'ifName'):
+                    value = value.prettyPrint()
+                else:
+                    value = int(value)
+                rows.setdefault(if_index, {'ifIndex': if_index})[names[column]] = value
+            # Read for every request of the walk
+            target.timeout = _attempt_timeout(ip, timeout, retries, deadline)
+
+    return rows
+
+
+def index_rows_by_name(rows):
+    """Index interface table rows by ifDescr and ifName for matching Interface.ifname"""
+    by_name = {}
+    for row in rows.values():
+        for key in ('ifName', 'ifDescr'):
+            name = row.get(key)
+            if name:
+                by_name.setdefault(name, row)
+                by_name.setdefault(name.lower(), row)
+    return by_name
+
+
+def get_sys_uptime(ip, community, version=2, port=161, timeout=None, retries=None, deadline=None):
+    """Return sysUpTime of a device in hundredths of a second, giving up by ``deadline``"""
+    from pysnmp.hlapi import (
+        CommunityData, UdpTransportTarget, ContextData,
+        ObjectType, ObjectIdentity, getCmd
+    )
+
+    timeout = timeout if timeout is not None else _snmp_config('SNMP_TIMEOUT', 2)
+    retries = retries if retries is not None else _snmp_config('SNMP_RETRIES', 1)
+
+    with SNMP_REQUEST_SECONDS.time(device=ip, operation='get'):
+        error_indication, error_status, error_index, var_binds = next(
+            getCmd(
+                _get_engine(),
+                CommunityData(community, mpModel=0 if version == 1 else 1),
+                UdpTransportTarget(_target(ip, port), timeout=_attempt_timeout(ip, timeout, retries, deadline),
+                                   retries=retries),
+                ContextData(),
+                ObjectType(ObjectIdentity(SYS_UPTIME_OID)),
+                lookupMib=False
+            )
+        )
+    if error_indication:
+        raise SNMPError(f"{ip}: {error_indication}")
+    if error_status:
+        raise SNMPError(f"{ip}: {error_status.prettyPrint()} at index {error_index}")
+    return int(var_binds[0][1])
+
+
+def counters_from_row(row):
+    """Extract raw counters from an interface table row
+
+    Returns ``(counters, bits)``. The 64 bit ifXTable counters are used when the
+    device has them, otherwise the 32 bit ifTable ones.
+    """
+    if 'ifHCInOctets' in row and 'ifHCOutOctets' in row:
+        bits = 64
+        counters = {
+            'input_octets_counter': row['ifHCInOctets'],
+            'output_octets_counter': row['ifHCOutOctets'],
+            'input_packets_counter': row.get('ifHCInUcastPkts'),
+            'output_packets_counter': row.get('ifHCOutUcastPkts')
+        }
+    else:
+        bits = 32
+        counters = {
+            'input_octets_counter': row.get('ifInOctets'),
+            'output_octets_counter': row.get('ifOutOctets'),
+            'input_packets_counter': row.get('ifInUcastPkts'),
+            'output_packets_counter': row.get('ifOutUcastPkts')
+        }
+    counters['input_errors_counter'] = row.get('ifInErrors')
+    counters['output_errors_counter'] = row.get('ifOutErrors')
+    return counters, bits
+
+
+def speed_kbps_from_row(row):
+    """Return the interface speed reported by the device in kbps, if any"""
+    if row.get('ifHighSpeed'):
+        return row['ifHighSpeed'] * 1000
+    return None
@@ -0,0 +1,453 @@
+import asyncio
+import bisect
+import logging
+import math
+import multiprocessing
+import random
+import signal
+import time
+
+from .snmp import IF_TABLE_COLUMNS, SYS_UPTIME_OID
+
+log = logging.getLogger(__name__)
+
+# BER tags used by SNMPv2c
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_IDENTIFIER = 0x06
+SEQUENCE = 0x30
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIMETICKS = 0x43
+COUNTER64 = 0x46
+NO_SUCH_OBJECT = 0x80
+END_OF_MIB_VIEW = 0x82
+GET_REQUEST = 0xA0
+GET_NEXT_REQUEST = 0xA1
+RESPONSE = 0xA2
+GET_BULK_REQUEST = 0xA5
+
+SNMP_V2C = 1
+# Keep responses well below the largest UDP datagram
+MAX_RESPONSE_BYTES = 60000
+
+SYS_DESCR_OID = '1.3.6.1.2.1.1.1.0'
+SYS_NAME_OID = '1.3.6.1.2.1.1.5.0'
+IF_NUMBER_OID = '1.3.6.1.2.1.2.1.0'
+IF_EXTRA_COLUMNS = {
+    'ifIndex': '1.3.6.1.2.1.2.2.1.1',
+    'ifSpeed': '1.3.6.1.2.1.2.2.1.5',
+    'ifOperStatus': '1.3.6.1.2.1.2.2.1.8',
+}
+
+# Link speed in Mbps guessed from the interface name when Interface.bandwidth is empty
+SPEEDS_BY_PREFIX = [
+    ('TenGigabit', 10000), ('Gigabit', 1000), ('FastEthernet', 100),
+    ('Ethernet', 10), ('Serial', 2)
+]
+
+
+def _oid(text):
+    return tuple(int(part) for part in text.split('.'))
+
+
+def _encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    body = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(body)]) + body
+
+
+def _tlv(tag, body):
+    return bytes([tag]) + _encode_length(len(body)) + body
+
+
+def _encode_integer(value):
+    return _tlv(INTEGER, value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True))
+
+
+def _encode_unsigned(tag, value):
+    return _tlv(tag, value.to_bytes((value.bit_length() + 8) // 8, 'big'))
+
+
+_oid_cache = {}
+
+
+def _encode_oid(oid):
+    """BER-encode an OID tuple; encodings are cached since every device shares them"""
+    encoded = _oid_cache.get(oid)
+    if encoded is None:
+        body = bytearray()
+        for arc in (oid[0] * 40 + oid[1],) + oid[2:]:
+            chunk = [arc & 0x7F]
+            arc >>= 7
+            while arc:
+                chunk.append(0x80 | (arc & 0x7F))
+                arc >>= 7
+            body.extend(reversed(chunk))
+        encoded = _oid_cache[oid] = _tlv(OBJECT_IDENTIFIER, bytes(body))
+    return encoded
+
+
+def _decode_tlv(data, pos):
+    """Return (tag, body, next position) of the TLV starting at ``pos``"""
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        size = length & 0x7F
+        length = int.from_bytes(data[pos:pos + size], 'big')
+        pos += size
+    end = pos + length
+    if end > len(data):
+        raise ValueError("Truncated BER value")
+    return tag, data[pos:end], end
+
+
+def _decode_oid(body):
+    arcs = []
+    value = 0
+    for byte in body:
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            arcs.append(value)
+            value = 0
+    first = arcs[0]
+    head = divmod(first, 40) if first < 80 else (2, first - 80)
+    return head + tuple(arcs[1:])
+
+
+def decode_request(data):
+    """Parse an SNMPv2c request into (community, pdu_type, request_id, field1, field2, oids)
+
+    ``field1``/``field2`` are error-status/error-index, or non-repeaters and
+    max-repetitions for GETBULK.
+    """
+    tag, message, _ = _decode_tlv(data, 0)
+    if tag != SEQUENCE:
+        raise ValueError("Not an SNMP message")
+    tag, version, pos = _decode_tlv(message, 0)
+    if tag != INTEGER or int.from_bytes(version, 'big') != SNMP_V2C:
+        raise ValueError("Only SNMPv2c is supported")
+    tag, community, pos = _decode_tlv(message, pos)
+    pdu_type, pdu, _ = _decode_tlv(message, pos)
+
+    fields = []
+    pos = 0
+    for _ in range(3):
+        tag, value, pos = _decode_tlv(pdu, pos)
+        fields.append(int.from_bytes(value, 'big', signed=True))
+    tag, var_binds, _ = _decode_tlv(pdu, pos)
+
+    oids = []
+    pos = 0
+    while pos < len(var_binds):
+        tag, var_bind, pos = _decode_tlv(var_binds, pos)
+        tag, oid, _ = _decode_tlv(var_bind, 0)
+        oids.append(_decode_oid(oid))
+    return bytes(community), pdu_type, fields[0], fields[1], fields[2], oids
+
+
+def encode_response(community, request_id, var_binds):
+    """Build a GetResponse PDU from a list of already encoded var binds"""
+    pdu = (
+        _encode_integer(request_id) + _encode_integer(0) + _encode_integer(0)
+        + _tlv(SEQUENCE, b''.join(var_binds))
+    )
+    return _tlv(SEQUENCE, _encode_integer(SNMP_V2C) + _tlv(OCTET_STRING, community) + _tlv(RESPONSE, pdu))
+
+
+class TrafficModel:
+    """Deterministic traffic of one interface direction
+
+    The rate follows a daily sine plus a faster burst sine around ``mean_bps``
+    and never drops below zero, so the octet counter, which is the closed-form
+    integral of the rate, only ever increases.
+    """
+
+    def __init__(self, rng, speed_bps):
+        self.daily = rng.uniform(0.1, 0.5)
+        self.burst = rng.uniform(0.0, 0.3)
+        self.burst_period = rng.uniform(300, 1800)
+        self.phase = rng.uniform(0, 2 * math.pi)
+        # Most ports are nearly idle, a few are busy uplinks
+        if rng.random() < 0.8:
+            peak = rng.uniform(0.001, 0.1)
+        else:
+            peak = rng.uniform(0.3, 0.95)
+        self.mean_bps = speed_bps * peak / (1 + self.daily + self.burst)
+        self.offset = rng.randrange(2 ** 40)
+
+    def octets(self, elapsed):
+        """Octets sent after ``elapsed`` seconds"""
+        bits = self.mean_bps * elapsed
+        for amplitude, period in ((self.daily, 86400.0), (self.burst, self.burst_period)):
+            omega = 2 * math.pi / period
+            bits -= self.mean_bps * amplitude / omega * (
+                math.cos(omega * elapsed + self.phase) - math.cos(self.phase)
+            )
+        return self.offset + int(bits / 8)
+
+
+class VirtualDevice:
+    """An agent answering for one inventory device
+
+    ``interfaces`` is a list of ``(ifname, speed_mbps)``; ifIndex follows the
+    list order. All randomness is seeded from ``device_id`` and counters are
+    computed from wall clock time, so several simulator processes sharing a
+    port give the same answers.
+    """
+
+    def __init__(self, device_id, name, interfaces, started):
+        rng = random.Random(device_id)
+        self.name = name
+        self.started = started
+        self.boot = started - rng.uniform(0, 30 * 86400)
+        self._values = {
+            _oid(SYS_DESCR_OID): lambda now: (OCTET_STRING, b'Simulated router'),
+            _oid(SYS_UPTIME_OID): lambda now: (TIMETICKS, int((now - self.boot) * 100) % 2 ** 32),
+            _oid(SYS_NAME_OID): lambda now: (OCTET_STRING, name.encode()),
+            _oid(IF_NUMBER_OID): lambda now, count=len(interfaces): (INTEGER, count),
+        }
+        columns = dict(IF_TABLE_COLUMNS, **IF_EXTRA_COLUMNS)
+        for if_index, (ifname, speed_mbps) in enumerate(interfaces, 1):
+            traffic_in = TrafficModel(rng, speed_mbps * 1000000)
+            traffic_out = TrafficModel(rng, speed_mbps * 1000000)
+            packet_size = rng.uniform(300, 1200)
+            error_ratio = rng.uniform(1e-9, 1e-7)
+            for column, oid in columns.items():
+                self._values[_oid(oid) + (if_index,)] = self._column(
+                    column, if_index, ifname, speed_mbps, traffic_in, traffic_out,
+                    packet_size, error_ratio
+                )
+        self.oids = sorted(self._values)
+
+    def _column(self, column, if_index, ifname, speed_mbps, traffic_in, traffic_out,
+                packet_size, error_ratio):
+        """Return the value function of one ifTable/ifXTable cell"""
+        if column in ('ifDescr', 'ifName'):
+            return lambda now: (OCTET_STRING, ifname.encode())
+        if column == 'ifIndex':
+            return lambda now: (INTEGER, if_index)
+        if column == 'ifOperStatus':
+            return lambda now: (INTEGER, 1)
+        if column == 'ifSpeed':
+            return lambda now: (GAUGE32, min(speed_mbps * 1000000, 2 ** 32 - 1))
+        if column == 'ifHighSpeed':
+            return lambda now: (GAUGE32, speed_mbps)
+
+        traffic = traffic_in if 'In' in column else traffic_out
+        if column.startswith('ifHC'):
+            tag, modulo = COUNTER64, 2 ** 64
+        else:
+            tag, modulo = COUNTER32, 2 ** 32
+        if column.endswith('Octets'):
+            scale = 1.0
+        elif column.endswith('Pkts'):
+            scale = 1.0 / packet_size
+        else:
+            scale = error_ratio
+        return lambda now: (tag, int(traffic.octets(now - self.started) * scale) % modulo)
+
+    def _var_bind(self, oid, now):
+        value = self._values.get(oid)
+        if value is None:
+            encoded = _tlv(NO_SUCH_OBJECT, b'')
+        else:
+            tag, value = value(now)
+            if tag == OCTET_STRING:
+                encoded = _tlv(tag, value)
+            elif tag == INTEGER:
+                encoded = _encode_integer(value)
+            else:
+                encoded = _encode_unsigned(tag, value)
+        return _encode_oid(oid) + encoded
+
+    def _next(self, oid, now):
+        """Return (next oid, encoded var bind), or (None, endOfMibView var bind)"""
+        index = bisect.bisect_right(self.oids, oid)
+        if index >= len(self.oids):
+            return None, _tlv(SEQUENCE, _encode_oid(oid) + _tlv(END_OF_MIB_VIEW, b''))
+        next_oid = self.oids[index]
+        return next_oid, _tlv(SEQUENCE, self._var_bind(next_oid, now))
+
+    def get(self, oids, now):
+        return [_tlv(SEQUENCE, self._var_bind(oid, now)) for oid in oids]
+
+    def get_next(self, oids, now):
+        return [self._next(oid, now)[1] for oid in oids]
+
+    def get_bulk(self, oids, non_repeaters, max_repetitions, now):
+        """GETBULK as in RFC 3416, truncated to whole rows that fit in one datagram"""
+        non_repeaters = max(0, min(non_repeaters, len(oids)))
+        var_binds = self.get_next(oids[:non_repeaters], now)
+        size = sum(len(var_bind) for var_bind in var_binds)
+        cursors = list(oids[non_repeaters:])
+        for _ in range(max(0, max_repetitions)):
+            if not cursors:
+                break
+            row = []
+            ended = 0
+            for position, cursor in enumerate(cursors):
+                next_oid, var_bind = self._next(cursor, now)
+                if next_oid is None:
+                    ended += 1
+                else:
+                    cursors[position] = next_oid
+                row.append(var_bind)
+            row_size = sum(len(var_bind) for var_bind in row)
+            if var_binds and size + row_size > MAX_RESPONSE_BYTES:
+                break
+            var_binds.extend(row)
+            size += row_size
+            if ended == len(cursors):
+                break
+        return var_binds
+
+
+class SimulatorProtocol(asyncio.DatagramProtocol):
+    """Answers SNMPv2c requests for virtual devices selected by community string
+
+    Requests with an unknown community are dropped, like a real agent would,
+    so they time out on the collector side.
+    """
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.transport = None
+        self.requests = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.requests += 1
+        try:
+            response = self.handle(data, time.time())
+        except (ValueError, IndexError):
+            response = None
+        if response is None:
+            self.dropped += 1
+            return
+        self.transport.sendto(response, addr)
+
+    def handle(self, data, now):
+        """Return the encoded response to one request, or None to stay silent"""
+        community, pdu_type, request_id, field1, field2, oids = decode_request(data)
+        device = self.devices.get(community)
+        if device is None:
+            return None
+        if pdu_type == GET_REQUEST:
+            var_binds = device.get(oids, now)
+        elif pdu_type == GET_NEXT_REQUEST:
+            var_binds = device.get_next(oids, now)
+        elif pdu_type == GET_BULK_REQUEST:
+            var_binds = device.get_bulk(oids, field1, field2, now)
+        else:
+            return None
+        return encode_response(community, request_id, var_binds)
+
+
+def speed_from_ifname(ifname):
+    """Guess a link speed in Mbps from an interface name"""
+    for prefix, speed in SPEEDS_BY_PREFIX:
+        if ifname.startswith(prefix):
+            return speed
+    return 100
+
+
+def build_devices(inventory, started=None):
+    """Build {community: VirtualDevice} from ``(device_id, name, community, interfaces)`` tuples
+
+    ``interfaces`` is a list of ``(ifname, bandwidth_kbps)``; bandwidth may be
+    None, in which case the speed is guessed from the name.
+    """
+    started = started or time.time()
+    devices = {}
+    for device_id, name, community, interfaces in inventory:
+        key = community.encode()
+        if key in devices:
+            log.warning("Community of device %s is already used by %s, skipping it",
+                        name, devices[key].name)
+            continue
+        devices[key] = VirtualDevice(device_id, name, [
+            (ifname, bandwidth // 1000 if bandwidth else speed_from_ifname(ifname))
+            for ifname, bandwidth in interfaces
+        ], started)
+    return devices
+
+
+def load_inventory():
+    """Read the SNMP-enabled devices and their interfaces from the database"""
+    from . import db
+    from .models import Device, Interface, SNMP
+    from .utils import decrypt_sensitive_data
+
+    rows = db.session.query(Device.id, Device.ip, SNMP.comm_key).join(
+        SNMP, Device.snmp_id == SNMP.id
+    ).filter(SNMP.status == 1).order_by(Device.id).all()
+    interfaces = {}
+    for device_id, ifname, bandwidth in db.session.query(
+        Interface.device_id, Interface.ifname, Interface.bandwidth
+    ).order_by(Interface.id):
+        interfaces.setdefault(device_id, []).append((ifname, bandwidth))
+    inventory = [
+        (device_id, ip, decrypt_sensitive_data(comm_key), interfaces.get(device_id, []))
+        for device_id, ip, comm_key in rows
+    ]
+    db.session.remove()
+    return inventory
+
+
+def serve(devices, host='127.0.0.1', port=1161, reuse_port=False, report_interval=10):
+    """Run the simulator on one UDP socket until SIGINT/SIGTERM"""
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: SimulatorProtocol(devices), local_addr=(host, port), reuse_port=reuse_port
+        )
+        last = 0
+        try:
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=report_interval)
+                except asyncio.TimeoutError:
+                    pass
+                log.info("SNMP simulator: %d requests (%.0f/s), %d dropped",
+                         protocol.requests, (protocol.requests - last) / report_interval,
+                         protocol.dropped)
+                last = protocol.requests
+        finally:
+            transport.close()
+
+    asyncio.run(main())
+
+
+def serve_in_processes(devices, host='127.0.0.1', port=1161, processes=1):
+    """Serve the same devices from several processes sharing the port with SO_REUSEPORT"""
+    if processes <= 1:
+        serve(devices, host, port)
+        return
+    context = multiprocessing.get_context('fork')
+    workers = [
+        context.Process(target=serve, args=(devices, host, port, True), name=f"snmpsim-{index}")
+        for index in range(processes)
+    ]
+
+    def stop_workers(*args):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,232 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+
+log = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.jsonl'
+LOCK_FILE = '.lock'
+QUARANTINE_DIR = 'quarantine'
+
+
+class SpoolLocked(Exception):
+    """Raised when another process already owns a spool directory"""
+
+
+class SegmentRejected(Exception):
+    """Raised by a replay callback when the rows of a segment can never be written"""
+
+
+def _encode(rows):
+    """Serialize a batch of sample rows to one line"""
+    return json.dumps([
+        dict(row, timestamp=row['timestamp'].isoformat()) if isinstance(row.get('timestamp'), datetime)
+        else row
+        for row in rows
+    ], separators=(',', ':')) + '\n'
+
+
+def _decode(line):
+    """Turn a spooled line back into sample rows"""
+    rows = json.loads(line)
+    for row in rows:
+        if isinstance(row.get('timestamp'), str):
+            row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+    return rows
+
+
+class Spool:
+    """Append-only on-disk queue of bandwidth sample batches
+
+    Batches are appended as JSON lines to numbered segment files in
+    ``directory``. A segment is closed once it grows past ``segment_bytes``.
+    Appends are flushed to the OS right away but only fsynced every
+    ``fsync_interval`` seconds, so a burst of failed inserts costs one fsync
+    instead of one per batch. A torn last line left by a crash is skipped on
+    replay.
+
+    replay() hands one whole segment at a time to a callback and deletes the
+    segment only if the callback succeeded, so samples are never lost and a
+    segment is never half replayed. A segment the callback rejects for good
+    is moved to the ``quarantine`` subdirectory for inspection, so it does
+    not hold up the segments behind it.
+
+    A spool belongs to one process at a time, enforced with an flock on its
+    directory; spools left behind by dead processes can be picked up with
+    orphaned_spools().
+    """
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._file = None
+        self._last_sync = time.monotonic()
+        self._unsynced = False
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise SpoolLocked(directory)
+        segments = self._segments()
+        self._next_seq = self._seq(segments[-1]) + 1 if segments else 1
+
+    def _segments(self):
+        """Segment file names in append order"""
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+
+    @staticmethod
+    def _seq(name):
+        return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def _open_segment(self):
+        name = f"{SEGMENT_PREFIX}{self._next_seq:012d}{SEGMENT_SUFFIX}"
+        self._next_seq += 1
+        self._file = open(os.path.join(self.directory, name), 'a', encoding='utf-8')
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        self._unsynced = False
+        self._last_sync = time.monotonic()
+
+    def append(self, rows):
+        """Append one batch of rows"""
+        if not rows:
+            return
+        line = _encode(rows)
+        with self._lock:
+            if self._file is None:
+                self._open_segment()
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced = True
+            if self._file.tell() >= self.segment_bytes:
+                self._close_segment()
+            elif time.monotonic() - self._last_sync >= self.fsync_interval:
+                self.sync()
+
+    def sync(self):
+        """fsync the open segment if it has unsynced appends"""
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = False
+            self._last_sync = time.monotonic()
+
+    def maybe_sync(self):
+        """fsync if the last sync is older than fsync_interval"""
+        with self._lock:
+            if self._unsynced and time.monotonic() - self._last_sync >= self.fsync_interval:
+                self.sync()
+
+    def pending(self):
+        """Return (segments, bytes) waiting to be replayed"""
+        with self._lock:
+            segments = self._segments()
+            size = sum(os.path.getsize(os.path.join(self.directory, name)) for name in segments)
+        return len(segments), size
+
+    def replay(self, write):
+        """Feed spooled rows to ``write(rows)`` segment by segment, oldest first
+
+        ``write`` must return True once the rows are stored. Replay stops at the
+        first segment that could not be written, unless ``write`` raised
+        SegmentRejected: that segment is quarantined and replay goes on.
+        Returns the number of rows replayed.
+        """
+        with self._lock:
+            self._close_segment()
+            segments = self._segments()
+
+        replayed = 0
+        for name in segments:
+            path = os.path.join(self.directory, name)
+            rows = []
+            with open(path, encoding='utf-8') as segment:
+                for number, line in enumerate(segment, 1):
+                    try:
+                        rows.extend(_decode(line))
+                    except ValueError:
+                        log.warning("Skipping corrupt line %d in spool segment %s", number, name)
+            try:
+                if rows and not write(rows):
+                    break
+            except SegmentRejected as e:
+                self.quarantine(name, e)
+                continue
+            os.remove(path)
+            replayed += len(rows)
+        return replayed
+
+    def quarantine(self, name, reason):
+        """Move a segment out of the replay queue into the quarantine subdirectory"""
+        directory = os.path.join(self.directory, QUARANTINE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        os.replace(os.path.join(self.directory, name), os.path.join(directory, name))
+        log.error("Quarantined spool segment %s in %s: %s", name, directory, reason)
+
+    def close(self):
+        """Close the open segment, making sure it is on disk, and release the directory
+
+        The directory is removed when nothing is left to replay.
+        """
+        with self._lock:
+            self._close_segment()
+            if self._lock_file.closed:
+                return
+            empty = not self._segments()
+            if empty:
+                os.remove(self._lock_file.name)
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            if empty:
+                try:
+                    os.rmdir(self.directory)
+                except OSError:
+                    pass
+
+
+def orphaned_spools(root, **options):
+    """Open the spools under ``root`` that no running process owns"""
+    spools = []
+    if not os.path.isdir(root):
+        return spools
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if not os.path.isdir(path):
+            continue
+        try:
+            spools.append(Spool(path, **options))
+        except SpoolLocked:
+            continue
+    return spools
+
+
+def open_spool(name):
+    """Open the spool of this process under SPOOL_DIR, or None when spooling is disabled"""
+    config = current_app.config
+    root = config.get('SPOOL_DIR')
+    if not root:
+        return None
+    return Spool(
+        os.path.join(root, name),
+        segment_bytes=config.get('SPOOL_SEGMENT_BYTES', 4 * 1024 * 1024),
+        fsync_interval=config.get('SPOOL_FSYNC_INTERVAL', 1.0)
+    )
@@ -0,0 +1,496 @@
+import importlib
+import logging
+from abc import ABC, abstractmethod
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import BigInteger, String, func, select, true, type_coerce
+
+from . import db
+from .models import BandwidthStat, BandwidthRollup, BandwidthArchiveBlock, InterfaceCurrent, EpochDateTime
+from .archive import (
+    VALUE_COLUMNS, archived_rows, read_archive_many, rows_to_arrays, empty_arrays, day_start, to_micros,
+    from_micros
+)
+from .rollups import (
+    update_rollups, rollup_history_query, rollup_history_batch_query, rollups_from_samples, bucket_start
+)
+from .current import update_current_state, SAMPLE_FIELDS
+from .rates import COUNTER_FIELDS
+from .partitions import partition_period, drop_expired_partitions, unpartitioned_stats_tables
+
+log = logging.getLogger(__name__)
+
+ROLLUP_FIELDS = (
+    'bucket', 'samples', 'input_rate_avg', 'output_rate_avg', 'input_packets', 'output_packets',
+    'input_errors', 'output_errors', 'input_rate_min', 'input_rate_max', 'input_rate_p95',
+    'output_rate_min', 'output_rate_max', 'output_rate_p95'
+)
+
+# Interfaces per query of the batch reads, well below the bound parameter limits
+BATCH_INTERFACES = 500
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+class StorageBackend(ABC):
+    """Where bandwidth samples are written to and read back from
+
+    Rows going in are dicts keyed by BandwidthStat column names. Samples come
+    back as dicts with a datetime ``timestamp`` and the VALUE_COLUMNS, oldest
+    first; aggregates as dicts keyed like BandwidthRollup columns. The fleet
+    overview in interface_current_tbl stays in the relational database
+    whatever the backend. Subclasses implement the abstract methods, so an
+    incomplete ``module:Class`` backend fails when it is created.
+    """
+
+    name = None
+
+    @abstractmethod
+    def write_batch(self, rows):
+        """Store sample rows atomically where the backend allows; returns the number stored"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_range(self, interface_id, since, until=None):
+        """Samples with rates of an interface in [since, until)"""
+        raise NotImplementedError
+
+    def read_columns(self, interface_id, since, until=None):
+        """The samples of read_range() as ``(timestamps, columns)`` without building a dict per row
+
+        Timestamps are int64 epoch microseconds and columns map VALUE_COLUMNS
+        to float64 arrays with NaN for NULL, as returned by read_archive().
+        """
+        return rows_to_arrays(self.read_range(interface_id, since, until))
+
+    def read_columns_many(self, interface_ids, since, until=None):
+        """{interface_id: (timestamps, columns)} of read_columns() for every one of ``interface_ids``"""
+        return {interface_id: self.read_columns(interface_id, since, until) for interface_id in interface_ids}
+
+    @abstractmethod
+    def aggregate(self, interface_id, resolution, since):
+        """Rollup rows of an interface at ``resolution`` seconds from the bucket holding ``since`` on"""
+        raise NotImplementedError
+
+    def aggregate_many(self, interface_ids, resolution, since):
+        """{interface_id: rollup rows} of aggregate() for every one of ``interface_ids``"""
+        return {interface_id: self.aggregate(interface_id, resolution, since) for interface_id in interface_ids}
+
+    @abstractmethod
+    def latest(self, interface_ids):
+        """{interface_id: row} of the newest sample with counters of each interface"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def oldest(self, interface_ids):
+        """A time no later than the oldest sample of any of ``interface_ids``, None when there is none
+
+        Backends may round down, e.g. to the day of the oldest sample.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def expire(self, cutoff, chunk_size=5000, pause=0.0, stop=None):
+        """Delete samples older than ``cutoff``; returns the number deleted"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self):
+        """Remove all samples, e.g. before the interfaces are deleted"""
+        raise NotImplementedError
+
+
+def bandwidth_history_query(interface_id, since):
+    """Query the samples of an interface since a point in time, oldest first"""
+    return db.session.query(BandwidthStat).filter(
+        BandwidthStat.interface_id == interface_id,
+        BandwidthStat.timestamp >= since,
+        BandwidthStat.input_rate_kbps.isnot(None)
+    ).order_by(BandwidthStat.timestamp)
+
+
+def history_columns_query(interface_ids, since, until=None, dialect='sqlite'):
+    """Select the samples of several interfaces as interface id, timestamp and VALUE_COLUMNS rows
+
+    Ordered by interface and time, which ix_bandwidth_stats_interface_timestamp
+    serves without a sort. ``dialect`` is the name of the database dialect.
+    Timestamps come as stored, for history_micros() to convert.
+    """
+    stats = BandwidthStat.__table__
+    timestamp = stats.c.timestamp
+    if isinstance(timestamp.type, EpochDateTime):
+        timestamp = type_coerce(timestamp, BigInteger)
+    elif dialect == 'sqlite':
+        # SQLite keeps DateTime as ISO text, which NumPy parses in one go
+        timestamp = type_coerce(timestamp, String)
+    query = select(stats.c.interface_id, timestamp, *[stats.c[name] for name in VALUE_COLUMNS]).where(
+        stats.c.interface_id.in_(interface_ids),
+        stats.c.timestamp >= since,
+        stats.c.input_rate_kbps.isnot(None)
+    ).order_by(stats.c.interface_id, stats.c.timestamp)
+    if until is not None:
+        query = query.where(stats.c.timestamp < until)
+    return query
+
+
+def history_micros(timestamps):
+    """Epoch microseconds of the timestamps history_columns_query() selected, as an int64 array"""
+    column_type = BandwidthStat.__table__.c.timestamp.type
+    if isinstance(column_type, EpochDateTime):
+        return np.array(timestamps, dtype=np.int64) * column_type.micros
+    return np.array(timestamps, dtype='datetime64[us]').astype(np.int64)
+
+
+def rollup_columns_query(session, interface_ids, resolution, since):
+    """Query the rollups of several interfaces as interface id and ROLLUP_FIELDS rows, grouped by interface"""
+    return rollup_history_batch_query(session, interface_ids, resolution, since).with_entities(
+        BandwidthRollup.interface_id, *[getattr(BandwidthRollup, field) for field in ROLLUP_FIELDS]
+    )
+
+
+class SQLStorage(StorageBackend):
+    """Samples in bandwidth_stats_tbl, rolled up on insert, partitioned and archived as configured"""
+
+    name = 'sql'
+
+    def __init__(self, engine=None):
+        self._engine = engine
+
+    @property
+    def engine(self):
+        return self._engine or db.engine
+
+    def write_batch(self, rows):
+        """Insert with one executemany and update rollups and current state in the same transaction"""
+        with self.engine.begin() as conn:
+            conn.execute(BandwidthStat.__table__.insert(), rows)
+            update_rollups(conn, rows)
+            update_current_state(conn, rows)
+        return len(rows)
+
+    def read_range(self, interface_id, since, until=None):
+        # Archived samples are older than anything left in the hot table
+        rows = archived_rows(db.session, interface_id, since, until)
+        query = bandwidth_history_query(interface_id, since)
+        if until is not None:
+            query = query.filter(BandwidthStat.timestamp < until)
+        rows.extend(
+            dict({field: getattr(stat, field) for field in VALUE_COLUMNS},
+                 interface_id=interface_id, timestamp=stat.timestamp)
+            for stat in query.all()
+        )
+        return rows
+
+    def read_columns(self, interface_id, since, until=None):
+        return self.read_columns_many([interface_id], since, until)[interface_id]
+
+    def read_columns_many(self, interface_ids, since, until=None):
+        """Archive blocks and hot samples of up to BATCH_INTERFACES interfaces per query, grouped in one pass"""
+        samples = {}
+        for start in range(0, len(interface_ids), BATCH_INTERFACES):
+            batch = interface_ids[start:start + BATCH_INTERFACES]
+            archived = read_archive_many(db.session, batch, since, until)
+            query = history_columns_query(batch, since, until, db.engine.dialect.name)
+            for interface_id, rows in groupby(db.session.execute(query), key=itemgetter(0)):
+                hot = list(zip(*rows))
+                timestamps, columns = archived.get(interface_id) or empty_arrays()
+                timestamps = np.concatenate([timestamps, history_micros(hot[1])])
+                samples[interface_id] = timestamps, {
+                    name: np.concatenate([columns[name], np.array(hot[index], dtype=np.float64)])
+                    for index, name in enumerate(VALUE_COLUMNS, 2)
+                }
+            for interface_id in batch:
+                if interface_id not in samples:
+                    samples[interface_id] = archived.get(interface_id) or empty_arrays()
+        return samples
+
+    def aggregate(self, interface_id, resolution, since):
+        return [
+            {field: getattr(rollup, field) for field in ROLLUP_FIELDS}
+            for rollup in rollup_history_query(db.session, interface_id, resolution, since).all()
+        ]
+
+    def aggregate_many(self, interface_ids, resolution, since):
+        rollups = {interface_id: [] for interface_id in interface_ids}
+        for start in range(0, len(interface_ids), BATCH_INTERFACES):
+            query = rollup_columns_query(db.session, interface_ids[start:start + BATCH_INTERFACES], resolution, since)
+            for row in query:
+                rollups[row[0]].append(dict(zip(ROLLUP_FIELDS, row[1:])))
+        return rollups
+
+    def latest(self, interface_ids):
+        """Counters from interface_current_tbl, falling back to the history for interfaces missing there"""
+        fields = SAMPLE_FIELDS + ('interface_id',)
+        latest = {
+            current.interface_id: {field: getattr(current, field) for field in fields}
+            for current in db.session.query(InterfaceCurrent).filter(
+                InterfaceCurrent.interface_id.in_(interface_ids),
+                InterfaceCurrent.input_octets_counter.isnot(None)
+            )
+        }
+        missing = set(interface_ids) - set(latest)
+        if missing:
+            latest_ids = select(func.max(BandwidthStat.id)).where(
+                BandwidthStat.interface_id.in_(missing),
+                BandwidthStat.input_octets_counter.isnot(None)
+            ).group_by(BandwidthStat.interface_id)
+            for stat in db.session.query(BandwidthStat).filter(BandwidthStat.id.in_(latest_ids)):
+                latest[stat.interface_id] = {field: getattr(stat, field) for field in fields}
+        return latest
+
+    def oldest(self, interface_ids):
+        """The first archived day, else the oldest hot sample; archived samples are older than any hot one"""
+        blocks = BandwidthArchiveBlock.__table__
+        stats = BandwidthStat.__table__
+        oldest = None
+        for start in range(0, len(interface_ids), BATCH_INTERFACES):
+            batch = interface_ids[start:start + BATCH_INTERFACES]
+            first = db.session.execute(
+                select(func.min(blocks.c.day)).where(blocks.c.interface_id.in_(batch))
+            ).scalar() or db.session.execute(
+                select(func.min(stats.c.timestamp)).where(stats.c.interface_id.in_(batch))
+            ).scalar()
+            if first is not None and (oldest is None or first < oldest):
+                oldest = first
+        return oldest
+
+    def expire(self, cutoff, chunk_size=5000, pause=0.0, stop=None):
+        """Drop whole partitions past ``cutoff`` and delete older rows outside them in chunks"""
+        from .retention import prune_table
+
+        deleted = drop_expired_partitions(cutoff) if partition_period() is not None else 0
+        for stats in unpartitioned_stats_tables():
+            deleted += prune_table(stats, true(), stats.c.timestamp < cutoff, chunk_size, pause, stop)
+        return deleted
+
+    def clear(self):
+        for model in (BandwidthRollup, BandwidthArchiveBlock, InterfaceCurrent, BandwidthStat):
+            db.session.query(model).delete()
+
+
+# Fixed-width sample records of the file backend; NULL is NaN for rates and
+# NULL_COUNTER / -1 for counters and uptime
+FILE_DTYPE = np.dtype(
+    [('timestamp', '<i8')]
+    + [(name, '<f8') for name in VALUE_COLUMNS]
+    + [(name, '<u8') for name in COUNTER_FIELDS]
+    + [('counter_bits', '<u1'), ('sys_uptime', '<i8')]
+)
+NULL_COUNTER = np.iinfo(np.uint64).max
+FILE_SUFFIX = '.bin'
+
+
+def _load(path):
+    """Records of a day file, ignoring a torn record at the end of a file being appended to"""
+    return np.fromfile(path, dtype=FILE_DTYPE, count=os.path.getsize(path) // FILE_DTYPE.itemsize)
+
+
+class FileStorage(StorageBackend):
+    """Embedded time-series store: one append-only file per interface and UTC day
+
+    Samples live in ``directory``/<interface id>/<YYYYMMDD>.bin as packed
+    FILE_DTYPE records and are read back with NumPy. Each batch is appended
+    with one write() per file, so concurrent collector processes never
+    interleave records. Retention deletes whole day files. Aggregates are
+    computed from the samples when they are read, so RETENTION_RAW_DAYS also
+    bounds how far back history goes. Writes are not fsynced; a crash can
+    lose the samples still in the OS page cache.
+    """
+
+    name = 'file'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _interface_dir(self, interface_id):
+        return os.path.join(self.directory, str(int(interface_id)))
+
+    def _day_files(self, interface_id, since=None, until=None):
+        """(day, path) of the files of an interface overlapping [since, until), oldest first"""
+        directory = self._interface_dir(interface_id)
+        try:
+            names = sorted(os.listdir(directory))
+        except FileNotFoundError:
+            return []
+        first = since and day_start(since).strftime('%Y%m%d')
+        files = []
+        for name in names:
+            if not name.endswith(FILE_SUFFIX):
+                continue
+            stamp = name[:-len(FILE_SUFFIX)]
+            if (first and stamp < first) or (until is not None and stamp > until.strftime('%Y%m%d')):
+                continue
+            files.append((datetime.strptime(stamp, '%Y%m%d'), os.path.join(directory, name)))
+        return files
+
+    def _records(self, rows):
+        records = np.zeros(len(rows), dtype=FILE_DTYPE)
+        records['timestamp'] = [to_micros(row['timestamp']) for row in rows]
+        for name in VALUE_COLUMNS:
+            records[name] = [np.nan if row.get(name) is None else row[name] for row in rows]
+        for name in COUNTER_FIELDS:
+            records[name] = [NULL_COUNTER if row.get(name) is None else row[name] for row in rows]
+        records['counter_bits'] = [row.get('counter_bits') or 0 for row in rows]
+        records['sys_uptime'] = [-1 if row.get('sys_uptime') is None else row['sys_uptime'] for row in rows]
+        return records
+
+    def _rows(self, interface_id, records):
+        rows = []
+        for record in records.tolist():
+            row = {'interface_id': interface_id, 'timestamp': from_micros(record[0])}
+            for index, name in enumerate(VALUE_COLUMNS, 1):
+                row[name] = None if record[index] != record[index] else record[index]
+            offset = len(VALUE_COLUMNS) + 1
+            for index, name in enumerate(COUNTER_FIELDS, offset):
+                row[name] = None if record[index] == NULL_COUNTER else record[index]
+            row['counter_bits'] = record[-2] or None
+            row['sys_uptime'] = None if record[-1] < 0 else record[-1]
+            rows.append(row)
+        return rows
+
+    def write_batch(self, rows):
+        """Append rows to their day files, then upsert interface_current_tbl
+
+        Once appended the rows are stored, so a failed upsert is only logged:
+        raising would make BatchWriter spool and append them a second time.
+        interface_current_tbl catches up with the next batch.
+        """
+        files = {}
+        for row in rows:
+            files.setdefault((row['interface_id'], day_start(row['timestamp'])), []).append(row)
+        for (interface_id, day), file_rows in files.items():
+            directory = self._interface_dir(interface_id)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, day.strftime('%Y%m%d') + FILE_SUFFIX)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, self._records(file_rows).tobytes())
+            finally:
+                os.close(fd)
+        try:
+            with db.engine.begin() as conn:
+                update_current_state(conn, rows)
+        except Exception as e:
+            log.warning("Stored %d bandwidth samples but could not update their current state: %s",
+                        len(rows), getattr(e, 'orig', e))
+        return len(rows)
+
+    def _read(self, interface_id, since=None, until=None):
+        """Records of an interface in [since, until) in timestamp order, one per timestamp
+
+        A batch replayed after a partial append leaves duplicate records;
+        the first of each timestamp is kept.
+        """
+        parts = [_load(path) for _, path in self._day_files(interface_id, since, until)]
+        if not parts:
+            return np.empty(0, dtype=FILE_DTYPE)
+        records = np.concatenate(parts)
+        keep = np.ones(len(records), dtype=bool)
+        if since is not None:
+            keep &= records['timestamp'] >= to_micros(since)
+        if until is not None:
+            keep &= records['timestamp'] < to_micros(until)
+        records = records[keep]
+        records = records[np.argsort(records['timestamp'], kind='stable')]
+        first = np.ones(len(records), dtype=bool)
+        first[1:] = records['timestamp'][1:] != records['timestamp'][:-1]
+        return records[first]
+
+    def read_range(self, interface_id, since, until=None):
+        records = self._read(interface_id, since, until)
+        records = records[~np.isnan(records['input_rate_kbps'])]
+        return [
+            {field: row[field] for field in ('interface_id', 'timestamp') + VALUE_COLUMNS}
+            for row in self._rows(interface_id, records)
+        ]
+
+    def read_columns(self, interface_id, since, until=None):
+        records = self._read(interface_id, since, until)
+        records = records[~np.isnan(records['input_rate_kbps'])]
+        return records['timestamp'].copy(), {name: records[name].copy() for name in VALUE_COLUMNS}
+
+    def aggregate(self, interface_id, resolution, since):
+        return [
+            {field: rollup[field] for field in ROLLUP_FIELDS}
+            for rollup in rollups_from_samples(
+                self.read_range(interface_id, bucket_start(since, resolution)), resolution
+            )
+        ]
+
+    def latest(self, interface_ids):
+        latest = {}
+        for interface_id in interface_ids:
+            for _, path in reversed(self._day_files(interface_id)):
+                records = _load(path)
+                records = records[records['input_octets_counter'] != NULL_COUNTER]
+                if len(records):
+                    newest = records[np.argmax(records['timestamp'])]
+                    latest[interface_id] = self._rows(interface_id, newest.reshape(1))[0]
+                    break
+        return latest
+
+    def oldest(self, interface_ids):
+        """The day of the oldest day file"""
+        days = [files[0][0] for files in map(self._day_files, interface_ids) if files]
+        return min(days) if days else None
+
+    def expire(self, cutoff, chunk_size=5000, pause=0.0, stop=None):
+        """Delete the day files that ended before ``cutoff``"""
+        last_day = (day_start(cutoff) - timedelta(days=1)).strftime('%Y%m%d')
+        deleted = 0
+        for name in os.listdir(self.directory):
+            if stop is not None and stop():
+                break
+            if not name.isdigit():
+                continue
+            for day, path in self._day_files(int(name)):
+                if day.strftime('%Y%m%d') > last_day:
+                    break
+                deleted += os.path.getsize(path) // FILE_DTYPE.itemsize
+                os.remove(path)
+            if pause:
+                time.sleep(pause)
+        return deleted
+
+    def clear(self):
+        db.session.query(InterfaceCurrent).delete()
+        for name in os.listdir(self.directory):
+            if name.isdigit():
+                shutil.rmtree(os.path.join(self.directory, name))
+
+
+BACKENDS = {'sql': SQLStorage, 'file': FileStorage}
+
+
+def create_storage(config):
+    """Build the STATS_BACKEND backend: 'sql', 'file' or a 'package.module:Class' import path"""
+    name = config.get('STATS_BACKEND') or 'sql'
+    if name == 'sql':
+        return SQLStorage()
+    if name == 'file':
+        return FileStorage(config['STATS_FILE_DIR'])
+    if ':' not in name:
+        raise ValueError(f"Unknown STATS_BACKEND {name!r}; use 'sql', 'file' or 'module:Class'")
+    module, cls = name.split(':', 1)
+    return getattr(importlib.import_module(module), cls)(config)
+
+
+def get_storage():
+    """The storage backend of the current app, created once per process"""
+    config = current_app.config
+    key = (config.get('STATS_BACKEND'), config.get('STATS_FILE_DIR'))
+    with _backends_lock:
+        storage = _backends.get(key)
+        if storage is None:
+            storage = _backends[key] = create_storage(config)
+    return storage
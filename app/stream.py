@@ -0,0 +1,210 @@
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import select
+
+from . import db
+from .archive import VALUE_COLUMNS, to_micros
+from .metrics import STREAM_CLIENTS, STREAM_SAMPLES
+from .models import InterfaceCurrent
+from .ringbuffer import open_ring_buffer
+from .storage import BATCH_INTERFACES
+from .utils import HISTORY_INT_FIELDS, format_history_timestamps
+
+log = logging.getLogger(__name__)
+
+# Milliseconds a browser waits before reconnecting a dropped stream
+RETRY_MILLISECONDS = 5000
+
+_hubs = {}
+_hubs_lock = threading.Lock()
+
+
+class Subscription:
+    """The interfaces one stream client follows and the samples it has not taken yet
+
+    At most one sample per interface is pending: a newer one replaces a
+    sample the client has not taken, so a slow consumer skips intermediate
+    samples instead of queueing them and its memory stays bounded by the
+    number of interfaces it follows.
+    """
+
+    def __init__(self, interface_ids):
+        self.interface_ids = frozenset(interface_ids)
+        self.fresh = True
+        self.dropped = 0
+        self._pending = {}
+        self._ready = threading.Condition()
+
+    def put(self, sample):
+        with self._ready:
+            if sample['interface_id'] in self._pending:
+                self.dropped += 1
+                STREAM_SAMPLES.inc(result='dropped')
+            self._pending[sample['interface_id']] = sample
+            self._ready.notify()
+
+    def get(self, timeout):
+        """Take the pending samples oldest first, waiting up to ``timeout`` seconds for one
+
+        Returns an empty list when none arrived in time.
+        """
+        with self._ready:
+            if not self._pending:
+                self._ready.wait(timeout)
+            samples, self._pending = list(self._pending.values()), {}
+        STREAM_SAMPLES.inc(len(samples), result='sent')
+        return sorted(samples, key=lambda sample: sample['timestamp'])
+
+
+class SampleHub:
+    """Fans the newest sample of every interface out to the stream clients of this process
+
+    One watcher thread wakes every ``interval`` seconds and reads the
+    newest sample of all interfaces followed by any client from
+    interface_current_tbl, or from the ring buffer the collectors append to
+    when RING_BUFFER_PATH is set and it holds a newer one. Each read serves
+    every client, so viewers add no database load; a sample is
+    handed on only when its timestamp changed, while new clients first get
+    the current sample of each of their interfaces. The thread runs only
+    while clients are connected.
+    """
+
+    def __init__(self, app, interval=1.0):
+        self.app = app
+        self.interval = interval
+        self._subscriptions = set()
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, interface_ids):
+        """Follow interfaces; returns the Subscription to take their samples from"""
+        subscription = Subscription(interface_ids)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            STREAM_CLIENTS.set(len(self._subscriptions))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sample-hub', daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            STREAM_CLIENTS.set(len(self._subscriptions))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                subscriptions = list(self._subscriptions)
+                if not subscriptions:
+                    self._thread = None
+                    self._seen = {}
+                    return
+            try:
+                with self.app.app_context():
+                    self.publish(subscriptions)
+            except Exception:
+                log.exception("Failed to read the newest samples for %d stream clients", len(subscriptions))
+
+    def publish(self, subscriptions):
+        """Read the newest samples once and hand them to ``subscriptions``"""
+        interface_ids = set().union(*(subscription.interface_ids for subscription in subscriptions))
+        latest = latest_samples(interface_ids)
+        changed = {
+            interface_id: sample for interface_id, sample in latest.items()
+            if self._seen.get(interface_id) != sample['timestamp']
+        }
+        self._seen = {interface_id: sample['timestamp'] for interface_id, sample in latest.items()}
+        for subscription in subscriptions:
+            samples = latest if subscription.fresh else changed
+            subscription.fresh = False
+            for interface_id in subscription.interface_ids & samples.keys():
+                subscription.put(samples[interface_id])
+
+
+def _sample(interface_id, micros, values):
+    """A stream sample with epoch microseconds; NaN and None become None, counts ints"""
+    sample = {'interface_id': interface_id, 'timestamp': micros}
+    for name, value in zip(VALUE_COLUMNS, values):
+        if value is None or value != value:
+            sample[name] = None
+        else:
+            sample[name] = int(value) if name in HISTORY_INT_FIELDS else float(value)
+    return sample
+
+
+def latest_samples(interface_ids):
+    """{interface_id: newest sample with rates} from the ring buffer or interface_current_tbl
+
+    The ring only holds what the collectors of this host wrote, so it wins
+    only where its sample is newer than the one in interface_current_tbl;
+    an interface polled on another host keeps streaming from the table.
+    """
+    latest = {}
+    ids = sorted(interface_ids)
+    table = InterfaceCurrent.__table__
+    with db.engine.connect() as conn:
+        for start in range(0, len(ids), BATCH_INTERFACES):
+            rows = conn.execute(
+                select(table.c.interface_id, table.c.timestamp, *[table.c[name] for name in VALUE_COLUMNS])
+                .where(table.c.interface_id.in_(ids[start:start + BATCH_INTERFACES]))
+            ).all()
+            for row in rows:
+                latest[row[0]] = _sample(row[0], to_micros(row[1]), row[2:])
+    ring = open_ring_buffer(readonly=True)
+    if ring is not None and ids:
+        ring_ids, samples = ring.latest(ids)
+        for interface_id, sample in zip(ring_ids.tolist(), samples.tolist()):
+            stored = latest.get(interface_id)
+            if stored is None or sample[0] > stored['timestamp']:
+                latest[interface_id] = _sample(interface_id, sample[0], sample[1:])
+    return {
+        interface_id: sample for interface_id, sample in latest.items()
+        if sample['input_rate_kbps'] is not None
+    }
+
+
+def get_hub():
+    """The SampleHub of this process and application"""
+    app = current_app._get_current_object()
+    with _hubs_lock:
+        hub = _hubs.get(app)
+        if hub is None:
+            hub = SampleHub(app, interval=app.config.get('STREAM_INTERVAL', 1.0))
+            _hubs[app] = hub
+    return hub
+
+
+def sample_events(hub, subscription, timestamps='iso', keepalive=15):
+    """Server-Sent Events of a subscription, one ``sample`` event per sample
+
+    Sends a comment every ``keepalive`` seconds without samples, which keeps
+    proxies from closing the connection and lets the server notice clients
+    that went away. Unsubscribes when the client disconnects.
+    """
+    try:
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+        while True:
+            samples = subscription.get(keepalive)
+            if not samples:
+                yield ": keepalive\n\n"
+                continue
+            rendered = format_history_timestamps(
+                np.array([sample['timestamp'] for sample in samples], dtype=np.int64), timestamps
+            )
+            yield ''.join(
+                f"event: sample\ndata: {json.dumps(dict(sample, timestamp=timestamp))}\n\n"
+                for sample, timestamp in zip(samples, rendered)
+            )
+    finally:
+        hub.unsubscribe(subscription)
@@ -1,3 +1,4 @@
+import logging
 import shlex
 import subprocess
 import socket
@@ -6,17 +7,35 @@ import os
 import json
 import time
 import re
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from flask import current_app
 from sqlalchemy.orm import joinedload
-from sqlalchemy import desc
+from sqlalchemy import desc, text
 from . import db
 from .models import (
     Device, Interface, Connection, SNMP, ICMP,
     TrafficClass, ClassMap, PolicyMap, PolicyEntry, 
-    PolicyApplication, BandwidthStat, QoSMechanismType
+    PolicyApplication, QoSMechanismType
+)
+from .snmp import (
+    walk_interface_table, get_sys_uptime, index_rows_by_name,
+    counters_from_row, speed_kbps_from_row
+)
+from .rates import rate_engine, CounterSample, COUNTER_FIELDS
+from .rollups import choose_resolution
+from .current import latest_sample_times
+from .archive import VALUE_COLUMNS, to_micros, from_micros
+from .downsample import downsample, SHAPE_FIELDS
+from .storage import get_storage, history_columns_query, rollup_columns_query
+from .ringbuffer import open_ring_buffer, recent_history
+from .metrics import (
+    PING_SECONDS, DB_COMMIT_SECONDS, INGEST_BATCH_ROWS, INGEST_ROWS
 )
 from cryptography.fernet import Fernet
 
+log = logging.getLogger(__name__)
+
 # Configuration constants
 SUDO_PASSWORD = os.environ.get('SUDO_PASSWORD', '123')  # Should be stored securely in production
 CFGMAKER_EXEC_PATH = 'cfgmaker'
@@ -26,6 +45,17 @@ from cryptography.fernet import Fernet
 ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', Fernet.generate_key().decode())  # Should be stored securely
 cipher_suite = Fernet(ENCRYPTION_KEY.encode())
 
+# Fields of bandwidth history points; rollup points take their rates from the
+# bucket averages and add the spread of the rates
+HISTORY_FIELDS = VALUE_COLUMNS
+HISTORY_INT_FIELDS = ('input_packets', 'output_packets', 'input_errors', 'output_errors')
+ROLLUP_HISTORY_FIELDS = {'input_rate_kbps': 'input_rate_avg', 'output_rate_kbps': 'output_rate_avg'}
+ROLLUP_HISTORY_EXTRA_FIELDS = ('input_rate_min', 'input_rate_max', 'input_rate_p95',
+                               'output_rate_min', 'output_rate_max', 'output_rate_p95')
+# Microseconds per unit of the epoch timestamps the history API can return
+TIMESTAMP_UNITS = {'s': 1000000, 'ms': 1000}
+TIMESTAMP_FORMATS = ('iso',) + tuple(TIMESTAMP_UNITS)
+
 # Encryption/decryption functions
 def encrypt_sensitive_data(data):
     """Encrypt sensitive data like passwords and SNMP community strings"""
@@ -189,7 +219,8 @@ def ping_ip(ip, interval):
     cmd = shlex.split(command)
     
     try:
-        output = subprocess.check_output(cmd, universal_newlines=True)
+        with PING_SECONDS.time(device=ip.strip()):
+            output = subprocess.check_output(cmd, universal_newlines=True)
         return 1, output
     except subprocess.CalledProcessError as e:
         return 0, str(e)
@@ -211,7 +242,7 @@ def get_device_interfaces(device_id):
     device = db.session.query(Device).get(device_id)
     if not device:
         return []
-    return [(i.id, i.device_id, i.ifname) for i in device.interfaces]
+    return [(i.id, i.device_id, i.ifname, i.poll_interval) for i in device.interfaces]
 
 def get_all_devices():
     """Get all devices with their status information"""
@@ -427,75 +458,346 @@ def get_interface_policies(interface_id):
 
 # Bandwidth Monitoring Functions
 
-def collect_interface_bandwidth_stats(device_id):
-    """Collect bandwidth statistics for all interfaces on a device"""
+def _seed_rate_engine(interface_ids):
+    """Load the last stored counters of interfaces the rate engine has not seen yet
+
+    This only hits the storage backend the first time an interface is polled
+    by this process, e.g. for every one-shot `flask collect-stats` run. On SQL
+    the counters come from interface_current_tbl.
+    """
+    missing = [i for i in interface_ids if not rate_engine.has_sample(i)]
+    if not missing:
+        return
     try:
-        device = db.session.query(Device).get(device_id)
-        if not device or not device.snmp or device.snmp.status != 1:
+        latest = get_storage().latest(missing)
+    except Exception as e:
+        # Polling goes on without the database; these interfaces get rates from their next poll
+        db.session.rollback()
+        log.warning("Could not load the last counters of %d interfaces: %s", len(missing), getattr(e, 'orig', e))
+        return
+    for interface_id, stat in latest.items():
+        rate_engine.seed(interface_id, CounterSample(
+            stat['timestamp'],
+            stat['sys_uptime'],
+            {field: stat[field] for field in COUNTER_FIELDS},
+            stat['counter_bits'] or 64
+        ))
+
+class PollTarget:
+    """What polling one device needs from the database: its address, SNMP settings and interfaces
+
+    ``interfaces`` are ``(interface_id, ifname, bandwidth)`` tuples. The
+    collector daemon keeps these between refreshes, so its polls read
+    nothing from the database and go on while it is unreachable.
+    """
+
+    __slots__ = ('device_id', 'ip', 'comm_key', 'snmp_version', 'interfaces')
+
+    def __init__(self, device_id, ip, comm_key, snmp_version, interfaces=None):
+        self.device_id = device_id
+        self.ip = ip
+        self.comm_key = comm_key
+        self.snmp_version = snmp_version
+        self.interfaces = interfaces if interfaces is not None else []
+
+def load_poll_targets(device_ids=None):
+    """{device_id: PollTarget} of the devices with SNMP enabled, or only of ``device_ids``"""
+    query = db.session.query(Device.id, Device.ip, SNMP.comm_key, SNMP.version).join(
+        SNMP, Device.snmp_id == SNMP.id
+    ).filter(SNMP.status == 1)
+    interfaces = db.session.query(Interface.device_id, Interface.id, Interface.ifname, Interface.bandwidth)
+    if device_ids is not None:
+        query = query.filter(Device.id.in_(device_ids))
+        interfaces = interfaces.filter(Interface.device_id.in_(device_ids))
+    targets = {device_id: PollTarget(device_id, ip, comm_key, version) for device_id, ip, comm_key, version in query}
+    if targets:
+        for device_id, interface_id, ifname, bandwidth in interfaces.order_by(Interface.id):
+            if device_id in targets:
+                targets[device_id].interfaces.append((interface_id, ifname, bandwidth))
+    return targets
+
+def collect_interface_bandwidth_stats(device_id, timeout=None, writer=None, policy=None, target=None,
+                                      deadline=None):
+    """Collect bandwidth statistics for all interfaces on a device
+
+    Samples are handed to ``writer`` (an ingest.BatchWriter) when one is given,
+    otherwise they are written right away in one storage backend batch. With an
+    adaptive.AdaptivePollPolicy only the interfaces that are due are recorded,
+    and the policy learns from their new rates. The device is read from the
+    database unless its PollTarget is given. SNMP requests fail rather than
+    run past ``deadline`` (a time.monotonic() value).
+    """
+    try:
+        if target is None:
+            target = load_poll_targets([device_id]).get(device_id)
+        if target is None:
             return False
             
-        snmp_community = decrypt_sensitive_data(device.snmp.comm_key)
+        snmp_community = decrypt_sensitive_data(target.comm_key)
         
-        for interface in device.interfaces:
-            # Use SNMP to get interface statistics
-            stats = get_interface_stats_via_snmp(device.ip, snmp_community, interface.ifname)
-            if stats:
-                # Create new bandwidth stat record
-                bandwidth_stat = BandwidthStat(
-                    interface_id=interface.id,
-                    timestamp=datetime.utcnow(),
-                    input_rate_kbps=stats.get('input_rate_kbps', 0),
-                    output_rate_kbps=stats.get('output_rate_kbps', 0),
-                    input_packets=stats.get('input_packets', 0),
-                    output_packets=stats.get('output_packets', 0),
-                    input_errors=stats.get('input_errors', 0),
-                    output_errors=stats.get('output_errors', 0)
-                )
-                db.session.add(bandwidth_stat)
+        # Read the whole interface table in a few bulk requests
+        sys_uptime = get_sys_uptime(target.ip, snmp_community,
+                                    version=target.snmp_version, timeout=timeout, deadline=deadline)
+        rows = walk_interface_table(target.ip, snmp_community,
+                                    version=target.snmp_version, timeout=timeout, deadline=deadline)
+        rows_by_name = index_rows_by_name(rows)
+        timestamp = datetime.utcnow()
         
-        db.session.commit()
+        _seed_rate_engine([interface_id for interface_id, _, _ in target.interfaces])
+        
+        samples = []
+        for interface_id, ifname, bandwidth in target.interfaces:
+            row = rows_by_name.get(ifname) or rows_by_name.get(ifname.lower())
+            if not row:
+                continue
+            if policy is not None and not policy.is_due(device_id, interface_id):
+                continue
+            
+            # Turn counters into rates against the previous poll of this interface
+            counters, bits = counters_from_row(row)
+            speed_kbps = speed_kbps_from_row(row) or bandwidth
+            rates = rate_engine.update(
+                interface_id, CounterSample(timestamp, sys_uptime, counters, bits), speed_kbps
+            ) or {}
+            if policy is not None:
+                policy.observe(device_id, interface_id, rates, bandwidth or speed_kbps)
+            
+            # Rates stay empty on the first poll of an interface
+            sample = {
+                'interface_id': interface_id,
+                'timestamp': timestamp,
+                'input_rate_kbps': rates.get('input_rate_kbps'),
+                'output_rate_kbps': rates.get('output_rate_kbps'),
+                'input_packets': rates.get('input_packets'),
+                'output_packets': rates.get('output_packets'),
+                'input_errors': rates.get('input_errors'),
+                'output_errors': rates.get('output_errors'),
+                'counter_bits': bits,
+                'sys_uptime': sys_uptime,
+                # Not stored with the sample; utilization of interface_current_tbl
+                'speed_kbps': speed_kbps
+            }
+            sample.update(counters)
+            samples.append(sample)
+        
+        if writer is not None:
+            db.session.rollback()
+            writer.add_many(samples)
+        else:
+            db.session.rollback()
+            with DB_COMMIT_SECONDS.time():
+                if samples:
+                    get_storage().write_batch(samples)
+            ring = open_ring_buffer()
+            if ring is not None and samples:
+                ring.append(samples)
+            INGEST_BATCH_ROWS.observe(len(samples))
+            INGEST_ROWS.inc(len(samples), result='written')
         return True
     except Exception as e:
         db.session.rollback()
         raise
 
-def get_interface_stats_via_snmp(ip, community, interface_name):
-    """Get interface statistics using SNMP"""
-    # This would normally use a library like pysnmp to query the device
-    # For demonstration, we'll return simulated data
+def get_interface_stats_via_snmp(ip, community, interface_name, version=2, timeout=None):
+    """Get the raw counters of a single interface using SNMP"""
+    rows_by_name = index_rows_by_name(
+        walk_interface_table(ip, community, version=version, timeout=timeout)
+    )
+    row = rows_by_name.get(interface_name) or rows_by_name.get(interface_name.lower())
+    if not row:
+        return None
+    counters, bits = counters_from_row(row)
+    counters['counter_bits'] = bits
+    return counters
+
+def explain_history_queries(interface_ids=(1,), hours=24, resolution=300):
+    """Return ``[(index_name, plan_lines, uses_index)]`` for the history reads on the current database
+
+    Explains the sample query of SQLStorage.read_columns_many() and the
+    rollup query of aggregate_many(), as built by the same functions.
+    ``uses_index`` is None for databases whose plans are not checked.
+    """
+    since = datetime.utcnow() - timedelta(hours=hours)
+    dialect = db.engine.dialect.name
+    queries = (
+        ('ix_bandwidth_stats_interface_timestamp',
+         history_columns_query(list(interface_ids), since, dialect=dialect)),
+        ('ix_bandwidth_rollups_interface_resolution_bucket',
+         rollup_columns_query(db.session, list(interface_ids), resolution, since).statement),
+    )
+    try:
+        return [(index_name, *query_plan(query, index_name)) for index_name, query in queries]
+    finally:
+        db.session.rollback()
+
+def query_plan(query, index_name):
+    """Return ``(plan_lines, uses_index)`` of a select, checking it reads ``index_name`` in order"""
+    statement = query.compile(db.engine, compile_kwargs={'literal_binds': True})
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        rows = db.session.execute(text(f"EXPLAIN QUERY PLAN {statement}")).fetchall()
+        plan = [row[-1] for row in rows]
+        uses_index = (
+            any(index_name in line for line in plan)
+            and not any('TEMP B-TREE' in line for line in plan)
+        )
+    elif dialect == 'postgresql':
+        # Small test tables are cheaper to scan, so ask whether the index *can* be used
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        rows = db.session.execute(text(f"EXPLAIN {statement}")).fetchall()
+        plan = [row[0] for row in rows]
+        uses_index = any(index_name in line for line in plan) and not any(
+            line.strip().startswith('Sort') for line in plan
+        )
+    else:
+        rows = db.session.execute(text(f"EXPLAIN {statement}")).fetchall()
+        plan = [' '.join(str(value) for value in row) for row in rows]
+        uses_index = None
+    return plan, uses_index
+
+def _rollup_arrays(rollups):
+    timestamps = np.array([to_micros(rollup['bucket']) for rollup in rollups], dtype=np.int64)
+    columns = {
+        field: np.array([rollup[ROLLUP_HISTORY_FIELDS.get(field, field)] for rollup in rollups], dtype=np.float64)
+        for field in HISTORY_FIELDS + ROLLUP_HISTORY_EXTRA_FIELDS
+    }
+    return timestamps, columns
+
+def bandwidth_history_arrays_many(interface_ids, hours=24, min_points=None, since=None):
+    """Get bandwidth history for several interfaces as {interface_id: (timestamps, columns, resolution)}
+
+    Reads the coarsest rollup tier that still gives ``min_points`` points over
+    the window (HISTORY_MIN_POINTS by default) and falls back to the raw
+    samples for short windows or for interfaces the tier has no data of yet.
+    Raw samples come from the memory-mapped ring buffer when it reaches back
+    far enough and holds the newest sample of interface_current_tbl, else
+    from the storage backend (on SQL the hot table and the compressed
+    archive), with one batch read for all interfaces.
+    Timestamps are int64 epoch microseconds and ``columns`` maps the
+    HISTORY_FIELDS to float64 arrays with NaN for NULL, so no row objects are
+    built on the way. Rollup points carry the bucket average as the rate,
+    summed packets and errors, plus the min/max/p95 of the rates;
+    ``resolution`` is the bucket length in seconds, None for raw samples.
+    
+    With ``since`` (a naive UTC datetime) only the samples from then on
+    are read, and the rollup bucket holding it, which may still be filling
+    up, is read again; the tier is still picked for the whole window.
+    """
+    window_start = datetime.utcnow() - timedelta(hours=hours)
+    since = window_start if since is None else max(since, window_start)
+    if min_points is None:
+        min_points = current_app.config.get('HISTORY_MIN_POINTS', 200)
+    resolution = choose_resolution(hours, min_points)
+    
+    storage = get_storage()
+    history = {}
+    if resolution is not None:
+        for interface_id, rollups in storage.aggregate_many(interface_ids, resolution, since).items():
+            if rollups:
+                history[interface_id] = _rollup_arrays(rollups) + (resolution,)
+    elif open_ring_buffer(readonly=True) is not None:
+        # The ring is only current if it holds the newest sample any collector stored
+        newest = latest_sample_times(db.session, interface_ids)
+        for interface_id in interface_ids:
+            recent = recent_history(interface_id, since, newest.get(interface_id))
+            if recent is not None:
+                history[interface_id] = recent + (None,)
+    
+    missing = [interface_id for interface_id in interface_ids if interface_id not in history]
+    if missing:
+        for interface_id, samples in storage.read_columns_many(missing, since).items():
+            history[interface_id] = samples + (None,)
+    return history
+
+def bandwidth_history_arrays(interface_id, hours=24, min_points=None):
+    """Get bandwidth history for an interface as ``(timestamps, columns, resolution)``
+
+    See bandwidth_history_arrays_many().
+    """
+    return bandwidth_history_arrays_many([interface_id], hours, min_points)[interface_id]
+
+def format_history_timestamps(timestamps, unit='iso'):
+    """Render epoch microseconds as ISO strings or integer epoch seconds ('s') or milliseconds ('ms')"""
+    if unit == 'iso':
+        return [from_micros(micros).isoformat() for micros in timestamps.tolist()]
+    return (timestamps // TIMESTAMP_UNITS[unit]).tolist()
+
+def parse_history_since(value, unit='iso'):
+    """Parse a timestamp as format_history_timestamps() renders it back into a naive UTC datetime
+
+    Raises ValueError for malformed values and OverflowError for epochs out of the datetime range.
+    """
+    if unit == 'iso':
+        since = datetime.fromisoformat(value)
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        return since
+    return from_micros(int(value) * TIMESTAMP_UNITS[unit])
+
+def history_values(field, values):
+    """A history column as a list, NaN back to None and the HISTORY_INT_FIELDS as integers"""
+    if field in HISTORY_INT_FIELDS:
+        return [None if value != value else int(value) for value in values.tolist()]
+    return [None if value != value else value for value in values.tolist()]
+
+def history_points(micros, columns, resolution, timestamps='iso', fields=None):
+    """Turn history arrays into one dict per point, limited to ``fields`` when given"""
+    values = {
+        field: history_values(field, array) for field, array in columns.items()
+        if fields is None or field in fields
+    }
+    
+    result = []
+    for index, stamp in enumerate(format_history_timestamps(micros, timestamps)):
+        point = {'timestamp': stamp}
+        for field, field_values in values.items():
+            point[field] = field_values[index]
+        if resolution is not None:
+            point['resolution'] = resolution
+        result.append(point)
+    return result
+
+def get_interfaces_bandwidth_arrays(interface_ids, hours=24, min_points=None, max_points=None,
+                                    method='minmax', downsample_fields=SHAPE_FIELDS, since=None):
+    """bandwidth_history_arrays_many() in the order of ``interface_ids``, each reduced to ``max_points``
+
+    With ``max_points`` the points of each interface are reduced by
+    downsample() with ``method`` ('minmax' keeps every peak, 'lttb' the
+    visual shape) of the ``downsample_fields``.
+    """
+    arrays = bandwidth_history_arrays_many(interface_ids, hours, min_points, since)
+    history = {}
+    for interface_id in interface_ids:
+        micros, columns, resolution = arrays[interface_id]
+        micros, columns = downsample(micros, columns, max_points, method, downsample_fields)
+        history[interface_id] = micros, columns, resolution
+    return history
+
+def get_interfaces_bandwidth_history(interface_ids, hours=24, min_points=None, timestamps='iso',
+                                     max_points=None, method='minmax', downsample_fields=SHAPE_FIELDS):
+    """Get bandwidth history for several interfaces as {interface_id: list of dicts}
+
+    One dict per point of get_interfaces_bandwidth_arrays(), with the
+    timestamp formatted as ``timestamps`` ('iso', or epoch 's' / 'ms' as
+    integers) and NaN turned back into None. Rollup points also carry the
+    bucket ``resolution`` in seconds.
+    """
     return {
-        'input_rate_kbps': float(random.randint(1000, 10000)),
-        'output_rate_kbps': float(random.randint(1000, 10000)),
-        'input_packets': random.randint(10000, 100000),
-        'output_packets': random.randint(10000, 100000),
-        'input_errors': random.randint(0, 10),
-        'output_errors': random.randint(0, 10)
+        interface_id: history_points(micros, columns, resolution, timestamps)
+        for interface_id, (micros, columns, resolution) in get_interfaces_bandwidth_arrays(
+            interface_ids, hours, min_points, max_points, method, downsample_fields
+        ).items()
     }
 
-def get_interface_bandwidth_history(interface_id, hours=24):
-    """Get bandwidth history for an interface"""
-    try:
-        since = datetime.utcnow() - timedelta(hours=hours)
-        stats = db.session.query(BandwidthStat).filter(
-            BandwidthStat.interface_id == interface_id,
-            BandwidthStat.timestamp >= since
-        ).order_by(BandwidthStat.timestamp).all()
-        
-        result = []
-        for stat in stats:
-            result.append({
-                'timestamp': stat.timestamp.isoformat(),
-                'input_rate_kbps': stat.input_rate_kbps,
-                'output_rate_kbps': stat.output_rate_kbps,
-                'input_packets': stat.input_packets,
-                'output_packets': stat.output_packets,
-                'input_errors': stat.input_errors,
-                'output_errors': stat.output_errors
-            })
-        
-        return result
-    except Exception as e:
-        raise
+def get_interface_bandwidth_history(interface_id, hours=24, min_points=None, timestamps='iso',
+                                    max_points=None, method='minmax', downsample_fields=SHAPE_FIELDS):
+    """Get bandwidth history for an interface as a list of dicts
+
+    See get_interfaces_bandwidth_history().
+    """
+    return get_interfaces_bandwidth_history(
+        [interface_id], hours, min_points, timestamps, max_points, method, downsample_fields
+    )[interface_id]
 
 # Device Configuration Functions
 
@@ -630,6 +932,3 @@ def generate_qos_removal_config(policy_map, interface, direction):
         commands.append(f" no service-policy output {policy_map.name}")
     
     return commands
-
-# Import for random data generation in the demo
-import random
@@ -1,4 +1,4 @@
-from flask import render_template, flash, redirect, request, url_for, jsonify
+from flask import render_template, flash, redirect, request, url_for, jsonify, Response
 from flask_appbuilder.models.sqla.interface import SQLAInterface
 from flask_appbuilder import ModelView, BaseView, expose, has_access
 from .models import (
@@ -13,10 +13,83 @@ from .utils import (
     create_traffic_class, create_class_map, create_policy_map,
     add_policy_entry, apply_policy_to_interface, remove_policy_from_interface,
     get_interface_policies, collect_interface_bandwidth_stats,
-    get_interface_bandwidth_history
+    get_interfaces_bandwidth_history, get_interfaces_bandwidth_arrays, bandwidth_history_arrays,
+    parse_history_since, TIMESTAMP_FORMATS
 )
-import json
-from datetime import datetime, timedelta
+from .downsample import METHODS as DOWNSAMPLE_METHODS, SHAPE_FIELDS
+from .formats import (
+    RESPONSE_FORMATS, MAX_INTERFACE_ID, encode_history, compressed_response, history_etag, not_modified
+)
+from .current import top_interfaces, device_utilization, interface_current_state
+from .metrics import render_all
+from .stream import get_hub, sample_events
+import functools
+import hmac
+
+DROP_FIELDS = ('input_errors', 'output_errors')
+
+def history_options():
+    """History API options from the query string: ``(options, error)``
+
+    ``timestamps`` picks ISO strings or integer epoch seconds / milliseconds;
+    ``max_points`` caps the points returned, picked with ``downsample``;
+    ``format`` is one of the RESPONSE_FORMATS; ``since`` is the last
+    timestamp a client got, as returned, to fetch only newer points.
+    """
+    timestamps = request.args.get('timestamps', 'iso')
+    if timestamps not in TIMESTAMP_FORMATS:
+        return None, f"timestamps must be one of {', '.join(TIMESTAMP_FORMATS)}"
+    max_points = request.args.get('max_points', None, type=int)
+    if max_points is not None and max_points < 2:
+        return None, "max_points must be at least 2"
+    method = request.args.get('downsample', 'minmax')
+    if method not in DOWNSAMPLE_METHODS:
+        return None, f"downsample must be one of {', '.join(DOWNSAMPLE_METHODS)}"
+    fmt = request.args.get('format', 'rows')
+    if fmt not in RESPONSE_FORMATS:
+        return None, f"format must be one of {', '.join(RESPONSE_FORMATS)}"
+    since = request.args.get('since')
+    if since:
+        try:
+            since = parse_history_since(since, 'ms' if fmt in ('msgpack', 'binary') else timestamps)
+        except (ValueError, OverflowError):
+            return None, "since must be a timestamp as returned by the API"
+    return {'timestamps': timestamps, 'max_points': max_points, 'method': method, 'format': fmt,
+            'since': since or None}, None
+
+def interface_ids_option(name):
+    """Interface ids of a comma separated query parameter, in order without repeats: ``(ids, error)``
+
+    Ids must be positive and fit the uint32 of the binary history format.
+    """
+    try:
+        interface_ids = [int(value) for value in request.args.get(name, '').split(',') if value]
+    except ValueError:
+        return None, f"{name} must be a comma separated list of interface ids"
+    if not interface_ids:
+        return None, f"{name} is required"
+    if not all(0 < interface_id <= MAX_INTERFACE_ID for interface_id in interface_ids):
+        return None, f"{name} must be interface ids between 1 and {MAX_INTERFACE_ID}"
+    return list(dict.fromkeys(interface_ids)), None
+
+def history_response(interface_ids, hours, options, fields=None, single=False):
+    """Encode the history of interfaces in the requested format, compressed as negotiated
+
+    Answers 304 when the client's If-None-Match still matches history_etag().
+    """
+    etag = history_etag(interface_ids)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    history = get_interfaces_bandwidth_arrays(
+        interface_ids, hours, max_points=options['max_points'], method=options['method'],
+        downsample_fields=fields or SHAPE_FIELDS, since=options['since']
+    )
+    body, mimetype = encode_history(history, options['format'], options['timestamps'], fields, single)
+    response = compressed_response(body, mimetype)
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
 
 class MarkEngineView(BaseView):
     route_base = "/markengine"
@@ -197,12 +270,27 @@ class MarkEngineView(BaseView):
             devices=devices_data
         )
         
-    @expose("/api/bandwidth/<int:interface_id>")
+    @expose("/api/bandwidth")
+    @has_access
+    def bandwidth_batch_data(self):
+        """History of several interfaces, ?interface_ids=1,2,3, as {interface_id: points}"""
+        hours = request.args.get('hours', 24, type=int)
+        interface_ids, error = interface_ids_option('interface_ids')
+        if error:
+            return jsonify({'error': error}), 400
+        options, error = history_options()
+        if error:
+            return jsonify({'error': error}), 400
+        return history_response(interface_ids, hours, options)
+
+    @expose(f"/api/bandwidth/<int(min=1, max={MAX_INTERFACE_ID}):interface_id>")
     @has_access
     def bandwidth_data(self, interface_id):
         hours = request.args.get('hours', 24, type=int)
-        data = get_interface_bandwidth_history(interface_id, hours)
-        return jsonify(data)
+        options, error = history_options()
+        if error:
+            return jsonify({'error': error}), 400
+        return history_response([interface_id], hours, options, single=True)
 
 
 class DropEngineView(BaseView):
@@ -330,22 +418,15 @@ class DropEngineView(BaseView):
             devices=devices_data
         )
         
-    @expose("/api/drops/<int:interface_id>")
+    @expose(f"/api/drops/<int(min=1, max={MAX_INTERFACE_ID}):interface_id>")
     @has_access
     def drop_data(self, interface_id):
         hours = request.args.get('hours', 24, type=int)
-        data = get_interface_bandwidth_history(interface_id, hours)
-        
-        # Filter for drop-related stats (input and output errors)
-        drop_data = []
-        for stat in data:
-            drop_data.append({
-                'timestamp': stat['timestamp'],
-                'input_errors': stat['input_errors'],
-                'output_errors': stat['output_errors']
-            })
-            
-        return jsonify(drop_data)
+        options, error = history_options()
+        if error:
+            return jsonify({'error': error}), 400
+        # Only the drop-related stats (input and output errors), downsampled by their peaks
+        return history_response([interface_id], hours, options, fields=DROP_FIELDS, single=True)
 
 
 class DeviceManagementView(BaseView):
@@ -357,6 +438,8 @@ class DeviceManagementView(BaseView):
     def list(self):
         # Get all devices directly from the database instead of using get_all_devices()
         devices = db.session.query(Device).all()
+        # Peak utilization and last poll per device from the current state table
+        utilization = device_utilization(db.session)
         
         # Format device information for the template
         devices_info = []
@@ -366,18 +449,36 @@ class DeviceManagementView(BaseView):
             ping_status = "green" if device.icmp and device.icmp.status == 1 else "red"
             ssh_status = "green" if device.connection and device.connection.status == 1 else "red"
             
+            peak_utilization, last_poll = utilization.get(device.id, (None, None))
+            
             # Add formatted device info
             devices_info.append((
                 device.id,
                 device.ip,
                 snmp_status,
                 ping_status,
-                ssh_status
+                ssh_status,
+                peak_utilization,
+                last_poll
             ))
         
+        # Busiest interfaces of the fleet
+        top = []
+        for current, interface, device in top_interfaces(db.session, limit=10):
+            top.append({
+                'device_id': device.id,
+                'device_ip': device.ip,
+                'ifname': interface.ifname,
+                'input_rate_kbps': current.input_rate_kbps,
+                'output_rate_kbps': current.output_rate_kbps,
+                'utilization': current.utilization,
+                'timestamp': current.timestamp
+            })
+        
         return self.render_template(
             "devices_list.html",
-            devices_info=devices_info
+            devices_info=devices_info,
+            top_interfaces=top
         )
 
     @expose("/new", methods=["GET", "POST"])
@@ -445,15 +546,18 @@ class DeviceManagementView(BaseView):
         except Exception as e:
             flash(f"Error collecting bandwidth stats: {str(e)}")
         
-        # Get interface details with policies
+        # Get interface details with policies and their latest rates
+        current_state = interface_current_state(db.session, [interface[0] for interface in interfaces])
         interface_details = []
-        for interface_id, device_id, ifname in interfaces:
+        for interface_id, device_id, ifname, poll_interval in interfaces:
             policies = get_interface_policies(interface_id)
             interface_details.append({
                 'id': interface_id,
                 'device_id': device_id,
                 'name': ifname,
-                'policies': policies
+                'poll_interval': poll_interval,
+                'policies': policies,
+                'current': current_state.get(interface_id)
             })
         
         # Get available policy maps for applying to interfaces
@@ -528,35 +632,21 @@ class DeviceManagementView(BaseView):
             'icmp_status': "Active" if device.icmp and device.icmp.status == 1 else "Inactive"
         }
         
-        # Get interfaces with bandwidth stats
+        # Get bandwidth history of all interfaces for the specified time period at once
+        interfaces = device.interfaces.all()
+        history = get_interfaces_bandwidth_history([interface.id for interface in interfaces], hours)
+        
+        # Format interface data
         interfaces_data = []
-        for interface in device.interfaces.all():
-            # Get bandwidth history for the specified time period
-            stats = get_interface_bandwidth_history(interface.id, hours)
-            
-            # Format interface data
-            interface_data = {
+        for interface in interfaces:
+            interfaces_data.append({
                 'id': interface.id,
                 'ifname': interface.ifname,
                 'description': interface.description,
                 'bandwidth': interface.bandwidth,
                 'is_active': interface.is_active,
-                'bandwidth_stats': []
-            }
-            
-            # Add formatted bandwidth stats
-            for stat_dict in stats:
-                interface_data['bandwidth_stats'].append({
-                    'timestamp': stat_dict['timestamp'],
-                    'input_rate_kbps': stat_dict['input_rate_kbps'],
-                    'output_rate_kbps': stat_dict['output_rate_kbps'],
-                    'input_packets': stat_dict['input_packets'],
-                    'output_packets': stat_dict['output_packets'],
-                    'input_errors': stat_dict['input_errors'],
-                    'output_errors': stat_dict['output_errors']
-                })
-            
-            interfaces_data.append(interface_data)
+                'bandwidth_stats': history[interface.id]
+            })
         
         return self.render_template(
             "device_bandwidth.html",
@@ -580,10 +670,10 @@ class DeviceManagementView(BaseView):
         # Get hours parameter from request
         hours = request.args.get('hours', 24, type=int)
         
-        # Get bandwidth history for the specified time period
-        stats = get_interface_bandwidth_history(interface_id, hours)
+        # Get bandwidth history for the specified time period as arrays
+        micros, columns, _ = bandwidth_history_arrays(interface_id, hours)
         
-        if not stats:
+        if not len(micros):
             # Create a simple "No data available" image
             fig, ax = plt.subplots(figsize=(10, 6))
             ax.text(0.5, 0.5, 'No bandwidth data available', 
@@ -600,9 +690,9 @@ class DeviceManagementView(BaseView):
             return send_file(img_io, mimetype='image/png')
         
         # Extract data
-        timestamps = [datetime.fromisoformat(stat['timestamp']) for stat in stats]
-        input_rates = [stat['input_rate_kbps'] / 1000 for stat in stats]  # Convert to Mbps
-        output_rates = [stat['output_rate_kbps'] / 1000 for stat in stats]  # Convert to Mbps
+        timestamps = micros.astype('datetime64[us]')
+        input_rates = columns['input_rate_kbps'] / 1000  # Convert to Mbps
+        output_rates = columns['output_rate_kbps'] / 1000  # Convert to Mbps
         
         # Create figure and plot data
         fig, ax = plt.subplots(figsize=(10, 6))
@@ -713,7 +803,7 @@ class ICMPModelView(ModelView):
 
 class InterfaceModelView(ModelView):
     datamodel = SQLAInterface(Interface)
-    list_columns = ['id', 'device', 'ifname', 'description', 'bandwidth', 'is_active']
+    list_columns = ['id', 'device', 'ifname', 'description', 'bandwidth', 'poll_interval', 'is_active']
     add_columns = ['device', 'ifname', 'description', 'bandwidth', 'is_active']
     edit_columns = ['device', 'ifname', 'description', 'bandwidth', 'is_active']
     # We'll set related_views after PolicyApplicationModelView and BandwidthStatModelView are defined
@@ -722,6 +812,7 @@ class InterfaceModelView(ModelView):
         'ifname': 'Interface Name',
         'description': 'Description',
         'bandwidth': 'Bandwidth (Kbps)',
+        'poll_interval': 'Effective Poll Interval (s)',
         'is_active': 'Active'
     }
     
@@ -761,15 +852,16 @@ class PolicyApplicationModelView(ModelView):
 
 class DeviceModelView(ModelView):
     datamodel = SQLAInterface(Device)
-    list_columns = ['id', 'ip', 'connection', 'snmp', 'icmp']
+    list_columns = ['id', 'ip', 'connection', 'snmp', 'icmp', 'poll_interval']
     related_views = [ConnectionModelView, SNMPModelView, ICMPModelView, InterfaceModelView]
-    add_columns = ['ip', 'connection', 'snmp', 'icmp']
-    edit_columns = ['ip', 'connection', 'snmp', 'icmp']
+    add_columns = ['ip', 'connection', 'snmp', 'icmp', 'poll_interval']
+    edit_columns = ['ip', 'connection', 'snmp', 'icmp', 'poll_interval']
     label_columns = {
         'ip': 'IP Address',
         'connection': 'Connection Status',
         'snmp': 'SNMP Status',
-        'icmp': 'ICMP Status'
+        'icmp': 'ICMP Status',
+        'poll_interval': 'Poll Interval (s)'
     }
     
     def format_connection(self, item):
@@ -943,9 +1035,72 @@ appbuilder.add_link("Drop Engine", href="/dropengine/rules", category="QoS Confi
 appbuilder.add_link("Device Management", href="/devices/list", category="Devices", icon="fa-server")
 
 # Register views
+def has_access_or_token(setting):
+    """has_access, or a request with ``Authorization: Bearer <token>`` when config ``setting`` holds a token
+
+    For machine clients such as Prometheus that cannot log in. A request
+    that sends a wrong token is answered 401 instead of being redirected to
+    the login page.
+    """
+    def decorator(f):
+        protected = has_access(f)
+
+        @functools.wraps(protected)
+        def wraps(self, *args, **kwargs):
+            token = appbuilder.app.config.get(setting)
+            authorization = request.headers.get('Authorization')
+            if token and authorization:
+                if hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {token}".encode('utf-8')):
+                    return f(self, *args, **kwargs)
+                return Response("Invalid token\n", status=401, mimetype="text/plain")
+            return protected(self, *args, **kwargs)
+        return wraps
+    return decorator
+
+class MetricsView(BaseView):
+    """Prometheus scrape endpoint for this process and the collector snapshots"""
+    route_base = ""
+    
+    @expose("/metrics")
+    @has_access_or_token('METRICS_TOKEN')
+    def metrics(self):
+        config = appbuilder.app.config
+        body = render_all(config.get('METRICS_DIR'), config.get('METRICS_SNAPSHOT_MAX_AGE', 300))
+        return Response(body, mimetype="text/plain; version=0.0.4")
+
+class StreamView(BaseView):
+    """Live samples of interfaces pushed as Server-Sent Events"""
+    route_base = "/api/stream"
+
+    @expose("/interfaces")
+    @has_access
+    def interfaces(self):
+        """Stream every new sample of ?ids=1,2,3 as a ``sample`` event until the client disconnects"""
+        config = appbuilder.app.config
+        interface_ids, error = interface_ids_option('ids')
+        if error:
+            return jsonify({'error': error}), 400
+        limit = config.get('STREAM_MAX_INTERFACES', 500)
+        if len(interface_ids) > limit:
+            return jsonify({'error': f"at most {limit} interfaces can be streamed at once"}), 400
+        timestamps = request.args.get('timestamps', 'iso')
+        if timestamps not in TIMESTAMP_FORMATS:
+            return jsonify({'error': f"timestamps must be one of {', '.join(TIMESTAMP_FORMATS)}"}), 400
+        # The stream outlives the request; give its database connection back now
+        db.session.remove()
+        hub = get_hub()
+        events = sample_events(hub, hub.subscribe(interface_ids), timestamps, config.get('STREAM_KEEPALIVE', 15))
+        response = Response(events, mimetype='text/event-stream')
+        response.cache_control.no_cache = True
+        # Keep nginx from buffering the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
 appbuilder.add_view_no_menu(MarkEngineView)
 appbuilder.add_view_no_menu(DropEngineView)
 appbuilder.add_view_no_menu(DeviceManagementView)
+appbuilder.add_view_no_menu(MetricsView)
+appbuilder.add_view_no_menu(StreamView)
 
 # Device-related views
 appbuilder.add_view(
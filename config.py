@@ -106,3 +106,125 @@ IMG_UPLOAD_URL = "/static/uploads/"
 # these are located on static/appbuilder/css/themes
 # you can create your own and easily use them placing them on the same dir structure to override
 APP_THEME = "flatly.css"  # A clean, modern theme
+
+# ----------------------------------------------------
+# Statistics collector
+# ----------------------------------------------------
+# Number of devices polled in parallel by `flask collect-stats`
+COLLECTOR_CONCURRENCY = int(os.getenv("COLLECTOR_CONCURRENCY", "16"))
+# Seconds a single device may take before it is reported as timed out
+DEVICE_TIMEOUT = int(os.getenv("DEVICE_TIMEOUT", "30"))
+
+# SNMP polling: per-request timeout (seconds), retries and GETBULK repetitions
+SNMP_TIMEOUT = float(os.getenv("SNMP_TIMEOUT", "2"))
+SNMP_RETRIES = int(os.getenv("SNMP_RETRIES", "1"))
+SNMP_MAX_REPETITIONS = int(os.getenv("SNMP_MAX_REPETITIONS", "25"))
+# Send every SNMP request to this "host:port" instead of the device, e.g. to the
+# agent started by `flask snmpsim run` for load tests
+SNMP_TARGET_OVERRIDE = os.getenv("SNMP_TARGET_OVERRIDE", "")
+
+# `flask collector run`: poll interval (seconds) for devices without their own,
+# +/- fraction of random jitter, and how often the device list is reloaded
+COLLECTOR_DEFAULT_INTERVAL = int(os.getenv("COLLECTOR_DEFAULT_INTERVAL", "300"))
+COLLECTOR_JITTER = float(os.getenv("COLLECTOR_JITTER", "0.1"))
+COLLECTOR_REFRESH_INTERVAL = int(os.getenv("COLLECTOR_REFRESH_INTERVAL", "60"))
+
+# Adaptive polling: devices without their own poll interval are polled faster
+# when their interfaces are volatile or close to their bandwidth, and slower
+# when they are flat, within COLLECTOR_MIN_INTERVAL..COLLECTOR_MAX_INTERVAL seconds
+COLLECTOR_ADAPTIVE = os.getenv("COLLECTOR_ADAPTIVE", "True").lower() in ("true", "1", "t", "yes")
+COLLECTOR_MIN_INTERVAL = int(os.getenv("COLLECTOR_MIN_INTERVAL", "60"))
+COLLECTOR_MAX_INTERVAL = int(os.getenv("COLLECTOR_MAX_INTERVAL", "900"))
+
+# Bandwidth samples are inserted in batches of up to INGEST_BATCH_SIZE rows,
+# or after INGEST_MAX_DELAY seconds, whichever comes first
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "1000"))
+INGEST_MAX_DELAY = float(os.getenv("INGEST_MAX_DELAY", "5"))
+
+# Samples the database rejects are spooled to SPOOL_DIR (empty disables it) in
+# segments of SPOOL_SEGMENT_BYTES, fsynced every SPOOL_FSYNC_INTERVAL seconds,
+# and replayed once the database has been left alone for SPOOL_RETRY_INTERVAL seconds;
+# segments it refuses for good (e.g. rows of deleted interfaces) go to <spool>/quarantine
+SPOOL_DIR = os.getenv("SPOOL_DIR", os.path.join(basedir, "spool"))
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+SPOOL_FSYNC_INTERVAL = float(os.getenv("SPOOL_FSYNC_INTERVAL", "1"))
+SPOOL_RETRY_INTERVAL = float(os.getenv("SPOOL_RETRY_INTERVAL", "30"))
+
+# Sharded collectors (`flask collector run --workers N` or `--sharded` on several
+# hosts) heartbeat every COLLECTOR_HEARTBEAT_INTERVAL seconds; a worker whose
+# heartbeat is older than COLLECTOR_WORKER_TTL seconds loses its devices
+COLLECTOR_HEARTBEAT_INTERVAL = int(os.getenv("COLLECTOR_HEARTBEAT_INTERVAL", "10"))
+COLLECTOR_WORKER_TTL = int(os.getenv("COLLECTOR_WORKER_TTL", "30"))
+
+# Metrics: collector processes write a snapshot to METRICS_DIR every
+# METRICS_SNAPSHOT_INTERVAL seconds; /metrics and `flask metrics` merge the
+# snapshots younger than METRICS_SNAPSHOT_MAX_AGE seconds. Empty disables them.
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(basedir, "metrics"))
+METRICS_SNAPSHOT_INTERVAL = int(os.getenv("METRICS_SNAPSHOT_INTERVAL", "10"))
+METRICS_SNAPSHOT_MAX_AGE = int(os.getenv("METRICS_SNAPSHOT_MAX_AGE", "300"))
+# /metrics needs a login with the can_metrics permission; scrapers that cannot
+# log in may send "Authorization: Bearer <METRICS_TOKEN>" instead (empty disables)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Storage backend of the bandwidth samples: "sql" keeps them in the database
+# (rollups, archive and partitions apply), "file" in per-interface day files
+# under STATS_FILE_DIR, whose aggregates are computed on read so its history
+# ends at RETENTION_RAW_DAYS; "package.module:Class" loads a custom backend
+STATS_BACKEND = os.getenv("STATS_BACKEND", "sql")
+STATS_FILE_DIR = os.getenv("STATS_FILE_DIR", os.path.join(basedir, "tsdb"))
+
+# The sql backend stores the sample timestamps of bandwidth_stats_tbl as
+# DateTime, or with "s" / "ms" as integer epoch seconds / milliseconds, so
+# history filters, partitions, retention and rollups compare integers.
+# `flask db upgrade` converts the stored samples to the unit set here; to
+# change it later, run `flask db downgrade e81b4c6f2d57` under the old setting
+# and `flask db upgrade` under the new one
+STATS_TIMESTAMP_UNIT = os.getenv("STATS_TIMESTAMP_UNIT", "")
+
+# The latest RING_BUFFER_SLOTS samples of every interface are kept in a
+# memory-mapped file shared by the collectors and web workers, which serves
+# short history windows without the database (empty path disables it)
+RING_BUFFER_PATH = os.getenv("RING_BUFFER_PATH", os.path.join(basedir, "bandwidth.ring"))
+RING_BUFFER_SLOTS = int(os.getenv("RING_BUFFER_SLOTS", "128"))
+
+# Bandwidth history is read from the coarsest rollup tier (1m, 5m, 1h, 1d)
+# that still gives at least HISTORY_MIN_POINTS points over the requested window
+HISTORY_MIN_POINTS = int(os.getenv("HISTORY_MIN_POINTS", "200"))
+
+# /api/stream/interfaces pushes new samples as Server-Sent Events: every web
+# worker reads the newest samples once per STREAM_INTERVAL seconds for all its
+# clients, each limited to STREAM_MAX_INTERFACES interfaces, and sends a
+# keepalive comment after STREAM_KEEPALIVE seconds without samples
+STREAM_INTERVAL = float(os.getenv("STREAM_INTERVAL", "1"))
+STREAM_MAX_INTERFACES = int(os.getenv("STREAM_MAX_INTERFACES", "500"))
+STREAM_KEEPALIVE = int(os.getenv("STREAM_KEEPALIVE", "15"))
+
+# Raw samples older than ARCHIVE_AFTER_DAYS whole days are packed into
+# compressed per-interface day blocks (0 disables) that history reads alongside
+# the hot table; done by `flask stats archive` and before every daemon prune
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "2"))
+
+# Retention in days of the raw samples, every rollup tier and the archive (0 keeps them
+# forever). `flask stats prune` and the collector daemon, every
+# RETENTION_PRUNE_INTERVAL seconds (0 disables), delete expired rows in chunks
+# of RETENTION_CHUNK_SIZE, pausing RETENTION_CHUNK_PAUSE seconds between them
+RETENTION_RAW_DAYS = int(os.getenv("RETENTION_RAW_DAYS", "7"))
+RETENTION_1M_DAYS = int(os.getenv("RETENTION_1M_DAYS", "3"))
+RETENTION_5M_DAYS = int(os.getenv("RETENTION_5M_DAYS", "30"))
+RETENTION_1H_DAYS = int(os.getenv("RETENTION_1H_DAYS", "730"))
+RETENTION_1D_DAYS = int(os.getenv("RETENTION_1D_DAYS", "0"))
+RETENTION_ARCHIVE_DAYS = int(os.getenv("RETENTION_ARCHIVE_DAYS", "90"))
+RETENTION_PRUNE_INTERVAL = int(os.getenv("RETENTION_PRUNE_INTERVAL", "3600"))
+RETENTION_CHUNK_SIZE = int(os.getenv("RETENTION_CHUNK_SIZE", "5000"))
+RETENTION_CHUNK_PAUSE = float(os.getenv("RETENTION_CHUNK_PAUSE", "0.05"))
+
+# Time partitioning of bandwidth_stats_tbl by "day" or "week" (empty disables).
+# PostgreSQL uses declarative range partitions (`flask stats partitions
+# --convert` once); SQLite keeps one database per period in STATS_PARTITION_DIR,
+# attached behind a view. Partitions are created STATS_PARTITION_AHEAD periods
+# ahead and expire as a whole with RETENTION_RAW_DAYS. SQLite attaches at most
+# 9 partitions, so the app refuses to start unless the periods of
+# RETENTION_RAW_DAYS plus STATS_PARTITION_AHEAD + 1 fit, e.g. 7 days by "day".
+STATS_PARTITION = os.getenv("STATS_PARTITION", "")
+STATS_PARTITION_DIR = os.getenv("STATS_PARTITION_DIR", os.path.join(basedir, "partitions"))
+STATS_PARTITION_AHEAD = int(os.getenv("STATS_PARTITION_AHEAD", "1"))
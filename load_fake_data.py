@@ -2,6 +2,7 @@
 import os
 import random
 import datetime
+import ipaddress
 from app import app, db
 from app.models import (
     Device, Interface, Connection, SNMP, ICMP,
@@ -9,8 +10,11 @@ from app.models import (
     PolicyApplication, BandwidthStat, QoSMechanismType
 )
 from app.utils import encrypt_sensitive_data
+from app.rollups import finalize_rollups
+from app.storage import get_storage
+from app.ringbuffer import open_ring_buffer
 
-def create_fake_data():
+def create_fake_data(device_count=None):
     """Create fake data for the bandwidth optimizer application"""
     print("Creating fake data for the bandwidth optimizer application...")
     
@@ -21,7 +25,11 @@ def create_fake_data():
     db.session.query(PolicyMap).delete()
     db.session.query(ClassMap).delete()
     db.session.query(TrafficClass).delete()
-    db.session.query(BandwidthStat).delete()
+    storage = get_storage()
+    storage.clear()
+    ring = open_ring_buffer()
+    if ring is not None:
+        ring.clear()
     db.session.query(Interface).delete()
     db.session.query(Device).delete()
     db.session.query(Connection).delete()
@@ -37,6 +45,13 @@ def create_fake_data():
         "192.168.3.1", "10.2.2.1", "172.18.0.1"
     ]
     
+    # Generate more addresses for load tests against the SNMP simulator
+    if device_count is not None:
+        first = ipaddress.ip_address("10.128.0.1")
+        router_ips = router_ips[:device_count] + [
+            str(first + n) for n in range(max(0, device_count - len(router_ips)))
+        ]
+    
     devices = []
     
     for i, ip in enumerate(router_ips):
@@ -230,6 +245,7 @@ def create_fake_data():
     # Create bandwidth statistics
     print("Creating bandwidth statistics...")
     now = datetime.datetime.utcnow()
+    bandwidth_stats = []
     
     for interface in interfaces:
         # Create 24 hours of data points (one per hour)
@@ -265,20 +281,27 @@ def create_fake_data():
             output_rate = int(max_rate * output_factor)
             
             # Create bandwidth stat
-            bandwidth_stat = BandwidthStat(
-                interface_id=interface.id,
-                timestamp=timestamp,
-                input_rate_kbps=input_rate,
-                output_rate_kbps=output_rate,
-                input_packets=int(input_rate * 0.1 * random.uniform(0.9, 1.1)),
-                output_packets=int(output_rate * 0.1 * random.uniform(0.9, 1.1)),
-                input_errors=int(input_rate * 0.0001 * random.uniform(0, 2)),
-                output_errors=int(output_rate * 0.0001 * random.uniform(0, 2))
-            )
-            db.session.add(bandwidth_stat)
+            bandwidth_stats.append({
+                'interface_id': interface.id,
+                'timestamp': timestamp,
+                'input_rate_kbps': input_rate,
+                'output_rate_kbps': output_rate,
+                'input_packets': int(input_rate * 0.1 * random.uniform(0.9, 1.1)),
+                'output_packets': int(output_rate * 0.1 * random.uniform(0.9, 1.1)),
+                'input_errors': int(input_rate * 0.0001 * random.uniform(0, 2)),
+                'output_errors': int(output_rate * 0.0001 * random.uniform(0, 2))
+            })
     
     # Commit all changes
     db.session.commit()
+    
+    # Write the samples in batches through the storage backend like the
+    # collector does, which also rolls them up on SQL
+    print("Writing bandwidth samples...")
+    for start in range(0, len(bandwidth_stats), 10000):
+        storage.write_batch(bandwidth_stats[start:start + 10000])
+    finalize_rollups(db.session, limit=None)
+    db.session.commit()
     print("Fake data creation complete!")
 
 if __name__ == "__main__":
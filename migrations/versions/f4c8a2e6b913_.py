@@ -0,0 +1,101 @@
+"""store bandwidth stats timestamps as epoch integers
+
+Revision ID: f4c8a2e6b913
+Revises: e81b4c6f2d57
+Create Date: 2026-10-18 09:30:00.000000
+
+Converts bandwidth_stats_tbl.timestamp to the STATS_TIMESTAMP_UNIT set when
+it runs and back on downgrade; without one it changes nothing. On SQLite the
+partitions attached for STATS_PARTITION are converted as well and the
+declared column type stays, as SQLite stores integers in it regardless.
+"""
+import re
+
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4c8a2e6b913'
+down_revision = 'e81b4c6f2d57'
+branch_labels = None
+depends_on = None
+
+TABLE = 'bandwidth_stats_tbl'
+PER_SECOND = {'s': 1, 'ms': 1000}
+
+
+def _sqlite_tables(conn):
+    """The main table and the tables of the attached partitions"""
+    tables = [f'main.{TABLE}']
+    for _, schema, _ in conn.execute(sa.text("PRAGMA database_list")).fetchall():
+        if schema == 'pdefault':
+            tables.append(f'"{schema}".{TABLE}_default')
+        elif re.match(r'^p\d{8}$', schema):
+            tables.append(f'"{schema}".{TABLE}_{schema}')
+    return tables
+
+
+def _pg_column_type(conn):
+    return conn.execute(sa.text(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = :table AND column_name = 'timestamp'"
+    ), {'table': TABLE}).scalar()
+
+
+def _check_pg_unpartitioned(conn):
+    kind = conn.execute(sa.text("SELECT relkind FROM pg_class WHERE relname = :table"), {'table': TABLE}).scalar()
+    if kind == 'p':
+        raise RuntimeError(
+            f"{TABLE} is partitioned and PostgreSQL cannot change the type of a partition key; "
+            "set STATS_TIMESTAMP_UNIT before `flask stats partitions --convert`"
+        )
+
+
+def upgrade():
+    unit = current_app.config.get('STATS_TIMESTAMP_UNIT')
+    if not unit:
+        return
+    per_second = PER_SECOND[unit]
+    conn = op.get_bind()
+    if conn.dialect.name == 'sqlite':
+        # SQLAlchemy writes 'YYYY-MM-DD HH:MM:SS.ffffff'; the milliseconds start at the 21st character
+        epoch = "CAST(strftime('%s', \"timestamp\") AS INTEGER)"
+        if per_second == 1000:
+            epoch = f"{epoch} * 1000 + CAST(substr(\"timestamp\", 21, 3) AS INTEGER)"
+        for table in _sqlite_tables(conn):
+            op.execute(f"UPDATE {table} SET \"timestamp\" = {epoch} WHERE typeof(\"timestamp\") = 'text'")
+    elif conn.dialect.name == 'postgresql':
+        if _pg_column_type(conn) == 'bigint':
+            return
+        _check_pg_unpartitioned(conn)
+        op.execute(
+            f'ALTER TABLE {TABLE} ALTER COLUMN "timestamp" TYPE BIGINT '
+            f'USING floor(extract(epoch FROM "timestamp") * {per_second})::bigint'
+        )
+    else:
+        raise RuntimeError(f"STATS_TIMESTAMP_UNIT is not supported on {conn.dialect.name}")
+
+
+def downgrade():
+    unit = current_app.config.get('STATS_TIMESTAMP_UNIT')
+    if not unit:
+        return
+    per_second = PER_SECOND[unit]
+    conn = op.get_bind()
+    if conn.dialect.name == 'sqlite':
+        seconds = f"strftime('%Y-%m-%d %H:%M:%S', \"timestamp\" / {per_second}, 'unixepoch')"
+        fraction = f"printf('%06d', \"timestamp\" % {per_second} * {1000000 // per_second})"
+        for table in _sqlite_tables(conn):
+            op.execute(f"UPDATE {table} SET \"timestamp\" = {seconds} || '.' || {fraction} "
+                       f"WHERE typeof(\"timestamp\") = 'integer'")
+    elif conn.dialect.name == 'postgresql':
+        if _pg_column_type(conn) != 'bigint':
+            return
+        _check_pg_unpartitioned(conn)
+        op.execute(
+            f'ALTER TABLE {TABLE} ALTER COLUMN "timestamp" TYPE TIMESTAMP WITHOUT TIME ZONE '
+            f"USING to_timestamp(\"timestamp\"::double precision / {per_second}) AT TIME ZONE 'UTC'"
+        )
+    else:
+        raise RuntimeError(f"STATS_TIMESTAMP_UNIT is not supported on {conn.dialect.name}")
@@ -0,0 +1,21 @@
+import os
+import tempfile
+
+import pytest
+
+# The application reads its configuration from the environment on import
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'app.db')
+os.environ['STATS_PARTITION'] = ''
+os.environ['RING_BUFFER_PATH'] = ''
+
+from app import app, db
+
+
+@pytest.fixture
+def database():
+    """An application context on freshly created tables, dropped again afterwards"""
+    with app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
+        db.drop_all()
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from app.archive import (
+    VALUE_COLUMNS, archive_samples, decode_block, encode_block, read_archive, to_micros
+)
+from app.models import BandwidthArchiveBlock, BandwidthStat, Interface
+from app.storage import SQLStorage
+
+
+def _columns(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return {name: rng.uniform(0, 1e6, count).round(3) for name in VALUE_COLUMNS}
+
+
+@pytest.mark.parametrize('count', [0, 1, 2, 1440])
+def test_block_round_trip(count):
+    timestamps = to_micros(datetime(2024, 1, 1)) + np.arange(count, dtype=np.int64) * 60 * 10 ** 6
+    if count > 2:
+        timestamps[5:] += 1234567  # a late poll shifts the rest
+    columns = _columns(count)
+    if count:
+        columns['input_rate_kbps'][0] = np.nan
+        columns['output_errors'][-1] = np.nan
+    decoded_timestamps, decoded = decode_block(encode_block(timestamps, columns))
+    assert decoded_timestamps.tolist() == timestamps.tolist()
+    for name in VALUE_COLUMNS:
+        np.testing.assert_array_equal(decoded[name], columns[name])
+
+
+def test_block_keeps_negative_zero_and_extremes():
+    columns = {name: np.array([0.0, -0.0, np.inf, 1e-300, np.nan]) for name in VALUE_COLUMNS}
+    timestamps = np.array([0, 1, 2, 10 ** 15, 10 ** 15 + 1], dtype=np.int64)
+    _, decoded = decode_block(encode_block(timestamps, columns))
+    for name in VALUE_COLUMNS:
+        assert decoded[name].view(np.uint64).tolist() == columns[name].view(np.uint64).tolist()
+
+
+@pytest.fixture
+def history(database):
+    """Five days of one sample per hour, the first one without rates, with archiving due for three"""
+    database.session.add(Interface(id=1, ifname='Gi0/1'))
+    now = datetime(2024, 1, 6, 12)
+    rows = []
+    for hour in range(5 * 24 + 12):
+        rate = None if hour == 0 else float(hour)
+        rows.append({'interface_id': 1, 'timestamp': datetime(2024, 1, 1) + timedelta(hours=hour),
+                     'input_rate_kbps': rate, 'output_rate_kbps': rate, 'input_packets': hour})
+    database.session.execute(BandwidthStat.__table__.insert(), rows)
+    database.session.commit()
+    return now, rows
+
+
+def test_archive_moves_one_day_at_a_time(database, history):
+    now, rows = history
+    # Fewer rows per step than a day holds, so days are archived in several steps
+    samples, interfaces, written = archive_samples(after_days=2, now=now, limit=7)
+    cutoff = datetime(2024, 1, 4)
+    assert samples == sum(1 for row in rows if row['timestamp'] < cutoff) - 1
+    assert interfaces == 1 and written > 0
+    days = database.session.query(BandwidthArchiveBlock.day, BandwidthArchiveBlock.samples).order_by(
+        BandwidthArchiveBlock.day).all()
+    assert days == [(datetime(2024, 1, 1), 23), (datetime(2024, 1, 2), 24), (datetime(2024, 1, 3), 24)]
+    left = database.session.query(BandwidthStat.timestamp).order_by(BandwidthStat.timestamp).all()
+    assert left[0][0] == cutoff
+    assert archive_samples(after_days=2, now=now) == (0, 0, 0)
+
+
+def test_archive_stops_when_asked(database, history):
+    now, _ = history
+    assert archive_samples(after_days=2, now=now, limit=7, stop=lambda: True) == (0, 0, 0)
+    assert database.session.query(BandwidthArchiveBlock).count() == 0
+
+
+def test_history_reads_across_archive_and_hot_table(database, history):
+    now, rows = history
+    archive_samples(after_days=2, now=now)
+    since = datetime(2024, 1, 2, 6)
+    timestamps, columns = SQLStorage().read_columns(1, since)
+    expected = [row for row in rows if row['timestamp'] >= since]
+    assert timestamps.tolist() == [to_micros(row['timestamp']) for row in expected]
+    assert columns['input_rate_kbps'].tolist() == [row['input_rate_kbps'] for row in expected]
+    assert columns['input_packets'].tolist() == [row['input_packets'] for row in expected]
+    archived, _ = read_archive(database.session, 1, since)
+    assert 0 < len(archived) < len(timestamps)
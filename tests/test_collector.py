@@ -0,0 +1,40 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from app import app, utils
+from app.collector import collect_fleet_bandwidth_stats
+from app.utils import PollTarget
+
+
+@pytest.fixture
+def hanging_device(database, monkeypatch):
+    """A device whose SNMP agent takes every request and never answers"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    monkeypatch.setitem(app.config, 'SNMP_TARGET_OVERRIDE', f'127.0.0.1:{sock.getsockname()[1]}')
+    monkeypatch.setitem(app.config, 'SNMP_TIMEOUT', 10)
+    monkeypatch.setitem(app.config, 'SNMP_RETRIES', 1)
+    monkeypatch.setattr(utils, 'decrypt_sensitive_data', lambda value: 'public')
+    monkeypatch.setattr(utils, 'load_poll_targets', lambda device_ids=None: {
+        1: PollTarget(1, '192.0.2.1', 'key', 2, [(1, 'Gi0/1', 1000)])
+    })
+    yield 1, '192.0.2.1'
+    sock.close()
+
+
+def test_hanging_device_does_not_outlive_the_timeout(hanging_device):
+    started = time.monotonic()
+    with app.app_context():
+        summary = collect_fleet_bandwidth_stats([hanging_device], timeout=1)
+    assert summary['total'] == 1 and summary['success'] == 0
+
+    # Without a deadline the worker would wait out 2 attempts of SNMP_TIMEOUT;
+    # allow for starting the SNMP engine and its half second timer ticks
+    for thread in threading.enumerate():
+        if thread.name.startswith('collector'):
+            thread.join(5)
+            assert not thread.is_alive()
+    assert time.monotonic() - started < 5
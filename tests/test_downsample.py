@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from app.downsample import downsample, minmax_indices
+from app.models import BandwidthRollup
+from app.utils import get_interfaces_bandwidth_arrays
+
+
+def test_minmax_keeps_every_peak():
+    values = np.sin(np.linspace(0, 20, 5000)) * 10 + 50
+    values[1234] = 500.0
+    values[4321] = -500.0
+    keep = minmax_indices([values], 100)
+    assert len(keep) <= 100
+    assert {0, 1234, 4321, 4999} <= set(keep.tolist())
+
+
+def test_rollup_points_are_picked_by_their_extremes():
+    count = 2016
+    average = np.full(count, 50.0)
+    # Averages that rise elsewhere, so picking by them would miss the spike
+    average[::7] = 60.0
+    columns = {
+        'input_rate_kbps': average, 'input_rate_min': average - 10, 'input_rate_max': average + 10,
+        'output_rate_kbps': average, 'output_rate_min': average - 10, 'output_rate_max': average + 10,
+    }
+    columns['input_rate_max'] = columns['input_rate_max'].copy()
+    columns['input_rate_max'][1000] = 900.0
+    columns['output_rate_min'] = columns['output_rate_min'].copy()
+    columns['output_rate_min'][1500] = 0.0
+    micros = np.arange(count, dtype=np.int64) * 300 * 10 ** 6
+
+    kept, reduced = downsample(micros, columns, 200)
+    assert len(kept) <= 200
+    assert reduced['input_rate_max'].max() == 900.0
+    assert reduced['output_rate_min'].min() == 0.0
+
+
+def test_week_of_five_minute_rollups_keeps_the_peak(database):
+    start = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(days=7)
+    start -= timedelta(minutes=start.minute % 5)
+    rollups = []
+    for bucket in range(2016):
+        # A burst within one bucket that barely moves its average
+        spike = bucket == 1000
+        rollups.append({
+            'interface_id': 1, 'resolution': 300, 'bucket': start + timedelta(minutes=5 * bucket),
+            'samples': 5, 'input_rate_avg': 101.0 if spike else 100.0 + bucket % 3,
+            'input_rate_min': 90.0, 'input_rate_max': 5000.0 if spike else 110.0,
+            'output_rate_avg': 100.0, 'output_rate_min': 90.0, 'output_rate_max': 110.0,
+        })
+    database.session.execute(BandwidthRollup.__table__.insert(), rollups)
+    database.session.commit()
+
+    micros, columns, resolution = get_interfaces_bandwidth_arrays([1], hours=24 * 7, max_points=200)[1]
+    assert resolution == 300
+    assert len(micros) <= 200
+    assert columns['input_rate_max'].max() == 5000.0
@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import storage
+from app.storage import FileStorage
+
+
+@pytest.fixture
+def file_storage(database, tmp_path):
+    return FileStorage(str(tmp_path))
+
+
+def _rows(interface_id, start, count):
+    return [
+        {'interface_id': interface_id, 'timestamp': start + timedelta(minutes=minute),
+         'input_rate_kbps': 100.0, 'output_rate_kbps': 50.0}
+        for minute in range(count)
+    ]
+
+
+def test_write_batch_keeps_rows_when_current_state_fails(file_storage, monkeypatch):
+    def fail(conn, rows):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(storage, 'update_current_state', fail)
+    start = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(hours=1)
+    assert file_storage.write_batch(_rows(1, start, 10)) == 10
+    timestamps, _ = file_storage.read_columns(1, start)
+    assert len(timestamps) == 10
+
+
+def test_replayed_rows_are_counted_once(file_storage):
+    start = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(hours=1)
+    rows = _rows(1, start, 10)
+    file_storage.write_batch(rows)
+    file_storage.write_batch(rows[:5])
+    timestamps, _ = file_storage.read_columns(1, start)
+    assert len(timestamps) == 10
+    assert sum(rollup['samples'] for rollup in file_storage.aggregate(1, 3600, start)) == 10
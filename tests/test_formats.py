@@ -0,0 +1,85 @@
+import gzip
+
+import brotli
+import msgpack
+import numpy as np
+import pytest
+
+from app import app
+from app.formats import MIN_COMPRESS_SIZE, compressed_response, encode_history, pack_history, unpack_history
+
+
+def _history():
+    micros = np.array([1700000000000000, 1700000060000000, 1700000120000000], dtype=np.int64)
+    return {
+        7: (micros, {
+            'input_rate_kbps': np.array([1.5, np.nan, 0.0]),
+            'output_rate_kbps': np.array([2.0, 3.0, np.nan]),
+        }, None),
+        2 ** 32 - 1: (micros[:1], {
+            'input_rate_kbps': np.array([4.0]),
+            'output_rate_kbps': np.array([5.0]),
+        }, 300),
+        9: (micros[:0], {'input_rate_kbps': np.array([]), 'output_rate_kbps': np.array([])}, None),
+    }
+
+
+def test_pack_history_round_trip():
+    history = _history()
+    unpacked = unpack_history(pack_history(history))
+
+    assert list(unpacked) == list(history)
+    for interface_id, (micros, columns, resolution) in history.items():
+        millis, values, unpacked_resolution = unpacked[interface_id]
+        assert unpacked_resolution == resolution
+        assert millis.tolist() == (micros // 1000).tolist()
+        assert sorted(values) == ['in', 'out']
+        np.testing.assert_array_equal(values['in'], columns['input_rate_kbps'])
+        np.testing.assert_array_equal(values['out'], columns['output_rate_kbps'])
+
+
+def test_pack_history_keeps_only_the_asked_fields():
+    unpacked = unpack_history(pack_history(_history(), fields=['output_rate_kbps']))
+    assert all(list(columns) == ['out'] for _, columns, _ in unpacked.values())
+
+
+def test_unpack_history_rejects_other_data():
+    with pytest.raises(ValueError):
+        unpack_history(b'XYZ\x01\x00\x00\x00\x00')
+
+
+def test_encode_history_msgpack_matches_columns():
+    history = _history()
+    with app.app_context():
+        body, mimetype = encode_history(history, 'msgpack')
+    assert mimetype == 'application/msgpack'
+    payload = msgpack.unpackb(body, strict_map_key=False)
+    assert payload[7]['t'] == [1700000000000, 1700000060000, 1700000120000]
+    assert payload[7]['in'] == [1.5, None, 0.0]
+    assert payload[2 ** 32 - 1]['resolution'] == 300
+    assert 'resolution' not in payload[7]
+
+
+BODY = b'{"t": [1, 2, 3]}' * (MIN_COMPRESS_SIZE // 8)
+
+
+@pytest.mark.parametrize('accept, encoding, decode', [
+    ('br, gzip', 'br', brotli.decompress),
+    ('gzip, deflate', 'gzip', gzip.decompress),
+    ('br;q=0, gzip', 'gzip', gzip.decompress),
+    ('identity', None, bytes),
+    ('', None, bytes),
+])
+def test_compressed_response_negotiates_the_encoding(accept, encoding, decode):
+    with app.test_request_context(headers={'Accept-Encoding': accept}):
+        response = compressed_response(BODY, 'application/json')
+    assert response.content_encoding == encoding
+    assert decode(response.get_data()) == BODY
+    assert 'Accept-Encoding' in response.vary
+
+
+def test_compressed_response_leaves_small_bodies_alone():
+    with app.test_request_context(headers={'Accept-Encoding': 'br, gzip'}):
+        response = compressed_response('{}', 'application/json')
+    assert response.content_encoding is None
+    assert response.get_data() == b'{}'
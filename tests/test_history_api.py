@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import app, appbuilder, db
+from app.models import BandwidthStat, InterfaceCurrent
+from app.views import MarkEngineView
+
+
+@pytest.fixture
+def client(database, monkeypatch):
+    """A test client logged in as an admin"""
+    monkeypatch.setitem(app.config, 'WTF_CSRF_ENABLED', False)
+    appbuilder.sm.create_db()
+    # The permissions the views registered on import went with the previous tables
+    view = next(view for view in appbuilder.baseviews if isinstance(view, MarkEngineView))
+    appbuilder.sm.add_permissions_view(view.base_permissions, view.class_permission_name)
+    appbuilder.sm.add_user('admin', 'Admin', 'User', 'admin@example.com',
+                           appbuilder.sm.find_role('Admin'), password='secret')
+    client = app.test_client()
+    response = client.post('/login/', data={'username': 'admin', 'password': 'secret'})
+    assert response.status_code == 302
+    return client
+
+
+def _add_samples(interface_id, timestamps):
+    for index, timestamp in enumerate(timestamps):
+        db.session.add(BandwidthStat(interface_id=interface_id, timestamp=timestamp,
+                                     input_rate_kbps=float(index), output_rate_kbps=float(index)))
+    db.session.merge(InterfaceCurrent(interface_id=interface_id, timestamp=timestamps[-1],
+                                      input_rate_kbps=float(len(timestamps) - 1)))
+    db.session.commit()
+
+
+@pytest.fixture
+def samples(client):
+    now = datetime.utcnow().replace(microsecond=0)
+    timestamps = [now - timedelta(minutes=minutes) for minutes in (30, 20, 10)]
+    _add_samples(1, timestamps)
+    return timestamps
+
+
+def test_history_since_returns_the_samples_from_the_cursor_on(client, samples):
+    points = client.get('/markengine/api/bandwidth/1?hours=1&timestamps=s').get_json()
+    assert [point['input_rate_kbps'] for point in points] == [0.0, 1.0, 2.0]
+
+    cursor = points[1]['timestamp']
+    newer = client.get(f'/markengine/api/bandwidth/1?hours=1&timestamps=s&since={cursor}').get_json()
+    assert newer == points[1:]
+
+    since = samples[1].isoformat()
+    history = client.get(f'/markengine/api/bandwidth?interface_ids=1&hours=1&since={since}').get_json()
+    assert [point['timestamp'] for point in history['1']] == [samples[1].isoformat(), samples[2].isoformat()]
+
+
+def test_history_since_before_the_window_is_clamped(client, samples):
+    since = (samples[0] - timedelta(days=30)).isoformat()
+    points = client.get(f'/markengine/api/bandwidth/1?hours=1&since={since}').get_json()
+    assert len(points) == 3
+
+
+@pytest.mark.parametrize('query', [
+    'timestamps=s&since=99999999999999999',
+    'timestamps=ms&since=-99999999999999999',
+    'since=yesterday',
+    'timestamps=s&since=2024-01-01T00:00:00',
+    'format=binary&since=1.5',
+])
+def test_history_rejects_bad_since(client, query):
+    for url in ('/markengine/api/bandwidth/1', '/markengine/api/bandwidth?interface_ids=1'):
+        response = client.get(f"{url}{'&' if '?' in url else '?'}{query}")
+        assert response.status_code == 400
+        assert response.get_json() == {'error': "since must be a timestamp as returned by the API"}
+
+
+def test_history_answers_304_until_a_new_sample(client, samples):
+    url = '/markengine/api/bandwidth/1?hours=1'
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.get_data() == b''
+
+    # Another query string is another resource
+    assert client.get(url + '&timestamps=ms', headers={'If-None-Match': etag}).status_code == 200
+
+    _add_samples(1, [samples[-1] + timedelta(minutes=5)])
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(response.get_json()) == 4
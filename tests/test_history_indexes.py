@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import app, db
+from app.storage import history_columns_query, rollup_columns_query
+from app.utils import explain_history_queries, query_plan
+
+STATS_INDEX = 'ix_bandwidth_stats_interface_timestamp'
+ROLLUPS_INDEX = 'ix_bandwidth_rollups_interface_resolution_bucket'
+
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+@pytest.mark.parametrize('interface_ids', [[1], list(range(1, 501))])
+def test_history_columns_query_uses_index(interface_ids):
+    now = datetime.utcnow()
+    for until in (None, now):
+        query = history_columns_query(interface_ids, now - timedelta(hours=24), until, 'sqlite')
+        plan, uses_index = query_plan(query, STATS_INDEX)
+        assert uses_index, plan
+
+
+@pytest.mark.parametrize('resolution', [60, 300, 3600, 86400])
+def test_rollup_columns_query_uses_index(resolution):
+    query = rollup_columns_query(db.session, [1, 2, 3], resolution, datetime.utcnow() - timedelta(days=7))
+    plan, uses_index = query_plan(query.statement, ROLLUPS_INDEX)
+    assert uses_index, plan
+
+
+def test_explain_history_queries():
+    plans = explain_history_queries([1, 2, 3], hours=24)
+    assert [index_name for index_name, _, _ in plans] == [STATS_INDEX, ROLLUPS_INDEX]
+    for index_name, plan, uses_index in plans:
+        assert uses_index, (index_name, plan)
+
+
+def test_cli_explain():
+    result = app.test_cli_runner().invoke(args=['stats', 'explain', '--interface-id', '1', '--interface-id', '2'])
+    assert result.exit_code == 0, result.output
+    assert f"OK: history queries use {STATS_INDEX}." in result.output
+    assert f"OK: history queries use {ROLLUPS_INDEX}." in result.output
@@ -0,0 +1,75 @@
+import os
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from app.ingest import BatchWriter
+from app.spool import QUARANTINE_DIR, Spool
+
+DELETED_INTERFACE = 999
+
+
+class FlakyStorage:
+    """Storage backend that is down on demand and refuses rows of a deleted interface"""
+
+    def __init__(self):
+        self.down = False
+        self.rows = []
+
+    def write_batch(self, rows):
+        if self.down:
+            raise OperationalError('INSERT', {}, Exception('database is locked'))
+        if any(row['interface_id'] == DELETED_INTERFACE for row in rows):
+            raise IntegrityError('INSERT', {}, Exception('FOREIGN KEY constraint failed'))
+        self.rows.extend(rows)
+        return len(rows)
+
+
+def _rows(interface_id, count=3):
+    return [{'interface_id': interface_id, 'timestamp': datetime(2024, 1, 1, 0, minute),
+             'input_rate_kbps': 1.0} for minute in range(count)]
+
+
+def test_unavailable_database_spools_and_replays(tmp_path):
+    storage = FlakyStorage()
+    writer = BatchWriter(batch_size=10, storage=storage, spool=Spool(str(tmp_path)))
+    storage.down = True
+    writer.add_many(_rows(1))
+    writer.flush()
+    assert writer.db_down()
+    assert writer.rows_spooled == 3
+    assert not storage.rows
+
+    storage.down = False
+    writer._db_down_until = 0.0
+    assert writer.replay_spool() == 3
+    assert len(storage.rows) == 3
+    assert writer.spool.pending() == (0, 0)
+
+
+def test_rejected_batch_is_not_spooled(tmp_path):
+    storage = FlakyStorage()
+    writer = BatchWriter(batch_size=10, storage=storage, spool=Spool(str(tmp_path)))
+    writer.add_many(_rows(DELETED_INTERFACE))
+    writer.flush()
+    assert not writer.db_down()
+    assert writer.rows_dropped == 3
+    assert writer.rows_spooled == 0
+
+    writer.add_many(_rows(1))
+    writer.flush()
+    assert writer.rows_written == 3
+
+
+def test_rejected_segment_is_quarantined(tmp_path):
+    storage = FlakyStorage()
+    spool = Spool(str(tmp_path), segment_bytes=1)
+    spool.append(_rows(DELETED_INTERFACE))
+    spool.append(_rows(1))
+    writer = BatchWriter(batch_size=10, storage=storage, spool=spool)
+
+    assert writer.replay_spool() == 3
+    assert not writer.db_down()
+    assert [row['interface_id'] for row in storage.rows] == [1, 1, 1]
+    assert spool.pending() == (0, 0)
+    assert len(os.listdir(tmp_path / QUARANTINE_DIR)) == 1
@@ -0,0 +1,29 @@
+import pytest
+
+from app.partitions import check_sqlite_partition_limit, sqlite_partitions_needed
+
+
+@pytest.mark.parametrize('days, retention_days, ahead, needed', [
+    (1, 7, 1, 9),
+    (1, 8, 1, 10),
+    (7, 7, 1, 3),
+    (7, 10, 2, 5),
+    (1, 0, 1, None),
+])
+def test_sqlite_partitions_needed(days, retention_days, ahead, needed):
+    assert sqlite_partitions_needed(days, retention_days, ahead) == needed
+
+
+def test_check_sqlite_partition_limit_accepts_default_retention():
+    check_sqlite_partition_limit({'STATS_PARTITION': 'day', 'RETENTION_RAW_DAYS': 7, 'STATS_PARTITION_AHEAD': 1})
+    check_sqlite_partition_limit({'STATS_PARTITION': 'week', 'RETENTION_RAW_DAYS': 42, 'STATS_PARTITION_AHEAD': 1})
+
+
+@pytest.mark.parametrize('config', [
+    {'STATS_PARTITION': 'day', 'RETENTION_RAW_DAYS': 8, 'STATS_PARTITION_AHEAD': 1},
+    {'STATS_PARTITION': 'day', 'RETENTION_RAW_DAYS': 7, 'STATS_PARTITION_AHEAD': 2},
+    {'STATS_PARTITION': 'week', 'RETENTION_RAW_DAYS': 0, 'STATS_PARTITION_AHEAD': 1},
+])
+def test_check_sqlite_partition_limit_refuses_too_many(config):
+    with pytest.raises(ValueError, match='SQLite attaches at most 9'):
+        check_sqlite_partition_limit(config)
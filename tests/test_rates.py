@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import utils
+from app.rates import COUNTER_FIELDS, CounterSample, RateEngine, counter_delta
+from app.utils import PollTarget, collect_interface_bandwidth_stats
+
+START = datetime(2024, 1, 1)
+
+
+def _sample(seconds, octets, uptime=None, bits=64, packets=0, errors=0):
+    counters = {field: 0 for field in COUNTER_FIELDS}
+    counters.update(input_octets_counter=octets, output_octets_counter=octets,
+                    input_packets_counter=packets, input_errors_counter=errors)
+    if uptime is not None:
+        uptime = int(uptime) % (1 << 32)
+    return CounterSample(START + timedelta(seconds=seconds), uptime, counters, bits)
+
+
+@pytest.mark.parametrize('previous, current, bits, delta', [
+    (100, 250, 32, 150),
+    (2 ** 32 - 100, 50, 32, 150),
+    (2 ** 64 - 100, 50, 64, 150),
+    (2 ** 32 - 100, 50, 64, None),  # a 64 bit counter does not wrap at 2**32
+    (1000000000, 10, 32, None),  # fell by more than half the range: reset
+    (None, 10, 32, None),
+])
+def test_counter_delta(previous, current, bits, delta):
+    assert counter_delta(previous, current, bits) == delta
+
+
+def test_first_poll_has_no_rates():
+    engine = RateEngine()
+    assert engine.update(1, _sample(0, 1000, uptime=100)) is None
+    assert engine.has_sample(1)
+
+
+def test_rates_across_a_32_bit_wrap():
+    engine = RateEngine()
+    engine.update(1, _sample(0, 2 ** 32 - 1000, uptime=0, bits=32))
+    rates = engine.update(1, _sample(60, 74000, uptime=6000, bits=32))
+    assert rates['interval'] == 60
+    assert rates['input_rate_kbps'] == pytest.approx(75000 * 8 / 1000 / 60)
+
+
+def test_rates_across_a_64_bit_wrap():
+    engine = RateEngine()
+    engine.update(1, _sample(0, 2 ** 64 - 1000, uptime=0))
+    rates = engine.update(1, _sample(60, 74000, uptime=6000))
+    assert rates['output_rate_kbps'] == pytest.approx(75000 * 8 / 1000 / 60)
+
+
+def test_error_counters_wrap_at_32_bits():
+    engine = RateEngine()
+    engine.update(1, _sample(0, 0, uptime=0, errors=2 ** 32 - 5))
+    rates = engine.update(1, _sample(60, 1000, uptime=6000, errors=5))
+    assert rates['input_errors'] == 10
+
+
+def test_sys_uptime_reset_means_a_reboot():
+    engine = RateEngine()
+    engine.update(1, _sample(0, 5000000, uptime=8640000))
+    # Rebooted 30 seconds ago: counters restarted too
+    assert engine.update(1, _sample(60, 1000, uptime=3000)) is None
+    # The reboot sample primes the engine for the next poll
+    assert engine.update(1, _sample(120, 61000, uptime=9000))['input_rate_kbps'] == pytest.approx(8.0)
+
+
+def test_sys_uptime_wrap_is_not_a_reboot():
+    engine = RateEngine()
+    engine.update(1, _sample(0, 0, uptime=2 ** 32 - 3000))
+    rates = engine.update(1, _sample(60, 60000, uptime=3000))
+    assert rates['interval'] == 60
+
+
+def test_rate_beyond_the_interface_speed_is_a_reset():
+    engine = RateEngine()
+    engine.update(1, _sample(0, 0, uptime=0), speed_kbps=1000)
+    # 1.4 times the speed is still a rate
+    assert engine.update(1, _sample(60, 1400 * 1000 // 8 * 60, uptime=6000), speed_kbps=1000)
+    # 2 times the speed cannot be real
+    base = 1400 * 1000 // 8 * 60
+    assert engine.update(1, _sample(120, base + 2000 * 1000 // 8 * 60, uptime=12000), speed_kbps=1000) is None
+
+
+def test_switch_between_32_and_64_bit_counters_has_no_rates():
+    engine = RateEngine()
+    engine.update(1, _sample(0, 1000, uptime=0, bits=32))
+    assert engine.update(1, _sample(60, 2000, uptime=6000, bits=64)) is None
+
+
+class ListWriter:
+    def __init__(self):
+        self.rows = []
+
+    def add_many(self, rows):
+        self.rows.extend(rows)
+
+
+def test_first_poll_stores_null_rates(database, monkeypatch):
+    monkeypatch.setattr(utils, 'decrypt_sensitive_data', lambda value: 'public')
+    monkeypatch.setattr(utils, 'get_sys_uptime', lambda *args, **kwargs: 100)
+    monkeypatch.setattr(utils, 'walk_interface_table', lambda *args, **kwargs: {
+        1: {'ifName': 'Gi0/1', 'ifHCInOctets': 1000, 'ifHCOutOctets': 0}
+    })
+    target = PollTarget(1, '192.0.2.1', 'secret', 2, [(4242, 'Gi0/1', 1000)])
+    writer = ListWriter()
+    utils.rate_engine.forget(4242)
+    try:
+        collect_interface_bandwidth_stats(1, writer=writer, target=target)
+        row, = writer.rows
+        assert row['input_rate_kbps'] is None and row['output_rate_kbps'] is None
+        assert row['input_octets_counter'] == 1000
+    finally:
+        utils.rate_engine.forget(4242)
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from app import app, db
+from app.models import BandwidthStat, InterfaceCurrent
+from app.ringbuffer import RingBuffer, open_ring_buffer
+from app.utils import bandwidth_history_arrays_many
+
+
+def _samples(interface_id, start, count, rate):
+    return [{'interface_id': interface_id, 'timestamp': start + timedelta(minutes=minute),
+             'input_rate_kbps': rate, 'output_rate_kbps': rate} for minute in range(count)]
+
+
+@pytest.fixture
+def ring(database, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'RING_BUFFER_PATH', str(tmp_path / 'bandwidth.ring'))
+    return open_ring_buffer()
+
+
+def test_window_requires_newest_sample(tmp_path):
+    ring = RingBuffer(str(tmp_path / 'ring'), slots=16)
+    start = datetime(2024, 1, 1)
+    ring.append(_samples(1, start, 10, 1.0))
+    newest = start + timedelta(minutes=9)
+    assert len(ring.window(1, start, newest)) == 10
+    assert ring.window(1, start, newest + timedelta(minutes=1)) is None
+
+
+def test_stale_ring_falls_back_to_storage(ring):
+    now = datetime.utcnow().replace(microsecond=0)
+    # This host's collector stopped writing the ring half an hour ago
+    ring.append(_samples(1, now - timedelta(hours=2), 90, 1.0))
+    stored = _samples(1, now - timedelta(minutes=20), 20, 2.0)
+    db.session.execute(BandwidthStat.__table__.insert(), stored)
+    db.session.add(InterfaceCurrent(interface_id=1, timestamp=stored[-1]['timestamp'], input_rate_kbps=2.0))
+    db.session.commit()
+
+    micros, columns, resolution = bandwidth_history_arrays_many([1], hours=1)[1]
+    assert resolution is None
+    assert len(micros) == 20
+    assert np.all(columns['input_rate_kbps'] == 2.0)
+
+
+def test_current_ring_is_used(ring):
+    now = datetime.utcnow().replace(microsecond=0)
+    samples = _samples(1, now - timedelta(hours=2), 120, 1.0)
+    ring.append(samples)
+    db.session.add(InterfaceCurrent(interface_id=1, timestamp=samples[-1]['timestamp'], input_rate_kbps=1.0))
+    db.session.commit()
+
+    micros, columns, _ = bandwidth_history_arrays_many([1], hours=1)[1]
+    assert len(micros) >= 59
+    assert np.all(columns['input_rate_kbps'] == 1.0)
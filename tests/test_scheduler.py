@@ -0,0 +1,114 @@
+import random
+
+import pytest
+
+from app.scheduler import PollScheduler
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    random.seed(7)
+    return Clock()
+
+
+def _due(scheduler, device_id):
+    return scheduler._due[device_id]
+
+
+def test_first_poll_is_spread_over_one_interval(clock):
+    scheduler = PollScheduler(clock=clock)
+    for device_id in range(200):
+        scheduler.add(device_id, 60)
+    dues = [_due(scheduler, device_id) - clock.now for device_id in range(200)]
+    assert all(0 <= due <= 60 for due in dues)
+    assert max(dues) - min(dues) > 30
+
+
+def test_jitter_stays_within_bounds(clock):
+    scheduler = PollScheduler(jitter=0.1, clock=clock)
+    scheduler.add(1, 100)
+    for _ in range(500):
+        clock.now = _due(scheduler, 1)
+        assert scheduler.pop_due(10) == [1]
+        scheduler.done(1)
+        assert 90 <= _due(scheduler, 1) - clock.now <= 110
+    assert scheduler.coalesced == 0
+
+
+def test_done_keeps_the_schedule_despite_poll_duration(clock):
+    scheduler = PollScheduler(jitter=0.0, clock=clock)
+    scheduler.add(1, 60)
+    due = _due(scheduler, 1)
+    clock.now = due
+    scheduler.pop_due(1)
+    clock.now += 20
+    scheduler.done(1)
+    assert _due(scheduler, 1) == due + 60
+
+
+def test_missed_polls_are_coalesced(clock):
+    scheduler = PollScheduler(jitter=0.1, clock=clock)
+    scheduler.add(1, 60)
+    due = _due(scheduler, 1)
+    clock.now = due
+    scheduler.pop_due(1)
+    # The poll hung for 200 seconds: three more polls were due meanwhile
+    clock.now = due + 200
+    scheduler.done(1)
+    assert scheduler.coalesced == 3
+    assert 54 <= _due(scheduler, 1) - clock.now <= 66
+    assert scheduler.pop_due(10) == []
+
+
+def test_in_flight_device_is_not_popped_twice(clock):
+    scheduler = PollScheduler(clock=clock)
+    scheduler.add(1, 60)
+    clock.now += 60
+    assert scheduler.pop_due(10) == [1]
+    clock.now += 600
+    assert scheduler.pop_due(10) == []
+    assert scheduler.next_due_in() is None
+
+
+def test_removed_device_is_skipped(clock):
+    scheduler = PollScheduler(clock=clock)
+    scheduler.add(1, 60)
+    scheduler.add(2, 60)
+    scheduler.remove(1)
+    clock.now += 60
+    assert scheduler.pop_due(10) == [2]
+    assert 1 not in scheduler
+
+
+def test_stale_entries_after_remove_and_add_are_skipped(clock):
+    scheduler = PollScheduler(clock=clock)
+    scheduler.add(1, 600)
+    scheduler.remove(1)
+    scheduler.add(1, 600)
+    scheduler.set_interval(1, 10)
+    # Several heap entries now exist for the device, only the last one is live
+    assert len(scheduler._heap) >= 2
+    clock.now += 600
+    assert scheduler.pop_due(10) == [1]
+    assert scheduler.pop_due(10) == []
+    assert scheduler._heap == []
+
+
+def test_removed_in_flight_device_is_not_rescheduled(clock):
+    scheduler = PollScheduler(clock=clock)
+    scheduler.add(1, 60)
+    clock.now += 60
+    scheduler.pop_due(1)
+    scheduler.remove(1)
+    scheduler.done(1)
+    clock.now += 600
+    assert scheduler.pop_due(10) == []
+    assert len(scheduler) == 0
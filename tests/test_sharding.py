@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models import CollectorWorker
+from app.sharding import HashRing, WorkerRegistry, parse_shard, shard_devices
+
+DEVICES = range(1, 2001)
+WORKERS = ['host-a-1', 'host-a-2', 'host-b-1', 'host-c-1']
+
+
+def _owners(ring):
+    return {device_id: ring.owner(device_id) for device_id in DEVICES}
+
+
+def test_dead_worker_only_moves_its_own_devices():
+    before = _owners(HashRing(WORKERS))
+    after = _owners(HashRing([worker for worker in WORKERS if worker != 'host-b-1']))
+    moved = {device_id for device_id in DEVICES if before[device_id] != after[device_id]}
+    assert moved == {device_id for device_id in DEVICES if before[device_id] == 'host-b-1'}
+    assert 'host-b-1' not in after.values()
+
+
+def test_new_worker_only_takes_devices():
+    before = _owners(HashRing(WORKERS))
+    after = _owners(HashRing(WORKERS + ['host-d-1']))
+    assert all(after[device_id] in (before[device_id], 'host-d-1') for device_id in DEVICES)
+
+
+def test_load_is_spread_over_the_workers():
+    counts = {}
+    for owner in _owners(HashRing(WORKERS)).values():
+        counts[owner] = counts.get(owner, 0) + 1
+    assert sorted(counts) == sorted(WORKERS)
+    assert min(counts.values()) > len(DEVICES) / len(WORKERS) / 2
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing([]).owner(1) is None
+
+
+def test_static_shards_split_every_device_once():
+    devices = [(device_id, f"10.0.0.{device_id}") for device_id in DEVICES]
+    shards = [shard_devices(devices, index, 3) for index in range(3)]
+    assert sorted(device for shard in shards for device in shard) == devices
+
+
+@pytest.mark.parametrize('value, expected', [('1/1', (0, 1)), ('2/4', (1, 4)), ('4/4', (3, 4))])
+def test_parse_shard(value, expected):
+    assert parse_shard(value) == expected
+
+
+@pytest.mark.parametrize('value', ['0/4', '5/4', '-1/4', '1/0', '1/-2', '1', '1/2/3', 'a/4', '1/b', '', None])
+def test_parse_shard_rejects_invalid_input(value):
+    with pytest.raises(ValueError, match='Invalid shard'):
+        parse_shard(value)
+
+
+def test_registry_drops_workers_whose_heartbeat_expired(database):
+    first, second = WorkerRegistry('host-a-1', ttl=30), WorkerRegistry('host-b-1', ttl=30)
+    first.heartbeat()
+    assert second.heartbeat() == ['host-a-1', 'host-b-1']
+    # host-a-1 died a minute ago
+    database.session.query(CollectorWorker).filter_by(worker_id='host-a-1').update(
+        {'heartbeat_at': datetime.utcnow() - timedelta(seconds=60)}
+    )
+    database.session.commit()
+    assert second.heartbeat() == ['host-b-1']
+    second.leave()
+    assert first.heartbeat() == ['host-a-1']
@@ -0,0 +1,109 @@
+import importlib.util
+import os
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine, text, true
+from sqlalchemy.pool import StaticPool
+
+from app import app
+from app.models import BandwidthStat, EpochDateTime
+from app.partitions import TABLE, _attach_sqlite_partitions, _unpartitioned_table, ensure_sqlite_partitions
+from app.retention import prune_table
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+MIGRATION = os.path.join(os.path.dirname(TESTS_DIR), 'migrations', 'versions', 'f4c8a2e6b913_.py')
+
+# Only run in the process test_suite_with_epoch_timestamps() starts
+epoch_storage = pytest.mark.skipif(
+    not os.environ.get('STATS_TIMESTAMP_UNIT'), reason="needs STATS_TIMESTAMP_UNIT set before the app is imported"
+)
+
+
+def test_epoch_datetime_binds_integers():
+    moment = datetime(2024, 3, 10, 12, 34, 56, 789123)
+    seconds, millis = EpochDateTime('s'), EpochDateTime('ms')
+    assert seconds.process_bind_param(moment, None) == 1710074096
+    assert millis.process_bind_param(moment, None) == 1710074096789
+    assert millis.process_result_value(1710074096789, None) == datetime(2024, 3, 10, 12, 34, 56, 789000)
+    assert seconds.process_result_value(1710074096, None) == datetime(2024, 3, 10, 12, 34, 56)
+    assert millis.process_bind_param(1710074096789, None) == 1710074096789
+    assert millis.process_bind_param(None, None) is None
+    assert millis.process_result_value(None, None) is None
+    with pytest.raises(ValueError):
+        EpochDateTime('us')
+
+
+def _migrate(engine, step):
+    spec = importlib.util.spec_from_file_location('stats_timestamps_migration', MIGRATION)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    with app.app_context(), engine.begin() as conn:
+        with Operations.context(MigrationContext.configure(conn)):
+            getattr(migration, step)()
+        return conn.execute(text(f'SELECT "timestamp" FROM {TABLE} ORDER BY id')).scalars().all()
+
+
+@pytest.mark.parametrize('unit, epoch, restored', [
+    ('s', 1710074096, '2024-03-10 12:34:56.000000'),
+    ('ms', 1710074096789, '2024-03-10 12:34:56.789000'),
+])
+def test_migration_converts_sqlite_samples(tmp_path, monkeypatch, unit, epoch, restored):
+    engine = create_engine(f"sqlite:///{tmp_path / 'app.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(f'CREATE TABLE {TABLE} (id INTEGER PRIMARY KEY, "timestamp" DATETIME)'))
+        conn.execute(text(f'INSERT INTO {TABLE} ("timestamp") VALUES (:first), (NULL), (:second)'),
+                     {'first': '2024-03-10 12:34:56.789123', 'second': '1970-01-01 00:00:01.000000'})
+
+    monkeypatch.setitem(app.config, 'STATS_TIMESTAMP_UNIT', '')
+    assert _migrate(engine, 'upgrade')[0] == '2024-03-10 12:34:56.789123'
+
+    monkeypatch.setitem(app.config, 'STATS_TIMESTAMP_UNIT', unit)
+    assert _migrate(engine, 'upgrade') == [epoch, None, 1 if unit == 's' else 1000]
+    # Converted rows are left alone when it runs again
+    assert _migrate(engine, 'upgrade') == [epoch, None, 1 if unit == 's' else 1000]
+    assert _migrate(engine, 'downgrade') == [restored, None, '1970-01-01 00:00:01.000000']
+
+
+@epoch_storage
+def test_partitions_compare_integer_timestamps(tmp_path):
+    column_type = BandwidthStat.__table__.c.timestamp.type
+    assert isinstance(column_type, EpochDateTime)
+    directory = str(tmp_path / 'partitions')
+    now = datetime(2024, 3, 10, 12)
+    partitions = ensure_sqlite_partitions(directory, 1, ahead=1, now=now)
+    connection = sqlite3.connect(str(tmp_path / 'app.db'))
+    _attach_sqlite_partitions(connection, directory, partitions)
+    for moment in (now - timedelta(days=2), now, now + timedelta(days=1)):
+        connection.execute(f'INSERT INTO {TABLE} (interface_id, "timestamp") VALUES (1, ?)',
+                           (column_type.to_epoch(moment),))
+    connection.commit()
+
+    def stored(schema, table):
+        return connection.execute(f'SELECT typeof("timestamp"), count(*) FROM "{schema}".{table}').fetchall()
+
+    assert stored('p20240310', f'{TABLE}_p20240310') == [('integer', 1)]
+    assert stored('p20240311', f'{TABLE}_p20240311') == [('integer', 1)]
+    assert stored('pdefault', f'{TABLE}_default') == [('integer', 1)]
+
+    # Retention deletes the rows outside the partitions by comparing integers
+    engine = create_engine('sqlite://', creator=lambda: connection, poolclass=StaticPool)
+    default = _unpartitioned_table(f'{TABLE}_default', schema='pdefault')
+    assert prune_table(default, true(), default.c.timestamp < now, engine=engine) == 1
+    assert stored('pdefault', f'{TABLE}_default') == [('null', 0)]
+
+
+@pytest.mark.skipif(bool(os.environ.get('STATS_TIMESTAMP_UNIT')), reason="already storing epoch timestamps")
+def test_suite_with_epoch_timestamps():
+    """The whole suite again, in a process storing the timestamps of samples as epoch milliseconds"""
+    result = subprocess.run(
+        [sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider', TESTS_DIR],
+        env=dict(os.environ, STATS_TIMESTAMP_UNIT='ms'), cwd=os.path.dirname(TESTS_DIR),
+        capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stdout[-5000:]
@@ -0,0 +1,27 @@
+import pytest
+
+from app.storage import FileStorage, SQLStorage, StorageBackend, create_storage
+
+
+class ReadOnlyStorage(StorageBackend):
+    """A custom backend that forgot most of the interface"""
+
+    name = 'read-only'
+
+    def __init__(self, config):
+        self.config = config
+
+    def read_range(self, interface_id, since, until=None):
+        return []
+
+
+def test_create_storage_builds_the_configured_backend(tmp_path):
+    assert isinstance(create_storage({}), SQLStorage)
+    assert isinstance(create_storage({'STATS_BACKEND': 'file', 'STATS_FILE_DIR': str(tmp_path)}), FileStorage)
+    with pytest.raises(ValueError):
+        create_storage({'STATS_BACKEND': 'influx'})
+
+
+def test_incomplete_custom_backend_fails_when_created():
+    with pytest.raises(TypeError, match='write_batch'):
+        create_storage({'STATS_BACKEND': f'{__name__}:ReadOnlyStorage'})
@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import app, db
+from app.archive import to_micros
+from app.models import InterfaceCurrent
+from app.ringbuffer import open_ring_buffer
+from app.stream import latest_samples
+
+
+@pytest.fixture
+def ring(database, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'RING_BUFFER_PATH', str(tmp_path / 'bandwidth.ring'))
+    return open_ring_buffer()
+
+
+def _sample(interface_id, timestamp, rate):
+    return {'interface_id': interface_id, 'timestamp': timestamp, 'input_rate_kbps': rate, 'output_rate_kbps': rate}
+
+
+def test_latest_samples_takes_the_newer_source(ring):
+    now = datetime.utcnow().replace(microsecond=0)
+    # Interface 1 moved to another host: this ring stopped a minute ago
+    ring.append([_sample(1, now - timedelta(minutes=1), 1.0), _sample(2, now, 1.0)])
+    db.session.add_all([
+        InterfaceCurrent(interface_id=1, timestamp=now, input_rate_kbps=2.0),
+        InterfaceCurrent(interface_id=2, timestamp=now - timedelta(minutes=1), input_rate_kbps=2.0),
+        InterfaceCurrent(interface_id=3, timestamp=now, input_rate_kbps=3.0),
+    ])
+    db.session.commit()
+
+    latest = latest_samples({1, 2, 3, 4})
+    assert sorted(latest) == [1, 2, 3]
+    assert latest[1]['timestamp'] == to_micros(now) and latest[1]['input_rate_kbps'] == 2.0
+    assert latest[2]['timestamp'] == to_micros(now) and latest[2]['input_rate_kbps'] == 1.0
+    assert latest[3]['input_rate_kbps'] == 3.0